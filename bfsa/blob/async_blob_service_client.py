@@ -0,0 +1,148 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-29
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from typing import List, Dict, Optional, Tuple
+from asyncio import Lock, Task, create_task
+from base64 import b64encode
+from collections import deque
+from fastapi import UploadFile
+from azure.storage.blob import BlobBlock
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient
+
+from bfsa.blob.blob_service_client import environment, get_blob_name
+from bfsa.utils.logger import logger as log
+
+
+class AsyncContainerClientPool:
+    """
+    Asynchronous counterpart of bfsa.blob.blob_service_client.ContainerClientPool, for
+    blob I/O on the event loop rather than in the thread pool
+    """
+
+    def __init__(self):
+        self._service_clients: Dict[str, BlobServiceClient] = {}
+        self._container_clients: Dict[Tuple[str, str], ContainerClient] = {}
+        self._lock: Optional[Lock] = None
+
+    async def get(self, connection: str, container: str) -> ContainerClient:
+        client = self._container_clients.get((connection, container))
+        if client is not None:
+            return client
+
+        # created lazily so that the lock binds to the server's event loop
+        if self._lock is None:
+            self._lock = Lock()
+
+        async with self._lock:
+            if (connection, container) not in self._container_clients:
+                if connection not in self._service_clients:
+                    self._service_clients[
+                        connection
+                    ] = BlobServiceClient.from_connection_string(connection)
+                client = self._service_clients[connection].get_container_client(
+                    container=container,
+                )
+                # raises if the container does not exist
+                await client.get_container_properties()
+                self._container_clients[(connection, container)] = client
+            return self._container_clients[(connection, container)]
+
+    async def validate(self, connection: str, containers: List[str]) -> None:
+        """
+        Checks that every container exists, keeping their clients for later use
+        """
+        log.info("Calling AsyncContainerClientPool.validate")
+        for container in containers:
+            await self.get(connection, container)
+
+    async def close(self) -> None:
+        log.info("Calling AsyncContainerClientPool.close")
+        for service_client in self._service_clients.values():
+            await service_client.close()
+        self._service_clients.clear()
+        self._container_clients.clear()
+
+
+async_container_client_pool = AsyncContainerClientPool()
+
+
+async def upload_blob(
+    connection: str,
+    container: str,
+    filename: str,
+    file: UploadFile,
+    guid: str,
+    overwrite: bool = False,
+    block_size: Optional[int] = None,
+    max_concurrency: Optional[int] = None,
+) -> Optional[str]:
+    """
+    Streams an upload to blob storage as staged blocks without blocking the event loop,
+    see bfsa.blob.blob_service_client.upload_blob
+    :param file: file with an asynchronous read, e.g. UploadFile
+    :return: URL of the blob, or None on failure
+    """
+    log.info("Calling upload_blob")
+
+    block_size = block_size or environment["BLOB_BLOCK_SIZE"]
+    max_concurrency = max_concurrency or environment["BLOB_MAX_CONCURRENCY"]
+
+    in_flight: "deque[Task]" = deque()
+    try:
+
+        container_client = await async_container_client_pool.get(connection, container)
+        client = container_client.get_blob_client(get_blob_name(guid, filename))
+
+        blocks = []
+        chunk = await file.read(block_size)
+        while chunk:
+            # block ids must all be the same length within a blob
+            block_id = b64encode(f"{len(blocks):08d}".encode()).decode()
+            blocks.append(BlobBlock(block_id=block_id))
+            in_flight.append(create_task(client.stage_block(block_id, chunk)))
+            if len(in_flight) >= max_concurrency:
+                await in_flight.popleft()
+            chunk = await file.read(block_size)
+        while in_flight:
+            await in_flight.popleft()
+
+        # without overwrite, committing fails if the blob already exists
+        await client.commit_block_list(
+            blocks,
+            **({} if overwrite else {"if_none_match": "*"}),
+        )
+
+        return client.url
+    except Exception as e:
+        for staged in in_flight:
+            staged.cancel()
+        log.critical(f"Failed to insert blob into storage. Error: {e}")
+        return None
+
+
+async def delete_blob(
+    connection: str,
+    container: str,
+    url: str,
+) -> bool:
+    log.info("Calling delete_blob")
+
+    try:
+
+        client = await async_container_client_pool.get(connection, container)
+        await client.get_blob_client(
+            url.replace(client.primary_endpoint + "/", "")
+        ).delete_blob()
+        return True
+    except Exception as e:
+        log.critical(f"Failed to delete blob from storage. Error: {e}")
+        return False
+
+
+if __name__ == "__main__":
+    pass
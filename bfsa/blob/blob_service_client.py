@@ -6,46 +6,237 @@ Created on 2022-08-28
 @email: bennettedmund@gmail.com
 """
 
-from typing import Optional
-from io import BytesIO
-from azure.storage.blob import BlobServiceClient
+from typing import List, Dict, Optional, Tuple, BinaryIO
+from base64 import b64encode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Lock
+from uuid import UUID
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import (
+    BlobBlock,
+    BlobSasPermissions,
+    BlobServiceClient,
+    ContainerClient,
+    generate_blob_sas,
+)
 
+from bfsa.controllers.environment import Environment
 from bfsa.utils.logger import logger as log
 
 
+environment = Environment()
+
+
+BLOB_CONTAINERS = ["family-tree-photos", "media", "papers", "recipe-photos"]
+
+UPLOAD_URL_EXPIRY_IN_SECONDS = 15 * 60
+# blobs uploaded through upload URLs are kept apart from those stored by the API, so
+# committing an upload can only ever refer to a blob uploaded that way
+UPLOAD_BLOB_PREFIX = "uploads/"
+
+
+def get_blob_name(guid: str, filename: str) -> str:
+    return f"{guid}.{filename.split('.')[-1]}"
+
+
+def get_upload_blob_name(guid: str, filename: str) -> Optional[str]:
+    """
+    :return: name of the blob an upload URL is issued for, or None if guid is not one
+        issued by create_guid or filename does not have a plain extension
+    """
+    try:
+        if str(UUID(guid)) != guid:
+            return None
+    except ValueError:
+        return None
+    if not filename.split(".")[-1].isalnum():
+        return None
+    return f"{UPLOAD_BLOB_PREFIX}{get_blob_name(guid, filename)}"
+
+
+class ContainerClientPool:
+    """
+    Long-lived container clients sharing one BlobServiceClient (and so one connection
+    pool) per connection string. Each container is checked to exist the first time it
+    is used, normally at startup, rather than on every upload and delete
+    """
+
+    def __init__(self):
+        self._service_clients: Dict[str, BlobServiceClient] = {}
+        self._container_clients: Dict[Tuple[str, str], ContainerClient] = {}
+        # blob functions run in the thread pool, so may build clients concurrently
+        self._lock = Lock()
+
+    def get(self, connection: str, container: str) -> ContainerClient:
+        client = self._container_clients.get((connection, container))
+        if client is not None:
+            return client
+
+        with self._lock:
+            if (connection, container) not in self._container_clients:
+                if connection not in self._service_clients:
+                    self._service_clients[
+                        connection
+                    ] = BlobServiceClient.from_connection_string(connection)
+                client = self._service_clients[connection].get_container_client(
+                    container=container,
+                )
+                # raises if the container does not exist
+                client.get_container_properties()
+                self._container_clients[(connection, container)] = client
+            return self._container_clients[(connection, container)]
+
+    def validate(self, connection: str, containers: List[str]) -> None:
+        """
+        Checks that every container exists, keeping their clients for later use
+        """
+        log.info("Calling ContainerClientPool.validate")
+        for container in containers:
+            self.get(connection, container)
+
+    def close(self) -> None:
+        log.info("Calling ContainerClientPool.close")
+        with self._lock:
+            for service_client in self._service_clients.values():
+                service_client.close()
+            self._service_clients.clear()
+            self._container_clients.clear()
+
+
+container_client_pool = ContainerClientPool()
+
+
 def upload_blob(
     connection: str,
     container: str,
     filename: str,
-    file: BytesIO,
+    file: BinaryIO,
     guid: str,
     overwrite: bool = False,
+    block_size: Optional[int] = None,
+    max_concurrency: Optional[int] = None,
 ) -> Optional[str]:
+    """
+    Streams a file to blob storage as staged blocks, uploading up to max_concurrency
+    blocks in parallel. At most max_concurrency blocks are held in memory at once, so
+    memory use does not grow with the size of the file. The blob only appears once
+    every block is committed
+    :param file: readable file object, e.g. the spooled file of an UploadFile
+    :param block_size: bytes per block. Defaults to BLOB_BLOCK_SIZE
+    :param max_concurrency: blocks uploaded in parallel. Defaults to BLOB_MAX_CONCURRENCY
+    :return: URL of the blob, or None on failure
+    """
     log.info("Calling upload_blob")
 
-    try:
+    block_size = block_size or environment["BLOB_BLOCK_SIZE"]
+    max_concurrency = max_concurrency or environment["BLOB_MAX_CONCURRENCY"]
 
-        blob_service_client = BlobServiceClient.from_connection_string(connection)
+    try:
 
-        client = blob_service_client.get_container_client(
-            container=container,
+        client = container_client_pool.get(connection, container).get_blob_client(
+            get_blob_name(guid, filename)
         )
 
-        # get properties of the container to force exception to be thrown if container does not exist
-        client.get_container_properties()
+        blocks, in_flight = [], deque()
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            chunk = file.read(block_size)
+            while chunk:
+                # block ids must all be the same length within a blob
+                block_id = b64encode(f"{len(blocks):08d}".encode()).decode()
+                blocks.append(BlobBlock(block_id=block_id))
+                in_flight.append(executor.submit(client.stage_block, block_id, chunk))
+                if len(in_flight) >= max_concurrency:
+                    in_flight.popleft().result()
+                chunk = file.read(block_size)
+            for staged in in_flight:
+                staged.result()
 
-        response = client.upload_blob(
-            f"{guid}.{filename.split('.')[-1]}",
-            file,
-            overwrite=overwrite,
+        # without overwrite, committing fails if the blob already exists
+        client.commit_block_list(
+            blocks,
+            **({} if overwrite else {"if_none_match": "*"}),
         )
 
-        return response.url
+        return client.url
     except Exception as e:
         log.critical(f"Failed to insert blob into storage. Error: {e}")
         return None
 
 
+def create_upload_url(
+    connection: str,
+    container: str,
+    filename: str,
+    guid: str,
+    expiry_in_seconds: int = UPLOAD_URL_EXPIRY_IN_SECONDS,
+) -> Optional[Dict[str, str]]:
+    """
+    Creates a URL with a shared access signature allowing a client to upload one new
+    blob straight to storage. The signature only permits creating that blob, so it
+    cannot be used to read, overwrite or delete anything, and expires shortly
+    :return: dictionary holding upload_url, blob_url and expires_on (ISO 8601, UTC),
+        or None on failure
+    """
+    log.info("Calling create_upload_url")
+
+    try:
+
+        blob_name = get_upload_blob_name(guid, filename)
+        if blob_name is None:
+            log.critical(f"Failed to create upload URL. Invalid id or filename.")
+            return None
+
+        client = container_client_pool.get(connection, container)
+        blob_client = client.get_blob_client(blob_name)
+        expires_on = datetime.utcnow() + timedelta(seconds=expiry_in_seconds)
+
+        signature = generate_blob_sas(
+            account_name=client.account_name,
+            container_name=container,
+            blob_name=blob_client.blob_name,
+            account_key=client.credential.account_key,
+            permission=BlobSasPermissions(create=True),
+            expiry=expires_on,
+        )
+
+        return {
+            "upload_url": f"{blob_client.url}?{signature}",
+            "blob_url": blob_client.url,
+            "expires_on": expires_on.isoformat(),
+        }
+    except Exception as e:
+        log.critical(f"Failed to create upload URL. Error: {e}")
+        return None
+
+
+def get_uploaded_blob_url(
+    connection: str,
+    container: str,
+    filename: str,
+    guid: str,
+) -> Optional[str]:
+    """
+    Checks that a blob uploaded through an upload URL exists. Only blobs uploaded
+    through upload URLs are found, never those stored by the API
+    :return: URL of the blob, or None if it has not been uploaded
+    """
+    log.info("Calling get_uploaded_blob_url")
+
+    blob_name = get_upload_blob_name(guid, filename)
+    if blob_name is None:
+        return None
+
+    client = container_client_pool.get(connection, container).get_blob_client(blob_name)
+    try:
+        client.get_blob_properties()
+    except ResourceNotFoundError:
+        return None
+
+    return client.url
+
+
 def delete_blob(
     connection: str,
     container: str,
@@ -55,11 +246,7 @@ def delete_blob(
 
     try:
 
-        blob_service_client = BlobServiceClient.from_connection_string(connection)
-        client = blob_service_client.get_container_client(
-            container=container,
-        )
-        client.get_container_properties()  # get properties of the container to force exception to be thrown if container does not exist
+        client = container_client_pool.get(connection, container)
         client.get_blob_client(
             url.replace(client.primary_endpoint + "/", "")
         ).delete_blob()
@@ -0,0 +1,195 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-30
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+import re
+from typing import Dict, Optional
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError
+from azure.cosmos.exceptions import (
+    CosmosHttpResponseError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+from fastapi import UploadFile
+
+from bfsa.blob.async_blob_service_client import (
+    async_container_client_pool,
+    upload_blob,
+    delete_blob,
+)
+from bfsa.blob.blob_service_client import environment, get_blob_name
+from bfsa.db.unit_of_work import UnitOfWork
+from bfsa.utils.hash_string import StreamingHash
+from bfsa.utils.logger import logger as log
+
+
+REFERENCES_PARTITION_KEY = "blob-references"
+# names given by store_blob: the SHA-256 of the content and the file extension
+CONTENT_ADDRESSED_BLOB_NAME = re.compile(r"[0-9a-f]{64}\.[^/]+")
+
+
+async def hash_file(file: UploadFile, block_size: Optional[int] = None) -> str:
+    """
+    Computes the SHA-256 of an upload a block at a time, then rewinds it
+    """
+    block_size = block_size or environment["BLOB_BLOCK_SIZE"]
+
+    digest = StreamingHash()
+    chunk = await file.read(block_size)
+    while chunk:
+        digest.update(chunk)
+        chunk = await file.read(block_size)
+    await file.seek(0)
+    return digest.hexdigest()
+
+
+def _reference(container: str, blob_name: str) -> Dict[str, str]:
+    return {"id": f"{container}:{blob_name}", "partitionKey": REFERENCES_PARTITION_KEY}
+
+
+async def store_blob(
+    client: UnitOfWork,
+    connection: str,
+    container: str,
+    filename: str,
+    file: UploadFile,
+) -> Optional[str]:
+    """
+    Stores an upload under a name derived from its content, and counts a reference to
+    it. Content already stored in the container is not uploaded again, so a duplicate
+    costs only hashing it and counting the reference. Every call must be matched by a
+    call to release_blob once the URL is no longer used
+    :return: URL of the blob, or None on failure
+    """
+    log.info("Calling store_blob")
+
+    try:
+        digest = await hash_file(file)
+        container_client = await async_container_client_pool.get(connection, container)
+        blob_name = get_blob_name(digest, filename)
+        reference = _reference(container, blob_name)
+
+        try:
+            await client.patch_data(
+                item=reference,
+                operations=[{"op": "incr", "path": "/references", "value": 1}],
+            )
+            return container_client.get_blob_client(blob_name).url
+        except CosmosResourceNotFoundError:
+            pass
+
+        blob_url = await upload_blob(
+            connection=connection,
+            container=container,
+            guid=digest,
+            filename=filename,
+            file=file,
+            overwrite=True,
+        )
+        if blob_url is None:
+            return None
+
+        try:
+            await client.insert_data(
+                [
+                    {
+                        **reference,
+                        "container": container,
+                        "blob_url": blob_url,
+                        "references": 1,
+                    }
+                ]
+            )
+        except CosmosResourceExistsError:
+            # the same content was stored concurrently
+            await client.patch_data(
+                item=reference,
+                operations=[{"op": "incr", "path": "/references", "value": 1}],
+            )
+
+        return blob_url
+    except Exception as e:
+        log.critical(f"Failed to store blob. Error: {e}")
+        return None
+
+
+async def release_blob(
+    client: UnitOfWork,
+    connection: str,
+    container: str,
+    url: str,
+) -> bool:
+    """
+    Releases a reference taken by store_blob, deleting the blob once nothing refers to
+    it. Blobs not stored by store_blob (those stored before content addressing, and
+    uploads through upload URLs) are only ever referred to once, so are deleted
+    :return: boolean indicating success or failure
+    """
+    log.info("Calling release_blob")
+
+    try:
+        container_client = await async_container_client_pool.get(connection, container)
+        blob_name = url.replace(container_client.primary_endpoint + "/", "")
+        reference = _reference(container, blob_name)
+
+        if CONTENT_ADDRESSED_BLOB_NAME.fullmatch(blob_name) is None:
+            return await delete_blob(
+                connection=connection,
+                container=container,
+                url=url,
+            )
+
+        try:
+            await client.patch_data(
+                item=reference,
+                operations=[{"op": "incr", "path": "/references", "value": -1}],
+            )
+        except CosmosResourceNotFoundError:
+            # kept, as others may still refer to it
+            log.warning(f"No references found for {reference['id']}. Blob kept.")
+            return True
+
+        document = await client.get_by_id(
+            item_id=reference["id"],
+            partition_key=REFERENCES_PARTITION_KEY,
+        )
+        if document is None or document["references"] > 0:
+            return True
+
+        # read before the reference is deleted: storing the content again after that
+        # re-uploads the blob, changing its etag, so the blob is then kept
+        blob_client = container_client.get_blob_client(blob_name)
+        properties = await blob_client.get_blob_properties()
+
+        try:
+            await client.delete_data(
+                item=reference["id"],
+                partition_key=REFERENCES_PARTITION_KEY,
+                etag=document["_etag"],
+            )
+        except CosmosHttpResponseError as e:
+            # referenced again since it was read
+            if e.status_code == 412:
+                return True
+            raise
+
+        try:
+            await blob_client.delete_blob(
+                etag=properties.etag,
+                match_condition=MatchConditions.IfNotModified,
+            )
+        except ResourceModifiedError:
+            pass
+        return True
+    except Exception as e:
+        log.critical(f"Failed to release blob. Error: {e}")
+        return False
+
+
+if __name__ == "__main__":
+    pass
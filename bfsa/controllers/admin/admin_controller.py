@@ -7,9 +7,15 @@ Created on 2022-07-16
 """
 
 from typing import Dict, Any
-from fastapi import APIRouter
+from asyncio import Semaphore, gather
+from fastapi import APIRouter, Depends
 
 from bfsa.controllers.media import media_controller
+from bfsa.db.client import Client
+from bfsa.db.unit_of_work import UnitOfWork
+from bfsa.db.environment import get_client
+from bfsa.db.metrics import metrics
+from bfsa.db.throttling import background_priority
 from bfsa.utils.return_json import return_json
 from bfsa.utils.logger import logger as log
 
@@ -18,34 +24,94 @@ router = APIRouter()
 
 
 @router.patch("/api/updateManyMedia")
-def update_many_media(
+async def update_many_media(
     where: Dict[str, Any],
     patch: Dict[str, Any],
+    client: UnitOfWork = Depends(get_client),
 ):
     """
-    Update many media
+    Update many media concurrently. Each update is applied server-side as a patch, so
+    concurrent updates of the same document never overwrite one another
     """
     log.info("Calling update_many_media")
     media = None
     try:
-        media = media_controller.read_media(where=where)
+        media = await media_controller.read_media(where=where, client=client)
     except Exception as e:
         log.critical(f"Error calling read_media. Error: {e}")
 
-    for i, medium in enumerate(media["media"]):
-        guid = medium["id"]
-        medium.update(patch)
-        try:
-            media_controller.update_media(
-                guid,
-                medium,
-            )
-        except Exception as e:
-            log.error(
-                f"Error calling update_media on media with id: {guid} and index: {i}. Error: {e}"
-            )
+    if not media or not media["success"]:
+        return return_json(
+            message="Failed to update multiple media documents.",
+            success=False,
+        )
+
+    # content is left out of the response when nothing matched
+    media = media.get("content", [])
+    if not media:
+        return return_json(
+            message="No media documents to update.",
+            success=True,
+        )
+
+    semaphore = Semaphore(Client.DEFAULT_MAX_CONCURRENCY)
+
+    async def update(i: int, guid: str) -> bool:
+        async with semaphore:
+            try:
+                response = await media_controller.update_media(
+                    guid,
+                    patch,
+                    client=client,
+                )
+                return response["success"]
+            except Exception as e:
+                log.error(
+                    f"Error calling update_media on media with id: {guid} and index: {i}. Error: {e}"
+                )
+                return False
+
+    with background_priority():
+        results = await gather(
+            *[update(i, medium["id"]) for i, medium in enumerate(media)]
+        )
+
+    if not all(results):
+        log.critical(
+            f"Failed to update {results.count(False)} of {len(results)} media."
+        )
+        return return_json(
+            message=f"Failed to update {results.count(False)} of {len(results)} media.",
+            success=False,
+        )
 
     return return_json(
         message="Successfully updated multiple media documents.",
         success=True,
     )
+
+
+@router.get("/api/readDatabaseMetrics")
+async def read_database_metrics():
+    """
+    Read request charge, latency, item and page totals per route and database operation
+    """
+    log.info("Calling read_database_metrics")
+    return return_json(
+        message="Successfully read database metrics.",
+        success=True,
+        content=metrics.snapshot(),
+    )
+
+
+@router.delete("/api/resetDatabaseMetrics")
+async def reset_database_metrics():
+    """
+    Reset database metrics
+    """
+    log.info("Calling reset_database_metrics")
+    metrics.reset()
+    return return_json(
+        message="Successfully reset database metrics.",
+        success=True,
+    )
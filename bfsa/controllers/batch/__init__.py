@@ -0,0 +1,10 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-27
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+if __name__ == "__main__":
+    pass
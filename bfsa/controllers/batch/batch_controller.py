@@ -0,0 +1,111 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-27
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from typing import List, Optional
+from fastapi import APIRouter, Depends
+from pydantic import BaseModel
+
+from bfsa.db.unit_of_work import UnitOfWork
+from bfsa.db.environment import get_client
+from bfsa.sql.create_select import parse_fields
+from bfsa.utils.return_json import return_json
+from bfsa.utils.logger import logger as log
+
+
+router = APIRouter()
+
+
+MAX_BATCH_READ_ITEMS = 1000
+
+READABLE_PARTITION_KEYS = {
+    "blog",
+    "equipment",
+    "equipment-usage",
+    "family-tree-data-source",
+    "family-tree-person",
+    "family-tree-relationship",
+    "ingredient-usage",
+    "ingredients",
+    "media",
+    "papers",
+    "photo",
+    "recipe-steps",
+    "recipes",
+}
+
+
+class ItemReferenceModel(BaseModel):
+    """
+    Pydantic model for a reference to a document
+    """
+
+    id: str
+    partitionKey: str
+
+
+@router.get("/api/batchRead")
+async def batch_read(
+    items: List[ItemReferenceModel],
+    fields: Optional[str] = None,
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Read many documents of any type by id, e.g. the relationships, photos and sources of
+    a family tree person. Documents are returned in the order requested, with null in
+    place of those that do not exist
+    """
+    log.info("Calling batch_read")
+
+    if len(items) > MAX_BATCH_READ_ITEMS:
+        log.critical(f"Failed to batch read {len(items)} documents. Too many items.")
+        return return_json(
+            message=f"Failed to batch read documents. At most {MAX_BATCH_READ_ITEMS} may be read at once.",
+            success=False,
+        )
+
+    unreadable = {
+        item.partitionKey
+        for item in items
+        if item.partitionKey not in READABLE_PARTITION_KEYS
+    }
+    if unreadable:
+        log.critical(
+            f"Failed to batch read documents. Unknown partitions: {unreadable}"
+        )
+        return return_json(
+            message="Failed to batch read documents. Unknown partition keys requested.",
+            success=False,
+        )
+
+    try:
+        data = await client.read_many(
+            items=[dict(item) for item in items],
+            fields=parse_fields(fields),
+        )
+        if data:
+            return return_json(
+                message="Successfully batch read documents.",
+                success=True,
+                content=data,
+            )
+    except Exception as e:
+        log.critical(f"Failed to batch read documents. Error: {e}")
+        return return_json(
+            message="Failed to batch read documents.",
+            success=False,
+        )
+
+    log.critical(f"Failed to batch read documents. Check logs for details.")
+    return return_json(
+        message="Failed to batch read documents.",
+        success=False,
+    )
+
+
+if __name__ == "__main__":
+    pass
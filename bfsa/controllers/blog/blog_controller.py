@@ -6,13 +6,22 @@ Created on 2022-07-16
 @email: bennettedmund@gmail.com
 """
 
-from typing import Dict, Any, Optional
-from fastapi import APIRouter
+from typing import Dict, Any, Optional, List, Union
+from fastapi import APIRouter, Depends, Header
 from pydantic import BaseModel
 
-from bfsa.db.environment import client_factory
-from bfsa.sql.create_select import create_select
+from bfsa.db.unit_of_work import UnitOfWork
+from bfsa.db.environment import get_client
+from bfsa.db.patch_operations import PatchOperationModel, create_patch_operations
+from bfsa.db.write_behind import write_behind_queue
+from bfsa.sql.create_select import (
+    create_select,
+    create_aggregate,
+    is_point_read,
+    parse_fields,
+)
 from bfsa.utils.return_json import return_json
+from bfsa.utils.return_ndjson import return_ndjson, accepts_ndjson
 from bfsa.utils.create_guid import create_guid
 from bfsa.utils.logger import logger as log
 
@@ -46,22 +55,21 @@ class BlogModel(BaseModel):
 
 
 @router.post("/api/createBlog")
-def create_blog(
+async def create_blog(
     blog: BlogModel,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Add blog object to database
     """
     log.info("Calling create_blog")
 
-    client = client_factory()
-
     blog_dict = dict(blog)
     blog_dict.update({"id": create_guid()})
     blog_dict.update({"partitionKey": "blog"})
 
     try:
-        success = client.insert_data(
+        success = await client.insert_data(
             [blog_dict],
         )
         if not success:
@@ -84,31 +92,45 @@ def create_blog(
 
 
 @router.get("/api/readBlog")
-def read_blog(
+async def read_blog(
     where: Dict[str, Any] = None,
+    fields: Optional[str] = None,
+    page_size: Optional[int] = None,
+    continuation_token: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Read blog
     """
     log.info("Calling read_blog")
 
-    client = client_factory()
-
     if where is None:
         where = {}
     where.update({"partitionKey": "blog"})
 
-    query = create_select(where)
-
     try:
-        data = client.select_data(
-            query=query,
-        )
-        if data:
-            return return_json(
-                message="Successfully selected blog data.",
-                success=True,
-                content=data,
+        if is_point_read(where):
+            item = await client.get_by_id(
+                item_id=where["id"],
+                partition_key=where["partitionKey"],
+                fields=parse_fields(fields),
+            )
+            data, continuation_token = [item] if item else [], None
+            if item:
+                # the view count does not need confirming, so is written behind
+                write_behind_queue.increment(
+                    {"id": where["id"], "partitionKey": where["partitionKey"]},
+                    "/views",
+                )
+        else:
+            query = create_select(where, fields=parse_fields(fields))
+            if accepts_ndjson(accept):
+                return return_ndjson(client.stream_data(query=query))
+            data, continuation_token = await client.select_page(
+                query=query,
+                page_size=page_size,
+                continuation_token=continuation_token,
             )
     except Exception as e:
         log.critical(f"Failed to select blog data. Error: {e}")
@@ -117,33 +139,71 @@ def read_blog(
             success=False,
         )
 
-    log.critical(f"Failed to select blog data. Check logs for details.")
     return return_json(
-        message="Failed to select blog data.",
-        success=False,
+        message="Successfully selected blog data.",
+        success=True,
+        content=data,
+        continuation_token=continuation_token,
+    )
+
+
+@router.get("/api/aggregateBlog")
+async def aggregate_blog(
+    where: Dict[str, Any] = None,
+    function: str = "count",
+    field: Optional[str] = None,
+    group_by: Optional[str] = None,
+    group_by_prefix: Optional[int] = None,
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Aggregate blog, e.g. count blog documents grouped by a field
+    """
+    log.info("Calling aggregate_blog")
+
+    if where is None:
+        where = {}
+    where.update({"partitionKey": "blog"})
+
+    try:
+        data = await client.aggregate(
+            query=create_aggregate(
+                where,
+                function=function,
+                field=field,
+                group_by=group_by,
+                group_by_prefix=group_by_prefix,
+            ),
+        )
+    except Exception as e:
+        log.critical(f"Failed to aggregate blog data. Error: {e}")
+        return return_json(
+            message="Failed to aggregate blog data.",
+            success=False,
+        )
+
+    return return_json(
+        message="Successfully aggregated blog data.",
+        success=True,
+        content={"aggregate": data},
     )
 
 
 @router.patch("/api/updateBlog")
-def update_blog(
+async def update_blog(
     blog_id: str,
-    patch: Dict[str, Any],
+    patch: Union[List[PatchOperationModel], Dict[str, Any]],
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Update blog
     """
     log.info("Calling update_blog")
 
-    client = client_factory()
-
-    patch.update({"id": blog_id})
-    patch.update({"partitionKey": "blog"})
-
     try:
-        success = client.update_data(
+        success = await client.patch_data(
             item={"id": blog_id, "partitionKey": "blog"},
-            body=patch,
-            upsert=False,
+            operations=create_patch_operations(patch),
         )
         if not success:
             log.critical(f"Failed to update blog. Check logs for details.")
@@ -165,18 +225,17 @@ def update_blog(
 
 
 @router.delete("/api/deleteBlog")
-def delete_blog(
+async def delete_blog(
     blog_id: str,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Delete blog
     """
     log.info("Calling delete_blog")
 
-    client = client_factory()
-
     try:
-        success = client.delete_data(
+        success = await client.delete_data(
             item=blog_id,
             partition_key="blog",
         )
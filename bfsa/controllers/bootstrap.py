@@ -6,11 +6,13 @@ Created on 2022-06-26
 @email: bennettedmund@gmail.com
 """
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 
 from bfsa.controllers.admin import admin_controller
 from bfsa.controllers.authentication import authentication_controller
+from bfsa.controllers.batch import batch_controller
 from bfsa.controllers.family_tree import (
     family_tree_person_controller,
     family_tree_relationship_controller,
@@ -32,6 +34,15 @@ from bfsa.controllers.recipes import (
 from bfsa.controllers.movie_database import movie_database_controller
 
 from bfsa.controllers.blog import blog_controller
+from bfsa.blob.async_blob_service_client import async_container_client_pool
+from bfsa.blob.blob_service_client import BLOB_CONTAINERS, container_client_pool
+from bfsa.db.client import get_blob_credentials
+from bfsa.db.environment import client_manager
+from bfsa.db.change_feed import change_feed_processor, change_feed_publisher
+from bfsa.db.query_cache import query_cache
+from bfsa.db.write_behind import write_behind_queue
+from bfsa.db.metrics import current_route, request_metrics, OperationMetrics
+from bfsa.utils.logger import logger as log
 
 
 port = 4646
@@ -39,8 +50,68 @@ host = "localhost"
 
 server = FastAPI()
 
+
+@server.on_event("startup")
+async def startup():
+    await client_manager.startup()
+    # picks up writes made by other instances, which the cache cannot see otherwise
+    change_feed_publisher.subscribe(
+        lambda partition_key, _: query_cache.invalidate(partition_key)
+    )
+    change_feed_processor.start()
+    write_behind_queue.start()
+
+    try:
+        blob_credentials = await run_in_threadpool(get_blob_credentials)
+        await run_in_threadpool(
+            container_client_pool.validate,
+            blob_credentials["credentials"],
+            BLOB_CONTAINERS,
+        )
+        await async_container_client_pool.validate(
+            blob_credentials["credentials"],
+            BLOB_CONTAINERS,
+        )
+    except Exception as e:
+        # blob storage is only needed by uploads, so the API can still serve reads
+        log.critical(f"Failed to connect to blob storage. Error: {e}")
+
+
+@server.on_event("shutdown")
+async def shutdown():
+    await change_feed_processor.stop()
+    # drained before the client is closed, so that no queued write is lost
+    await write_behind_queue.stop()
+    await client_manager.shutdown()
+    container_client_pool.close()
+    await async_container_client_pool.close()
+
+
+@server.middleware("http")
+async def record_database_metrics(request: Request, call_next):
+    """
+    Tags database operations with the calling route and reports their totals as
+    response headers. Streamed responses send headers before the database is read,
+    so their charges only appear in the aggregated metrics
+    """
+    route_token = current_route.set(f"{request.method} {request.url.path}")
+    per_request = OperationMetrics()
+    metrics_token = request_metrics.set(per_request)
+    try:
+        response = await call_next(request)
+    finally:
+        current_route.reset(route_token)
+        request_metrics.reset(metrics_token)
+
+    response.headers["x-db-request-charge"] = f"{per_request.request_charge:.2f}"
+    response.headers["x-db-latency-ms"] = f"{per_request.client_latency_ms:.2f}"
+    response.headers["x-db-operations"] = str(per_request.count)
+    return response
+
+
 server.include_router(admin_controller.router, tags=["Administration"])
 server.include_router(authentication_controller.router, tags=["Authentication"])
+server.include_router(batch_controller.router, tags=["Batch"])
 
 server.include_router(family_tree_person_controller.router, tags=["Family Tree People"])
 server.include_router(
@@ -83,4 +154,5 @@ server.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["x-db-request-charge", "x-db-latency-ms", "x-db-operations"],
 )
@@ -6,16 +6,25 @@ Created on 2022-07-16
 @email: bennettedmund@gmail.com
 """
 
-from typing import Dict, Any, Optional
-from io import BytesIO
-from fastapi import APIRouter, UploadFile, File
+from typing import Dict, Any, Optional, List, Union
+from fastapi import APIRouter, UploadFile, File, Depends, Header
+from fastapi.concurrency import run_in_threadpool
 
-from bfsa.db.environment import client_factory
 from bfsa.db.client import get_blob_credentials
+from bfsa.db.unit_of_work import UnitOfWork
+from bfsa.db.environment import get_client
+from bfsa.db.patch_operations import PatchOperationModel, create_patch_operations
 from bfsa.controllers.environment import Environment as Base
-from bfsa.blob.blob_service_client import upload_blob, delete_blob
-from bfsa.sql.create_select import create_select
+from bfsa.blob.content_addressed_storage import store_blob, release_blob
+from bfsa.blob.blob_service_client import create_upload_url, get_uploaded_blob_url
+from bfsa.sql.create_select import (
+    create_select,
+    create_aggregate,
+    is_point_read,
+    parse_fields,
+)
 from bfsa.utils.return_json import return_json
+from bfsa.utils.return_ndjson import return_ndjson, accepts_ndjson
 from bfsa.utils.create_guid import create_guid
 from bfsa.utils.logger import logger as log
 
@@ -24,6 +33,8 @@ router = APIRouter()
 
 environment = Base()
 
+ALLOWED_MEDIA_EXTENSIONS = ["png", "bmp", "jpg", "jpeg", "mp4"]
+
 #    @       @
 #     @     @
 #   @@@@@@@@@@@
@@ -45,14 +56,13 @@ async def create_content(
     camera_details: Optional[str] = None,
     taken_by: Optional[str] = None,
     taken_date: Optional[str] = None,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Add content object to database
     """
     log.info("Calling create_content")
 
-    allowed_media_extensions = ["png", "bmp", "jpg", "jpeg", "mp4"]
-
     # check inputs
 
     if file.filename == "":
@@ -64,31 +74,26 @@ async def create_content(
     if (
         file
         and "." in file.filename
-        and file.filename.rsplit(".", 1)[1].lower() not in allowed_media_extensions
+        and file.filename.rsplit(".", 1)[1].lower() not in ALLOWED_MEDIA_EXTENSIONS
     ):
         return return_json(
             "Invalid image file.",
             success=False,
         )
 
-    # pre-amble
-
-    client = client_factory()
-
     # insert data - blob first then metadata
 
     guid = create_guid()
 
-    blob_credentials = get_blob_credentials()
+    blob_credentials = await run_in_threadpool(get_blob_credentials)
 
     try:
-        blob_url = upload_blob(
+        blob_url = await store_blob(
+            client=client,
             connection=blob_credentials["credentials"],
             container="media",
-            guid=guid,
             filename=file.filename,
-            file=BytesIO(await file.read()),
-            overwrite=False,
+            file=file,
         )
 
     except Exception as e:
@@ -98,6 +103,13 @@ async def create_content(
             success=False,
         )
 
+    if blob_url is None:
+        log.critical(f"Failed to insert content. Check logs for details.")
+        return return_json(
+            message="Failed to insert content.",
+            success=False,
+        )
+
     content_dict = {
         "name": name,
         "description": description,
@@ -113,7 +125,7 @@ async def create_content(
     }
 
     try:
-        cosmos_success = client.insert_data(
+        cosmos_success = await client.insert_data(
             [content_dict],
         )
         if not cosmos_success:
@@ -130,11 +142,14 @@ async def create_content(
         )
 
     # Are you still here? Then blob insertion succeeded but Cosmos insertion failed
-    # roll back by deleting blob
+    # roll back by releasing blob
 
     try:
-        response = delete_content(
-            content_id=guid,
+        response = await release_blob(
+            client=client,
+            connection=blob_credentials["credentials"],
+            container="media",
+            url=blob_url,
         )
         # TODO: indicate whether roll back was successful
         return return_json(
@@ -151,32 +166,163 @@ async def create_content(
         )
 
 
+@router.post("/api/createContentUploadUrl")
+async def create_content_upload_url(
+    filename: str,
+):
+    """
+    Create a short-lived URL to upload a content file straight to blob storage. Once
+    uploaded, the content is added by calling commitContent with the returned id
+    """
+    log.info("Calling create_content_upload_url")
+
+    if "." not in filename or (
+        filename.rsplit(".", 1)[1].lower() not in ALLOWED_MEDIA_EXTENSIONS
+    ):
+        return return_json(
+            "Invalid image file.",
+            success=False,
+        )
+
+    guid = create_guid()
+
+    blob_credentials = await run_in_threadpool(get_blob_credentials)
+
+    upload_url = await run_in_threadpool(
+        create_upload_url,
+        connection=blob_credentials["credentials"],
+        container="media",
+        filename=filename,
+        guid=guid,
+    )
+    if upload_url is None:
+        log.critical(f"Failed to create content upload URL. Check logs for details.")
+        return return_json(
+            message="Failed to create content upload URL.",
+            success=False,
+        )
+
+    return return_json(
+        message="Successfully created content upload URL.",
+        success=True,
+        content={"id": guid, **upload_url},
+    )
+
+
+@router.post("/api/commitContent")
+async def commit_content(
+    content_id: str,
+    filename: str,
+    name: str,
+    file_format: str,
+    height: Optional[float] = None,
+    width: Optional[float] = None,
+    description: Optional[str] = None,
+    camera_details: Optional[str] = None,
+    taken_by: Optional[str] = None,
+    taken_date: Optional[str] = None,
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Add content object to database for a file uploaded through createContentUploadUrl
+    """
+    log.info("Calling commit_content")
+
+    blob_credentials = await run_in_threadpool(get_blob_credentials)
+
+    try:
+        blob_url = await run_in_threadpool(
+            get_uploaded_blob_url,
+            connection=blob_credentials["credentials"],
+            container="media",
+            filename=filename,
+            guid=content_id,
+        )
+    except Exception as e:
+        log.critical(f"Failed to read uploaded content. Error: {e}")
+        return return_json(
+            message="Failed to commit content.",
+            success=False,
+        )
+
+    if blob_url is None:
+        return return_json(
+            message="No uploaded file found for content.",
+            success=False,
+        )
+
+    content_dict = {
+        "name": name,
+        "description": description,
+        "file_format": file_format,
+        "height": height,
+        "width": width,
+        "camera_details": camera_details,
+        "taken_by": taken_by,
+        "taken_date": taken_date,
+        "blob_url": blob_url,
+        "id": content_id,
+        "partitionKey": "photo",
+    }
+
+    # the uploaded blob is kept on failure, so that the commit can be retried
+    try:
+        success = await client.insert_data(
+            [content_dict],
+        )
+        if not success:
+            log.critical(f"Failed to commit content. Check logs for details.")
+            return return_json(
+                message="Failed to commit content.",
+                success=False,
+            )
+    except Exception as e:
+        log.critical(f"Failed to commit content. Error: {e}")
+        return return_json(
+            message="Failed to commit content.",
+            success=False,
+        )
+
+    return return_json(
+        message="Successfully inserted content.",
+        success=True,
+    )
+
+
 @router.get("/api/readContent")
-def read_content(
+async def read_content(
     where: Dict[str, Any] = None,
+    fields: Optional[str] = None,
+    page_size: Optional[int] = None,
+    continuation_token: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Read content
     """
     log.info("Calling read_content")
 
-    client = client_factory()
-
     if where is None:
         where = {}
     where.update({"partitionKey": "photo"})
 
-    query = create_select(where)
-
     try:
-        data = client.select_data(
-            query=query,
-        )
-        if data:
-            return return_json(
-                message="Successfully selected content data.",
-                success=True,
-                content=data,
+        if is_point_read(where):
+            item = await client.get_by_id(
+                item_id=where["id"],
+                partition_key=where["partitionKey"],
+                fields=parse_fields(fields),
+            )
+            data, continuation_token = [item] if item else [], None
+        else:
+            query = create_select(where, fields=parse_fields(fields))
+            if accepts_ndjson(accept):
+                return return_ndjson(client.stream_data(query=query))
+            data, continuation_token = await client.select_page(
+                query=query,
+                page_size=page_size,
+                continuation_token=continuation_token,
             )
     except Exception as e:
         log.critical(f"Failed to select content data. Error: {e}")
@@ -185,33 +331,71 @@ def read_content(
             success=False,
         )
 
-    log.critical(f"Failed to select content data. Check logs for details.")
     return return_json(
-        message="Failed to select content data.",
-        success=False,
+        message="Successfully selected content data.",
+        success=True,
+        content=data,
+        continuation_token=continuation_token,
+    )
+
+
+@router.get("/api/aggregateContent")
+async def aggregate_content(
+    where: Dict[str, Any] = None,
+    function: str = "count",
+    field: Optional[str] = None,
+    group_by: Optional[str] = None,
+    group_by_prefix: Optional[int] = None,
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Aggregate content, e.g. count content documents grouped by a field
+    """
+    log.info("Calling aggregate_content")
+
+    if where is None:
+        where = {}
+    where.update({"partitionKey": "photo"})
+
+    try:
+        data = await client.aggregate(
+            query=create_aggregate(
+                where,
+                function=function,
+                field=field,
+                group_by=group_by,
+                group_by_prefix=group_by_prefix,
+            ),
+        )
+    except Exception as e:
+        log.critical(f"Failed to aggregate content data. Error: {e}")
+        return return_json(
+            message="Failed to aggregate content data.",
+            success=False,
+        )
+
+    return return_json(
+        message="Successfully aggregated content data.",
+        success=True,
+        content={"aggregate": data},
     )
 
 
 @router.patch("/api/updateContentMetadata")
-def update_content_metadata(
+async def update_content_metadata(
     content_id: str,
-    patch: Dict[str, Any],
+    patch: Union[List[PatchOperationModel], Dict[str, Any]],
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Update content metadata
     """
     log.info("Calling update_content_metadata")
 
-    client = client_factory()
-
-    patch.update({"id": content_id})
-    patch.update({"partitionKey": "photo"})
-
     try:
-        success = client.update_data(
+        success = await client.patch_data(
             item={"id": content_id, "partitionKey": "photo"},
-            body=patch,
-            upsert=False,
+            operations=create_patch_operations(patch),
         )
         if not success:
             log.critical(f"Failed to update content metadata. Check logs for details.")
@@ -233,20 +417,22 @@ def update_content_metadata(
 
 
 @router.delete("/api/deleteContent")
-def delete_content(
+async def delete_content(
     content_id: str,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Delete content
     """
     log.info("Calling delete_content")
 
-    client = client_factory()
-
-    blob_credentials = get_blob_credentials()
+    blob_credentials = await run_in_threadpool(get_blob_credentials)
 
     try:
-        content_details = read_content(where={"id": content_id})
+        content_details = await client.get_by_id(
+            item_id=content_id,
+            partition_key="photo",
+        )
     except Exception as e:
         log.critical(f"Failed to read content. Error: {e}")
         return return_json(
@@ -255,7 +441,7 @@ def delete_content(
         )
 
     try:
-        success = client.delete_data(
+        success = await client.delete_data(
             item=content_id,
             partition_key="photo",
         )
@@ -266,10 +452,11 @@ def delete_content(
                 success=False,
             )
 
-        blob_delete_success = delete_blob(
+        blob_delete_success = await release_blob(
+            client=client,
             connection=blob_credentials["credentials"],
             container="media",
-            url=content_details["content"][0]["blob_url"],
+            url=content_details["blob_url"],
         )
 
         if blob_delete_success:
@@ -12,6 +12,10 @@ from os import getenv
 
 class Environment:
     IS_PROD = "IS_PROD"
+    DB_BACKEND = "DB_BACKEND"
+    DB_FILE = "DB_FILE"
+    BLOB_BLOCK_SIZE = "BLOB_BLOCK_SIZE"
+    BLOB_MAX_CONCURRENCY = "BLOB_MAX_CONCURRENCY"
 
     _environment = {}
 
@@ -19,8 +23,22 @@ class Environment:
         self._environment[Environment.IS_PROD] = (
             True if getenv(Environment.IS_PROD) == "1" else False
         )
+        # "cosmos", or "memory"/"file" to run against bfsa.db.fake_client offline
+        self._environment[Environment.DB_BACKEND] = getenv(
+            Environment.DB_BACKEND, "cosmos"
+        )
+        self._environment[Environment.DB_FILE] = getenv(
+            Environment.DB_FILE, "staging/db.json"
+        )
+        # uploads are streamed to blob storage in blocks of this many bytes
+        self._environment[Environment.BLOB_BLOCK_SIZE] = int(
+            getenv(Environment.BLOB_BLOCK_SIZE, 4 * 1024 * 1024)
+        )
+        self._environment[Environment.BLOB_MAX_CONCURRENCY] = int(
+            getenv(Environment.BLOB_MAX_CONCURRENCY, 4)
+        )
 
-    def __getitem__(self, key: str) -> Union[bool, str]:
+    def __getitem__(self, key: str) -> Union[bool, int, str]:
         try:
             return self._environment[key]
         except KeyError as _:
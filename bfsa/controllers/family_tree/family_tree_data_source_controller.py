@@ -6,13 +6,21 @@ Created on 2022-08-08
 @email: bennettedmund@gmail.com
 """
 
-from typing import Dict, Any
-from fastapi import APIRouter
+from typing import Dict, Any, List, Union, Optional
+from fastapi import APIRouter, Depends, Header
 from pydantic import BaseModel
 
-from bfsa.db.environment import client_factory
-from bfsa.sql.create_select import create_select
+from bfsa.db.unit_of_work import UnitOfWork
+from bfsa.db.environment import get_client
+from bfsa.db.patch_operations import PatchOperationModel, create_patch_operations
+from bfsa.sql.create_select import (
+    create_select,
+    create_aggregate,
+    is_point_read,
+    parse_fields,
+)
 from bfsa.utils.return_json import return_json
+from bfsa.utils.return_ndjson import return_ndjson, accepts_ndjson
 from bfsa.utils.create_guid import create_guid
 from bfsa.utils.logger import logger as log
 
@@ -32,22 +40,21 @@ class FamilyTreeDataSourceModel(BaseModel):
 
 
 @router.post("/api/createFamilyTreeDataSource")
-def create_family_tree_data_source(
+async def create_family_tree_data_source(
     data_source: FamilyTreeDataSourceModel,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Add family-tree data source object to database
     """
     log.info("Calling create_family_tree_data_source")
 
-    client = client_factory()
-
     data_source_dict = dict(data_source)
     data_source_dict.update({"id": create_guid()})
     data_source_dict.update({"partitionKey": "family-tree-data-source"})
 
     try:
-        success = client.insert_data(
+        success = await client.insert_data(
             [data_source_dict],
         )
         if not success:
@@ -72,31 +79,39 @@ def create_family_tree_data_source(
 
 
 @router.get("/api/readFamilyTreeDataSources")
-def read_family_tree_data_sources(
+async def read_family_tree_data_sources(
     where: Dict[str, Any] = None,
+    fields: Optional[str] = None,
+    page_size: Optional[int] = None,
+    continuation_token: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Read family-tree people
     """
     log.info("Calling read_family_tree_data_sources")
 
-    client = client_factory()
-
     if where is None:
         where = {}
     where.update({"partitionKey": "family-tree-data-source"})
 
-    query = create_select(where)
-
     try:
-        data = client.select_data(
-            query=query,
-        )
-        if data:
-            return return_json(
-                message="Successfully selected family-tree data source data.",
-                success=True,
-                content=data,
+        if is_point_read(where):
+            item = await client.get_by_id(
+                item_id=where["id"],
+                partition_key=where["partitionKey"],
+                fields=parse_fields(fields),
+            )
+            data, continuation_token = [item] if item else [], None
+        else:
+            query = create_select(where, fields=parse_fields(fields))
+            if accepts_ndjson(accept):
+                return return_ndjson(client.stream_data(query=query))
+            data, continuation_token = await client.select_page(
+                query=query,
+                page_size=page_size,
+                continuation_token=continuation_token,
             )
     except Exception as e:
         log.critical(f"Failed to select family-tree data source data. Error: {e}")
@@ -105,38 +120,74 @@ def read_family_tree_data_sources(
             success=False,
         )
 
-    log.critical(
-        f"Failed to select family-tree data source data. Check logs for details."
+    return return_json(
+        message="Successfully selected family-tree data source data.",
+        success=True,
+        content=data,
+        continuation_token=continuation_token,
     )
+
+
+@router.get("/api/aggregateFamilyTreeDataSources")
+async def aggregate_family_tree_data_sources(
+    where: Dict[str, Any] = None,
+    function: str = "count",
+    field: Optional[str] = None,
+    group_by: Optional[str] = None,
+    group_by_prefix: Optional[int] = None,
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Aggregate family-tree data source, e.g. count family-tree data source documents grouped by a field
+    """
+    log.info("Calling aggregate_family_tree_data_sources")
+
+    if where is None:
+        where = {}
+    where.update({"partitionKey": "family-tree-data-source"})
+
+    try:
+        data = await client.aggregate(
+            query=create_aggregate(
+                where,
+                function=function,
+                field=field,
+                group_by=group_by,
+                group_by_prefix=group_by_prefix,
+            ),
+        )
+    except Exception as e:
+        log.critical(f"Failed to aggregate family-tree data source data. Error: {e}")
+        return return_json(
+            message="Failed to aggregate family-tree data source data.",
+            success=False,
+        )
+
     return return_json(
-        message="Failed to select family-tree data source data.",
-        success=False,
+        message="Successfully aggregated family-tree data source data.",
+        success=True,
+        content={"aggregate": data},
     )
 
 
 @router.patch("/api/updateFamilyTreeDataSource")
-def update_family_tree_data_source(
+async def update_family_tree_data_source(
     family_tree_data_source_id: str,
-    patch: Dict[str, Any],
+    patch: Union[List[PatchOperationModel], Dict[str, Any]],
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Update family-tree data source
     """
     log.info("Calling update_family_tree_data_source")
 
-    client = client_factory()
-
-    patch.update({"id": family_tree_data_source_id})
-    patch.update({"partitionKey": "family-tree-data-source"})
-
     try:
-        success = client.update_data(
+        success = await client.patch_data(
             item={
                 "id": family_tree_data_source_id,
                 "partitionKey": "family-tree-data-source",
             },
-            body=patch,
-            upsert=False,
+            operations=create_patch_operations(patch),
         )
         if not success:
             log.critical(
@@ -160,18 +211,17 @@ def update_family_tree_data_source(
 
 
 @router.delete("/api/deleteFamilyTreeDataSource")
-def delete_family_tree_data_source(
+async def delete_family_tree_data_source(
     family_tree_data_source_id: str,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Delete family tree data source
     """
     log.info("Calling delete_family_tree_data_source")
 
-    client = client_factory()
-
     try:
-        success = client.delete_data(
+        success = await client.delete_data(
             item=family_tree_data_source_id,
             partition_key="family-tree-data-source",
         )
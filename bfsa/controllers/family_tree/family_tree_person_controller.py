@@ -6,16 +6,24 @@ Created on 2022-08-08
 @email: bennettedmund@gmail.com
 """
 
-from typing import List, Dict, Any, Optional
-from fastapi import APIRouter, UploadFile, File
+from typing import List, Dict, Any, Optional, Union
+from fastapi import APIRouter, UploadFile, File, Depends, Header
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from io import BytesIO
 
-from bfsa.db.environment import client_factory
 from bfsa.db.client import get_blob_credentials
-from bfsa.blob.blob_service_client import upload_blob, delete_blob
-from bfsa.sql.create_select import create_select
+from bfsa.db.unit_of_work import UnitOfWork
+from bfsa.db.environment import get_client
+from bfsa.db.patch_operations import PatchOperationModel, create_patch_operations
+from bfsa.blob.content_addressed_storage import store_blob, release_blob
+from bfsa.sql.create_select import (
+    create_select,
+    create_aggregate,
+    is_point_read,
+    parse_fields,
+)
 from bfsa.utils.return_json import return_json
+from bfsa.utils.return_ndjson import return_ndjson, accepts_ndjson
 from bfsa.utils.create_guid import create_guid
 from bfsa.utils.logger import logger as log
 
@@ -49,22 +57,21 @@ class FamilyTreePersonModel(BaseModel):
 
 
 @router.post("/api/createFamilyTreePerson")
-def create_family_tree_person(
+async def create_family_tree_person(
     person: FamilyTreePersonModel,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Add family-tree person object to database
     """
     log.info("Calling create_family_tree_person")
 
-    client = client_factory()
-
     person_dict = dict(person)
     person_dict.update({"id": create_guid()})
     person_dict.update({"partitionKey": "family-tree-person"})
 
     try:
-        success = client.insert_data(
+        success = await client.insert_data(
             [person_dict],
         )
         if not success:
@@ -88,10 +95,57 @@ def create_family_tree_person(
     )
 
 
+@router.post("/api/createManyFamilyTreePeople")
+async def create_many_family_tree_people(
+    people: List[FamilyTreePersonModel],
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Add many family-tree people objects to database concurrently
+    """
+    log.info("Calling create_many_family_tree_people")
+
+    person_dicts = []
+    for person in people:
+        person_dict = dict(person)
+        person_dict.update({"id": create_guid()})
+        person_dict.update({"partitionKey": "family-tree-person"})
+        person_dicts.append(person_dict)
+
+    try:
+        results = await client.bulk_insert_data(
+            person_dicts,
+        )
+    except Exception as e:
+        log.critical(f"Failed to insert family-tree people. Error: {e}")
+        return return_json(
+            message="Failed to insert family-tree people.",
+            success=False,
+        )
+
+    failures = [result for result in results if not result["success"]]
+    if failures:
+        log.critical(
+            f"Failed to insert {len(failures)} of {len(results)} family-tree people."
+        )
+        return return_json(
+            message=f"Failed to insert {len(failures)} of {len(results)} family-tree people.",
+            success=False,
+            content=results,
+        )
+
+    return return_json(
+        message="Successfully inserted family-tree people.",
+        success=True,
+        content=results,
+    )
+
+
 @router.put("/api/putFamilyTreePersonImage")
 async def put_family_tree_person_image(
     family_tree_person_id: str,
     image: UploadFile = File(...),
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Put family tree person image
@@ -117,22 +171,17 @@ async def put_family_tree_person_image(
             success=False,
         )
 
-    # pre-amble
-
-    client = client_factory()
-
     # insert data - blob first then metadata
 
-    blob_credentials = get_blob_credentials()
+    blob_credentials = await run_in_threadpool(get_blob_credentials)
 
     try:
-        blob_url = upload_blob(
+        blob_url = await store_blob(
+            client=client,
             connection=blob_credentials["credentials"],
             container="family-tree-photos",
-            guid=family_tree_person_id,
             filename=image.filename,
-            file=BytesIO(await image.read()),
-            overwrite=True,
+            file=image,
         )
 
     except Exception as e:
@@ -142,53 +191,84 @@ async def put_family_tree_person_image(
             success=False,
         )
 
-    response = read_family_tree_people(where={"id": family_tree_person_id})
-
-    if response["success"]:
-        content = response["content"]
-        if content:
-            family_tree_person_dict = content[0]
-            if (
-                "blob_url" in family_tree_person_dict.keys()
-                and family_tree_person_dict["blob_url"] == blob_url
-            ):
-                return return_json(
-                    message="Successfully updated family tree person image.",
-                    success=True,
-                )
+    if blob_url is None:
+        log.critical(
+            f"Failed to insert family tree person image. Check logs for details."
+        )
+        return return_json(
+            message="Failed to insert family tree person image.",
+            success=False,
+        )
 
-            family_tree_person_dict.update({"blob_url": blob_url})
+    try:
+        family_tree_person_dict = await client.get_by_id(
+            item_id=family_tree_person_id,
+            partition_key="family-tree-person",
+        )
+    except Exception as e:
+        log.critical(f"Failed to read family tree person. Error: {e}")
+        family_tree_person_dict = None
+
+    if family_tree_person_dict:
+        if (
+            "blob_url" in family_tree_person_dict.keys()
+            and family_tree_person_dict["blob_url"] == blob_url
+        ):
+            # the image is unchanged, so the reference just taken is not needed
+            await release_blob(
+                client=client,
+                connection=blob_credentials["credentials"],
+                container="family-tree-photos",
+                url=blob_url,
+            )
+            return return_json(
+                message="Successfully updated family tree person image.",
+                success=True,
+            )
 
-            try:
-                cosmos_success = client.update_data(
-                    item={
-                        "id": family_tree_person_id,
-                        "partitionKey": "family-tree-person",
-                    },
-                    body=family_tree_person_dict,
-                    upsert=False,
+        try:
+            # only if the image is unchanged since it was read, so that concurrent
+            # puts never both release the previous image
+            cosmos_success = await client.patch_data(
+                item={
+                    "id": family_tree_person_id,
+                    "partitionKey": "family-tree-person",
+                },
+                operations=[{"op": "set", "path": "/blob_url", "value": blob_url}],
+                etag=family_tree_person_dict["_etag"],
+            )
+            if not cosmos_success:
+                log.critical(
+                    f"Failed to insert family tree person image. Check logs for details."
                 )
-                if not cosmos_success:
-                    log.critical(
-                        f"Failed to insert family tree person image. Check logs for details."
-                    )
-
-            except Exception as e:
-                cosmos_success = False
-                log.critical(f"Failed to insert family tree person image. Error: {e}")
-
-            if cosmos_success:
-                return return_json(
-                    message="Successfully inserted family tree person image.",
-                    success=True,
+
+        except Exception as e:
+            cosmos_success = False
+            log.critical(f"Failed to insert family tree person image. Error: {e}")
+
+        if cosmos_success:
+            # the previous image is no longer used by this family tree person
+            if family_tree_person_dict.get("blob_url"):
+                await release_blob(
+                    client=client,
+                    connection=blob_credentials["credentials"],
+                    container="family-tree-photos",
+                    url=family_tree_person_dict["blob_url"],
                 )
+            return return_json(
+                message="Successfully inserted family tree person image.",
+                success=True,
+            )
 
     # Are you still here? Then blob insertion succeeded but Cosmos insertion failed
-    # roll back by deleting blob
+    # roll back by releasing blob
 
     try:
-        response = delete_family_tree_person_image(
-            photo_id=family_tree_person_id,
+        response = await release_blob(
+            client=client,
+            connection=blob_credentials["credentials"],
+            container="family-tree-photos",
+            url=blob_url,
         )
         # TODO: indicate whether roll back was successful
         return return_json(
@@ -206,16 +286,18 @@ async def put_family_tree_person_image(
 
 
 @router.delete("/api/deleteFamilyTreePersonImage")
-def delete_family_tree_person_image(
+async def delete_family_tree_person_image(
     family_tree_person_id: str,
+    client: UnitOfWork = Depends(get_client),
 ):
     log.info("Calling delete_family_tree_person_image")
 
-    blob_credentials = get_blob_credentials()
+    blob_credentials = await run_in_threadpool(get_blob_credentials)
 
     try:
-        family_tree_person_details = read_family_tree_people(
-            where={"id": family_tree_person_id}
+        family_tree_person_details = await client.get_by_id(
+            item_id=family_tree_person_id,
+            partition_key="family-tree-person",
         )
     except Exception as e:
         log.critical(f"Failed to read family tree person. Error: {e}")
@@ -224,20 +306,30 @@ def delete_family_tree_person_image(
             success=False,
         )
 
-    try:
-        blob_delete_success = delete_blob(
-            connection=blob_credentials["credentials"],
-            container="family-tree-photos",
-            url=family_tree_person_details["content"][0]["blob_url"],
+    if not family_tree_person_details or not family_tree_person_details.get("blob_url"):
+        log.info(f"No family tree person image to delete.")
+        return return_json(
+            message="No family tree person image to delete.",
+            success=True,
         )
 
-        if not blob_delete_success:
-            log.critical(f"Failed to delete family tree person image.")
+    # delete URL to blob from cosmos first, and only if the image is unchanged since it
+    # was read, so that the blob is released once however often this is retried
+
+    try:
+        success = await client.patch_data(
+            item={"id": family_tree_person_id, "partitionKey": "family-tree-person"},
+            operations=[{"op": "set", "path": "/blob_url", "value": None}],
+            etag=family_tree_person_details["_etag"],
+        )
+        if not success:
+            log.critical(
+                f"Failed to delete family tree person image. Check logs for details."
+            )
             return return_json(
                 message="Failed to delete family tree person image.",
                 success=False,
             )
-
     except Exception as e:
         log.critical(f"Failed to delete family tree person image. Error: {e}")
         return return_json(
@@ -245,17 +337,27 @@ def delete_family_tree_person_image(
             success=False,
         )
 
-    # blob deleted, now delete URL to blob from cosmos
-
-    family_tree_person_details.update({"blob_url": None})
-
     try:
-        update_family_tree_person(
-            family_tree_person_id,
-            family_tree_person_details,
+        blob_delete_success = await release_blob(
+            client=client,
+            connection=blob_credentials["credentials"],
+            container="family-tree-photos",
+            url=family_tree_person_details["blob_url"],
         )
+
+        if not blob_delete_success:
+            log.critical(
+                f"Failed to delete family tree person image. Check blob storage for orphaned blobs."
+            )
+            return return_json(
+                message="Failed to delete family tree person image.",
+                success=False,
+            )
+
     except Exception as e:
-        log.critical(f"Failed to delete family tree person image. Error: {e}")
+        log.critical(
+            f"Failed to delete family tree person image. Check blob storage for orphaned blobs. Error: {e}"
+        )
         return return_json(
             message="Failed to delete family tree person image.",
             success=False,
@@ -268,31 +370,39 @@ def delete_family_tree_person_image(
 
 
 @router.get("/api/readFamilyTreePeople")
-def read_family_tree_people(
+async def read_family_tree_people(
     where: Dict[str, Any] = None,
+    fields: Optional[str] = None,
+    page_size: Optional[int] = None,
+    continuation_token: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Read family-tree people
     """
     log.info("Calling read_family_tree_people")
 
-    client = client_factory()
-
     if where is None:
         where = {}
     where.update({"partitionKey": "family-tree-person"})
 
-    query = create_select(where)
-
     try:
-        data = client.select_data(
-            query=query,
-        )
-        if data:
-            return return_json(
-                message="Successfully selected family-tree person data.",
-                success=True,
-                content=data,
+        if is_point_read(where):
+            item = await client.get_by_id(
+                item_id=where["id"],
+                partition_key=where["partitionKey"],
+                fields=parse_fields(fields),
+            )
+            data, continuation_token = [item] if item else [], None
+        else:
+            query = create_select(where, fields=parse_fields(fields))
+            if accepts_ndjson(accept):
+                return return_ndjson(client.stream_data(query=query))
+            data, continuation_token = await client.select_page(
+                query=query,
+                page_size=page_size,
+                continuation_token=continuation_token,
             )
     except Exception as e:
         log.critical(f"Failed to select family-tree person data. Error: {e}")
@@ -301,33 +411,71 @@ def read_family_tree_people(
             success=False,
         )
 
-    log.critical(f"Failed to select family-tree person data. Check logs for details.")
     return return_json(
-        message="Failed to select family-tree person data.",
-        success=False,
+        message="Successfully selected family-tree person data.",
+        success=True,
+        content=data,
+        continuation_token=continuation_token,
+    )
+
+
+@router.get("/api/aggregateFamilyTreePeople")
+async def aggregate_family_tree_people(
+    where: Dict[str, Any] = None,
+    function: str = "count",
+    field: Optional[str] = None,
+    group_by: Optional[str] = None,
+    group_by_prefix: Optional[int] = None,
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Aggregate family-tree person, e.g. count family-tree person documents grouped by a field
+    """
+    log.info("Calling aggregate_family_tree_people")
+
+    if where is None:
+        where = {}
+    where.update({"partitionKey": "family-tree-person"})
+
+    try:
+        data = await client.aggregate(
+            query=create_aggregate(
+                where,
+                function=function,
+                field=field,
+                group_by=group_by,
+                group_by_prefix=group_by_prefix,
+            ),
+        )
+    except Exception as e:
+        log.critical(f"Failed to aggregate family-tree person data. Error: {e}")
+        return return_json(
+            message="Failed to aggregate family-tree person data.",
+            success=False,
+        )
+
+    return return_json(
+        message="Successfully aggregated family-tree person data.",
+        success=True,
+        content={"aggregate": data},
     )
 
 
 @router.patch("/api/updateFamilyTreePerson")
-def update_family_tree_person(
+async def update_family_tree_person(
     family_tree_person_id: str,
-    patch: Dict[str, Any],
+    patch: Union[List[PatchOperationModel], Dict[str, Any]],
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Update family-tree person
     """
     log.info("Calling update_family_tree_person")
 
-    client = client_factory()
-
-    patch.update({"id": family_tree_person_id})
-    patch.update({"partitionKey": "family-tree-person"})
-
     try:
-        success = client.update_data(
+        success = await client.patch_data(
             item={"id": family_tree_person_id, "partitionKey": "family-tree-person"},
-            body=patch,
-            upsert=False,
+            operations=create_patch_operations(patch),
         )
         if not success:
             log.critical(
@@ -351,18 +499,17 @@ def update_family_tree_person(
 
 
 @router.delete("/api/deleteFamilyTreePerson")
-def delete_family_tree_person(
+async def delete_family_tree_person(
     family_tree_person_id: str,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Delete family tree person
     """
     log.info("Calling delete_family_tree_person")
 
-    client = client_factory()
-
     try:
-        success = client.delete_data(
+        success = await client.delete_data(
             item=family_tree_person_id,
             partition_key="family-tree-person",
         )
@@ -6,13 +6,21 @@ Created on 2022-08-08
 @email: bennettedmund@gmail.com
 """
 
-from typing import Dict, Any, Optional
-from fastapi import APIRouter
+from typing import Dict, Any, Optional, List, Union
+from fastapi import APIRouter, Depends, Header
 from pydantic import BaseModel
 
-from bfsa.db.environment import client_factory
-from bfsa.sql.create_select import create_select
+from bfsa.db.unit_of_work import UnitOfWork
+from bfsa.db.environment import get_client
+from bfsa.db.patch_operations import PatchOperationModel, create_patch_operations
+from bfsa.sql.create_select import (
+    create_select,
+    create_aggregate,
+    is_point_read,
+    parse_fields,
+)
 from bfsa.utils.return_json import return_json
+from bfsa.utils.return_ndjson import return_ndjson, accepts_ndjson
 from bfsa.utils.create_guid import create_guid
 from bfsa.utils.logger import logger as log
 
@@ -34,22 +42,21 @@ class FamilyTreeRelationshipModel(BaseModel):
 
 
 @router.post("/api/createFamilyTreeRelationship")
-def create_family_tree_relationship(
+async def create_family_tree_relationship(
     relationship: FamilyTreeRelationshipModel,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Add family-tree relationship object to database
     """
     log.info("Calling create_family_tree_relationship")
 
-    client = client_factory()
-
     relationship_dict = dict(relationship)
     relationship_dict.update({"id": create_guid()})
     relationship_dict.update({"partitionKey": "family-tree-relationship"})
 
     try:
-        success = client.insert_data(
+        success = await client.insert_data(
             [relationship_dict],
         )
         if not success:
@@ -74,31 +81,39 @@ def create_family_tree_relationship(
 
 
 @router.get("/api/readFamilyTreeRelationships")
-def read_family_tree_relationships(
+async def read_family_tree_relationships(
     where: Dict[str, Any] = None,
+    fields: Optional[str] = None,
+    page_size: Optional[int] = None,
+    continuation_token: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Read family-tree people
     """
     log.info("Calling read_family_tree_relationships")
 
-    client = client_factory()
-
     if where is None:
         where = {}
     where.update({"partitionKey": "family-tree-relationship"})
 
-    query = create_select(where)
-
     try:
-        data = client.select_data(
-            query=query,
-        )
-        if data:
-            return return_json(
-                message="Successfully selected family-tree relationship data.",
-                success=True,
-                content=data,
+        if is_point_read(where):
+            item = await client.get_by_id(
+                item_id=where["id"],
+                partition_key=where["partitionKey"],
+                fields=parse_fields(fields),
+            )
+            data, continuation_token = [item] if item else [], None
+        else:
+            query = create_select(where, fields=parse_fields(fields))
+            if accepts_ndjson(accept):
+                return return_ndjson(client.stream_data(query=query))
+            data, continuation_token = await client.select_page(
+                query=query,
+                page_size=page_size,
+                continuation_token=continuation_token,
             )
     except Exception as e:
         log.critical(f"Failed to select family-tree relationship data. Error: {e}")
@@ -107,38 +122,74 @@ def read_family_tree_relationships(
             success=False,
         )
 
-    log.critical(
-        f"Failed to select family-tree relationship data. Check logs for details."
+    return return_json(
+        message="Successfully selected family-tree relationship data.",
+        success=True,
+        content=data,
+        continuation_token=continuation_token,
     )
+
+
+@router.get("/api/aggregateFamilyTreeRelationships")
+async def aggregate_family_tree_relationships(
+    where: Dict[str, Any] = None,
+    function: str = "count",
+    field: Optional[str] = None,
+    group_by: Optional[str] = None,
+    group_by_prefix: Optional[int] = None,
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Aggregate family-tree relationship, e.g. count family-tree relationship documents grouped by a field
+    """
+    log.info("Calling aggregate_family_tree_relationships")
+
+    if where is None:
+        where = {}
+    where.update({"partitionKey": "family-tree-relationship"})
+
+    try:
+        data = await client.aggregate(
+            query=create_aggregate(
+                where,
+                function=function,
+                field=field,
+                group_by=group_by,
+                group_by_prefix=group_by_prefix,
+            ),
+        )
+    except Exception as e:
+        log.critical(f"Failed to aggregate family-tree relationship data. Error: {e}")
+        return return_json(
+            message="Failed to aggregate family-tree relationship data.",
+            success=False,
+        )
+
     return return_json(
-        message="Failed to select family-tree relationship data.",
-        success=False,
+        message="Successfully aggregated family-tree relationship data.",
+        success=True,
+        content={"aggregate": data},
     )
 
 
 @router.patch("/api/updateFamilyTreeRelationship")
-def update_family_tree_relationship(
+async def update_family_tree_relationship(
     family_tree_relationship_id: str,
-    patch: Dict[str, Any],
+    patch: Union[List[PatchOperationModel], Dict[str, Any]],
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Update family-tree relationship
     """
     log.info("Calling update_family_tree_relationship")
 
-    client = client_factory()
-
-    patch.update({"id": family_tree_relationship_id})
-    patch.update({"partitionKey": "family-tree-relationship"})
-
     try:
-        success = client.update_data(
+        success = await client.patch_data(
             item={
                 "id": family_tree_relationship_id,
                 "partitionKey": "family-tree-relationship",
             },
-            body=patch,
-            upsert=False,
+            operations=create_patch_operations(patch),
         )
         if not success:
             log.critical(
@@ -162,18 +213,17 @@ def update_family_tree_relationship(
 
 
 @router.delete("/api/deleteFamilyTreeRelationship")
-def delete_family_tree_relationship(
+async def delete_family_tree_relationship(
     family_tree_relationship_id: str,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Delete family tree relationship
     """
     log.info("Calling delete_family_tree_relationship")
 
-    client = client_factory()
-
     try:
-        success = client.delete_data(
+        success = await client.delete_data(
             item=family_tree_relationship_id,
             partition_key="family-tree-relationship",
         )
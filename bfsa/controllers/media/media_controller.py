@@ -6,13 +6,21 @@ Created on 2022-07-16
 @email: bennettedmund@gmail.com
 """
 
-from typing import Dict, Any, Optional
-from fastapi import APIRouter
+from typing import List, Dict, Any, Optional, Union
+from fastapi import APIRouter, Depends, Header
 from pydantic import BaseModel
 
-from bfsa.db.environment import client_factory
-from bfsa.sql.create_select import create_select
+from bfsa.db.unit_of_work import UnitOfWork
+from bfsa.db.environment import get_client
+from bfsa.db.patch_operations import PatchOperationModel, create_patch_operations
+from bfsa.sql.create_select import (
+    create_select,
+    create_aggregate,
+    is_point_read,
+    parse_fields,
+)
 from bfsa.utils.return_json import return_json
+from bfsa.utils.return_ndjson import return_ndjson, accepts_ndjson
 from bfsa.utils.create_guid import create_guid
 from bfsa.utils.logger import logger as log
 
@@ -40,22 +48,21 @@ class MediaModel(BaseModel):
 
 
 @router.post("/api/createMedia")
-def create_media(
+async def create_media(
     media: MediaModel,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Add media object to database
     """
     log.info("Calling create_media")
 
-    client = client_factory()
-
     media_dict = dict(media)
     media_dict.update({"id": create_guid()})
     media_dict.update({"partitionKey": "media"})
 
     try:
-        success = client.insert_data(
+        success = await client.insert_data(
             [media_dict],
         )
         if not success:
@@ -77,32 +84,84 @@ def create_media(
     )
 
 
+@router.post("/api/createManyMedia")
+async def create_many_media(
+    media: List[MediaModel],
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Add many media objects to database concurrently
+    """
+    log.info("Calling create_many_media")
+
+    media_dicts = []
+    for medium in media:
+        media_dict = dict(medium)
+        media_dict.update({"id": create_guid()})
+        media_dict.update({"partitionKey": "media"})
+        media_dicts.append(media_dict)
+
+    try:
+        results = await client.bulk_insert_data(
+            media_dicts,
+        )
+    except Exception as e:
+        log.critical(f"Failed to insert media. Error: {e}")
+        return return_json(
+            message="Failed to insert media.",
+            success=False,
+        )
+
+    failures = [result for result in results if not result["success"]]
+    if failures:
+        log.critical(f"Failed to insert {len(failures)} of {len(results)} media.")
+        return return_json(
+            message=f"Failed to insert {len(failures)} of {len(results)} media.",
+            success=False,
+            content=results,
+        )
+
+    return return_json(
+        message="Successfully inserted media.",
+        success=True,
+        content=results,
+    )
+
+
 @router.get("/api/readMedia")
-def read_media(
+async def read_media(
     where: Dict[str, Any] = None,
+    fields: Optional[str] = None,
+    page_size: Optional[int] = None,
+    continuation_token: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Read media
     """
     log.info("Calling read_media")
 
-    client = client_factory()
-
     if where is None:
         where = {}
     where.update({"partitionKey": "media"})
 
-    query = create_select(where)
-
     try:
-        data = client.select_data(
-            query=query,
-        )
-        if data:
-            return return_json(
-                message="Successfully selected media data.",
-                success=True,
-                content=data,
+        if is_point_read(where):
+            item = await client.get_by_id(
+                item_id=where["id"],
+                partition_key=where["partitionKey"],
+                fields=parse_fields(fields),
+            )
+            data, continuation_token = [item] if item else [], None
+        else:
+            query = create_select(where, fields=parse_fields(fields))
+            if accepts_ndjson(accept):
+                return return_ndjson(client.stream_data(query=query))
+            data, continuation_token = await client.select_page(
+                query=query,
+                page_size=page_size,
+                continuation_token=continuation_token,
             )
     except Exception as e:
         log.critical(f"Failed to select media data. Error: {e}")
@@ -111,33 +170,71 @@ def read_media(
             success=False,
         )
 
-    log.critical(f"Failed to select media data. Check logs for details.")
     return return_json(
-        message="Failed to select media data.",
-        success=False,
+        message="Successfully selected media data.",
+        success=True,
+        content=data,
+        continuation_token=continuation_token,
+    )
+
+
+@router.get("/api/aggregateMedia")
+async def aggregate_media(
+    where: Dict[str, Any] = None,
+    function: str = "count",
+    field: Optional[str] = None,
+    group_by: Optional[str] = None,
+    group_by_prefix: Optional[int] = None,
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Aggregate media, e.g. count media documents grouped by a field
+    """
+    log.info("Calling aggregate_media")
+
+    if where is None:
+        where = {}
+    where.update({"partitionKey": "media"})
+
+    try:
+        data = await client.aggregate(
+            query=create_aggregate(
+                where,
+                function=function,
+                field=field,
+                group_by=group_by,
+                group_by_prefix=group_by_prefix,
+            ),
+        )
+    except Exception as e:
+        log.critical(f"Failed to aggregate media data. Error: {e}")
+        return return_json(
+            message="Failed to aggregate media data.",
+            success=False,
+        )
+
+    return return_json(
+        message="Successfully aggregated media data.",
+        success=True,
+        content={"aggregate": data},
     )
 
 
 @router.patch("/api/updateMedia")
-def update_media(
+async def update_media(
     media_id: str,
-    patch: Dict[str, Any],
+    patch: Union[List[PatchOperationModel], Dict[str, Any]],
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Update media
     """
     log.info("Calling update_media")
 
-    client = client_factory()
-
-    patch.update({"id": media_id})
-    patch.update({"partitionKey": "media"})
-
     try:
-        success = client.update_data(
+        success = await client.patch_data(
             item={"id": media_id, "partitionKey": "media"},
-            body=patch,
-            upsert=False,
+            operations=create_patch_operations(patch),
         )
         if not success:
             log.critical(f"Failed to update media. Check logs for details.")
@@ -159,18 +256,17 @@ def update_media(
 
 
 @router.delete("/api/deleteMedia")
-def delete_media(
+async def delete_media(
     media_id: str,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Delete media
     """
     log.info("Calling delete_media")
 
-    client = client_factory()
-
     try:
-        success = client.delete_data(
+        success = await client.delete_data(
             item=media_id,
             partition_key="media",
         )
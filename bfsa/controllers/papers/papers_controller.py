@@ -8,18 +8,32 @@ Created on 2022-11-12
 
 from os import system, remove
 from io import BytesIO
-from typing import Dict, Any, Optional
-from fastapi import APIRouter, UploadFile
+from typing import Dict, Any, Optional, List, Union
+from fastapi import APIRouter, UploadFile, Depends, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse
 from PyPDF2 import PdfReader
 import csv
 
-from bfsa.db.environment import client_factory
 from bfsa.db.client import get_blob_credentials
+from bfsa.db.unit_of_work import UnitOfWork
+from bfsa.db.environment import get_client
+from bfsa.db.patch_operations import PatchOperationModel, create_patch_operations
 from bfsa.controllers.environment import Environment as Base
-from bfsa.blob.blob_service_client import upload_blob, delete_blob
-from bfsa.sql.create_select import create_select
+from bfsa.blob.blob_service_client import (
+    upload_blob,
+    delete_blob,
+    create_upload_url,
+    get_uploaded_blob_url,
+)
+from bfsa.sql.create_select import (
+    create_select,
+    create_aggregate,
+    is_point_read,
+    parse_fields,
+)
 from bfsa.utils.return_json import return_json
+from bfsa.utils.return_ndjson import return_ndjson, accepts_ndjson
 from bfsa.utils.create_guid import create_guid
 from bfsa.utils.get_files_recursively import FileManipulation
 from bfsa.utils.logger import logger as log
@@ -40,7 +54,7 @@ environment = Base()
 
 
 @router.post("/api/createPaper")
-def create_paper(
+async def create_paper(
     title: str,
     file: UploadFile = None,
     description: Optional[str] = None,
@@ -51,6 +65,7 @@ def create_paper(
     publication_type: Optional[str] = None,
     publication_location: Optional[str] = None,
     publication_date: Optional[str] = None,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Add paper object to database
@@ -61,7 +76,9 @@ def create_paper(
     staging_populated = False
     if doi is not None:
         try:
-            system(f'python -m PyPaperBot --doi="{doi}" --dwn-dir="{staging_dir}"')
+            await run_in_threadpool(
+                system, f'python -m PyPaperBot --doi="{doi}" --dwn-dir="{staging_dir}"'
+            )
             staging_populated = True
         except Exception as e:
             log.warning(f"DOI provided but could not get paper. Error: {e}")
@@ -102,18 +119,15 @@ def create_paper(
             success=False,
         )
 
-    # pre-amble
-
-    client = client_factory()
-
     # insert data - blob first then metadata
 
     guid = create_guid()
 
-    blob_credentials = get_blob_credentials()
+    blob_credentials = await run_in_threadpool(get_blob_credentials)
 
     try:
-        blob_url = upload_blob(
+        blob_url = await run_in_threadpool(
+            upload_blob,
             connection=blob_credentials["credentials"],
             container="papers",
             guid=guid,
@@ -132,7 +146,9 @@ def create_paper(
     file_bytes.seek(0)
 
     reader = PdfReader(file_bytes)
-    paper_content = "\n".join([page.extract_text() for page in reader.pages])
+    paper_content = await run_in_threadpool(
+        lambda: "\n".join([page.extract_text() for page in reader.pages])
+    )
 
     parsed_authors = None if bib_data is None else bib_data["Authors"].split(" and ")
 
@@ -168,7 +184,7 @@ def create_paper(
     # insert data into cosmos
 
     try:
-        cosmos_success = client.insert_data(
+        cosmos_success = await client.insert_data(
             [paper_dict],
         )
         if not cosmos_success:
@@ -188,8 +204,9 @@ def create_paper(
     # roll back by deleting blob
 
     try:
-        response = delete_paper(
+        response = await delete_paper(
             paper_id=guid,
+            client=client,
         )
         # TODO: indicate whether roll back was successful
         return return_json(
@@ -206,32 +223,166 @@ def create_paper(
         )
 
 
+@router.post("/api/createPaperUploadUrl")
+async def create_paper_upload_url(
+    filename: str,
+):
+    """
+    Create a short-lived URL to upload a paper straight to blob storage. Once uploaded,
+    the paper is added by calling commitPaper with the returned id
+    """
+    log.info("Calling create_paper_upload_url")
+
+    if "." not in filename or filename.rsplit(".", 1)[1].lower() not in ["pdf"]:
+        return return_json(
+            "Invalid file.",
+            success=False,
+        )
+
+    guid = create_guid()
+
+    blob_credentials = await run_in_threadpool(get_blob_credentials)
+
+    upload_url = await run_in_threadpool(
+        create_upload_url,
+        connection=blob_credentials["credentials"],
+        container="papers",
+        filename=filename,
+        guid=guid,
+    )
+    if upload_url is None:
+        log.critical(f"Failed to create paper upload URL. Check logs for details.")
+        return return_json(
+            message="Failed to create paper upload URL.",
+            success=False,
+        )
+
+    return return_json(
+        message="Successfully created paper upload URL.",
+        success=True,
+        content={"id": guid, **upload_url},
+    )
+
+
+@router.post("/api/commitPaper")
+async def commit_paper(
+    paper_id: str,
+    filename: str,
+    title: str,
+    description: Optional[str] = None,
+    abstract: Optional[str] = None,
+    doi: Optional[str] = None,
+    language: Optional[str] = None,
+    authors: Optional[str] = None,
+    publication_type: Optional[str] = None,
+    publication_location: Optional[str] = None,
+    publication_date: Optional[str] = None,
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Add paper object to database for a file uploaded through createPaperUploadUrl. The
+    file never passes through the API, so paper_content and pages are not extracted
+    """
+    log.info("Calling commit_paper")
+
+    blob_credentials = await run_in_threadpool(get_blob_credentials)
+
+    try:
+        blob_url = await run_in_threadpool(
+            get_uploaded_blob_url,
+            connection=blob_credentials["credentials"],
+            container="papers",
+            filename=filename,
+            guid=paper_id,
+        )
+    except Exception as e:
+        log.critical(f"Failed to read uploaded paper. Error: {e}")
+        return return_json(
+            message="Failed to commit paper.",
+            success=False,
+        )
+
+    if blob_url is None:
+        return return_json(
+            message="No uploaded file found for paper.",
+            success=False,
+        )
+
+    paper_dict = {
+        "title": title,
+        "description": description,
+        "abstract": abstract,
+        "paper_content": None,
+        "doi": doi,
+        "pages": None,
+        "language": language,
+        "publication_type": publication_type,
+        "publication_location": publication_location,
+        "publication_date": publication_date,
+        "authors": None if authors is None else authors.split(","),
+        "blob_url": blob_url,
+        "id": paper_id,
+        "partitionKey": "papers",
+    }
+
+    # the uploaded blob is kept on failure, so that the commit can be retried
+    try:
+        success = await client.insert_data(
+            [paper_dict],
+        )
+        if not success:
+            log.critical(f"Failed to commit paper. Check logs for details.")
+            return return_json(
+                message="Failed to commit paper.",
+                success=False,
+            )
+    except Exception as e:
+        log.critical(f"Failed to commit paper. Error: {e}")
+        return return_json(
+            message="Failed to commit paper.",
+            success=False,
+        )
+
+    return return_json(
+        message="Successfully inserted paper.",
+        success=True,
+    )
+
+
 @router.get("/api/readPapers")
-def read_papers(
+async def read_papers(
     where: Dict[str, Any] = None,
+    fields: Optional[str] = None,
+    page_size: Optional[int] = None,
+    continuation_token: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Read papers
     """
     log.info("Calling read_papers")
 
-    client = client_factory()
-
     if where is None:
         where = {}
     where.update({"partitionKey": "papers"})
 
-    query = create_select(where)
-
     try:
-        data = client.select_data(
-            query=query,
-        )
-        if data:
-            return return_json(
-                message="Successfully selected papers data.",
-                success=True,
-                content=data,
+        if is_point_read(where):
+            item = await client.get_by_id(
+                item_id=where["id"],
+                partition_key=where["partitionKey"],
+                fields=parse_fields(fields),
+            )
+            data, continuation_token = [item] if item else [], None
+        else:
+            query = create_select(where, fields=parse_fields(fields))
+            if accepts_ndjson(accept):
+                return return_ndjson(client.stream_data(query=query))
+            data, continuation_token = await client.select_page(
+                query=query,
+                page_size=page_size,
+                continuation_token=continuation_token,
             )
     except Exception as e:
         log.critical(f"Failed to select papers data. Error: {e}")
@@ -240,33 +391,71 @@ def read_papers(
             success=False,
         )
 
-    log.critical(f"Failed to select papers data. Check logs for details.")
     return return_json(
-        message="Failed to select papers data.",
-        success=False,
+        message="Successfully selected papers data.",
+        success=True,
+        content=data,
+        continuation_token=continuation_token,
+    )
+
+
+@router.get("/api/aggregatePapers")
+async def aggregate_papers(
+    where: Dict[str, Any] = None,
+    function: str = "count",
+    field: Optional[str] = None,
+    group_by: Optional[str] = None,
+    group_by_prefix: Optional[int] = None,
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Aggregate papers, e.g. count papers documents grouped by a field
+    """
+    log.info("Calling aggregate_papers")
+
+    if where is None:
+        where = {}
+    where.update({"partitionKey": "papers"})
+
+    try:
+        data = await client.aggregate(
+            query=create_aggregate(
+                where,
+                function=function,
+                field=field,
+                group_by=group_by,
+                group_by_prefix=group_by_prefix,
+            ),
+        )
+    except Exception as e:
+        log.critical(f"Failed to aggregate papers data. Error: {e}")
+        return return_json(
+            message="Failed to aggregate papers data.",
+            success=False,
+        )
+
+    return return_json(
+        message="Successfully aggregated papers data.",
+        success=True,
+        content={"aggregate": data},
     )
 
 
 @router.patch("/api/updatePaperMetadata")
-def update_paper_metadata(
+async def update_paper_metadata(
     paper_id: str,
-    patch: Dict[str, Any],
+    patch: Union[List[PatchOperationModel], Dict[str, Any]],
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Update papers metadata
     """
     log.info("Calling update_paper_metadata")
 
-    client = client_factory()
-
-    patch.update({"id": paper_id})
-    patch.update({"partitionKey": "papers"})
-
     try:
-        success = client.update_data(
+        success = await client.patch_data(
             item={"id": paper_id, "partitionKey": "papers"},
-            body=patch,
-            upsert=False,
+            operations=create_patch_operations(patch),
         )
         if not success:
             log.critical(f"Failed to update paper metadata. Check logs for details.")
@@ -288,20 +477,22 @@ def update_paper_metadata(
 
 
 @router.delete("/api/deletePaper")
-def delete_paper(
+async def delete_paper(
     paper_id: str,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Delete paper
     """
     log.info("Calling delete_paper")
 
-    client = client_factory()
-
-    blob_credentials = get_blob_credentials()
+    blob_credentials = await run_in_threadpool(get_blob_credentials)
 
     try:
-        papers_details = read_papers(where={"id": paper_id})
+        papers_details = await client.get_by_id(
+            item_id=paper_id,
+            partition_key="papers",
+        )
     except Exception as e:
         log.critical(f"Failed to read paper. Error: {e}")
         return return_json(
@@ -310,7 +501,7 @@ def delete_paper(
         )
 
     try:
-        success = client.delete_data(
+        success = await client.delete_data(
             item=paper_id,
             partition_key="papers",
         )
@@ -321,10 +512,11 @@ def delete_paper(
                 success=False,
             )
 
-        blob_delete_success = delete_blob(
+        blob_delete_success = await run_in_threadpool(
+            delete_blob,
             connection=blob_credentials["credentials"],
-            container="paper",
-            url=papers_details["content"][0]["blob_url"],
+            container="papers",
+            url=papers_details["blob_url"],
         )
 
         if not blob_delete_success:
@@ -6,13 +6,21 @@ Created on 2022-07-16
 @email: bennettedmund@gmail.com
 """
 
-from typing import Dict, Any
-from fastapi import APIRouter
+from typing import Dict, Any, List, Union, Optional
+from fastapi import APIRouter, Depends, Header
 from pydantic import BaseModel
 
-from bfsa.db.environment import client_factory
-from bfsa.sql.create_select import create_select
+from bfsa.db.unit_of_work import UnitOfWork
+from bfsa.db.environment import get_client
+from bfsa.db.patch_operations import PatchOperationModel, create_patch_operations
+from bfsa.sql.create_select import (
+    create_select,
+    create_aggregate,
+    is_point_read,
+    parse_fields,
+)
 from bfsa.utils.return_json import return_json
+from bfsa.utils.return_ndjson import return_ndjson, accepts_ndjson
 from bfsa.utils.create_guid import create_guid
 from bfsa.utils.logger import logger as log
 
@@ -31,22 +39,21 @@ class EquipmentUsageModel(BaseModel):
 
 
 @router.post("/api/createEquipmentUsage")
-def create_equipment_usage(
+async def create_equipment_usage(
     equipment_usage: EquipmentUsageModel,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Add equipment usage object to database
     """
     log.info("Calling create_equipment_usage")
 
-    client = client_factory()
-
     equipment_usage_dict = dict(equipment_usage)
     equipment_usage_dict.update({"id": create_guid()})
     equipment_usage_dict.update({"partitionKey": "equipment-usage"})
 
     try:
-        success = client.insert_data(
+        success = await client.insert_data(
             [equipment_usage_dict],
         )
         if not success:
@@ -69,31 +76,39 @@ def create_equipment_usage(
 
 
 @router.get("/api/readEquipmentUsages")
-def read_equipment_usages(
+async def read_equipment_usages(
     where: Dict[str, Any] = None,
+    fields: Optional[str] = None,
+    page_size: Optional[int] = None,
+    continuation_token: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Read equipment usages
     """
     log.info("Calling read_equipment_usages")
 
-    client = client_factory()
-
     if where is None:
         where = {}
     where.update({"partitionKey": "equipment-usage"})
 
-    query = create_select(where)
-
     try:
-        data = client.select_data(
-            query=query,
-        )
-        if data:
-            return return_json(
-                message="Successfully selected equipment usage data.",
-                success=True,
-                content=data,
+        if is_point_read(where):
+            item = await client.get_by_id(
+                item_id=where["id"],
+                partition_key=where["partitionKey"],
+                fields=parse_fields(fields),
+            )
+            data, continuation_token = [item] if item else [], None
+        else:
+            query = create_select(where, fields=parse_fields(fields))
+            if accepts_ndjson(accept):
+                return return_ndjson(client.stream_data(query=query))
+            data, continuation_token = await client.select_page(
+                query=query,
+                page_size=page_size,
+                continuation_token=continuation_token,
             )
     except Exception as e:
         log.critical(f"Failed to select equipment usage data. Error: {e}")
@@ -102,33 +117,71 @@ def read_equipment_usages(
             success=False,
         )
 
-    log.critical(f"Failed to select equipment usage data. Check logs for details.")
     return return_json(
-        message="Failed to select equipment usage data.",
-        success=False,
+        message="Successfully selected equipment usage data.",
+        success=True,
+        content=data,
+        continuation_token=continuation_token,
+    )
+
+
+@router.get("/api/aggregateEquipmentUsages")
+async def aggregate_equipment_usages(
+    where: Dict[str, Any] = None,
+    function: str = "count",
+    field: Optional[str] = None,
+    group_by: Optional[str] = None,
+    group_by_prefix: Optional[int] = None,
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Aggregate equipment usage, e.g. count equipment usage documents grouped by a field
+    """
+    log.info("Calling aggregate_equipment_usages")
+
+    if where is None:
+        where = {}
+    where.update({"partitionKey": "equipment-usage"})
+
+    try:
+        data = await client.aggregate(
+            query=create_aggregate(
+                where,
+                function=function,
+                field=field,
+                group_by=group_by,
+                group_by_prefix=group_by_prefix,
+            ),
+        )
+    except Exception as e:
+        log.critical(f"Failed to aggregate equipment usage data. Error: {e}")
+        return return_json(
+            message="Failed to aggregate equipment usage data.",
+            success=False,
+        )
+
+    return return_json(
+        message="Successfully aggregated equipment usage data.",
+        success=True,
+        content={"aggregate": data},
     )
 
 
 @router.patch("/api/updateEquipmentUsage")
-def update_equipment_usage(
+async def update_equipment_usage(
     equipment_usage_id: str,
-    patch: Dict[str, Any],
+    patch: Union[List[PatchOperationModel], Dict[str, Any]],
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Update equipment usage
     """
     log.info("Calling update_equipment_usage")
 
-    client = client_factory()
-
-    patch.update({"id": equipment_usage_id})
-    patch.update({"partitionKey": "equipment-usage"})
-
     try:
-        success = client.update_data(
+        success = await client.patch_data(
             item={"id": equipment_usage_id, "partitionKey": "equipment-usage"},
-            body=patch,
-            upsert=False,
+            operations=create_patch_operations(patch),
         )
         if not success:
             log.critical(f"Failed to update equipment usage. Check logs for details.")
@@ -150,18 +203,17 @@ def update_equipment_usage(
 
 
 @router.delete("/api/deleteEquipmentUsage")
-def delete_equipment_usage(
+async def delete_equipment_usage(
     equipment_usage_id: str,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Delete equipment usage
     """
     log.info("Calling delete_equipment_usage")
 
-    client = client_factory()
-
     try:
-        success = client.delete_data(
+        success = await client.delete_data(
             item=equipment_usage_id,
             partition_key="equipment-usage",
         )
@@ -6,16 +6,24 @@ Created on 2022-07-16
 @email: bennettedmund@gmail.com
 """
 
-from typing import Dict, Any
-from io import BytesIO
-from fastapi import APIRouter, UploadFile, File
+from typing import Dict, Any, List, Union, Optional
+from fastapi import APIRouter, UploadFile, File, Depends, Header
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
-from bfsa.db.environment import client_factory
 from bfsa.db.client import get_blob_credentials
-from bfsa.blob.blob_service_client import upload_blob, delete_blob
-from bfsa.sql.create_select import create_select
+from bfsa.db.unit_of_work import UnitOfWork
+from bfsa.db.environment import get_client
+from bfsa.db.patch_operations import PatchOperationModel, create_patch_operations
+from bfsa.blob.content_addressed_storage import store_blob, release_blob
+from bfsa.sql.create_select import (
+    create_select,
+    create_aggregate,
+    is_point_read,
+    parse_fields,
+)
 from bfsa.utils.return_json import return_json
+from bfsa.utils.return_ndjson import return_ndjson, accepts_ndjson
 from bfsa.utils.create_guid import create_guid
 from bfsa.utils.logger import logger as log
 
@@ -33,22 +41,21 @@ class IngredientModel(BaseModel):
 
 
 @router.post("/api/createIngredient")
-def create_ingredient(
+async def create_ingredient(
     ingredient: IngredientModel,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Add ingredient object to database
     """
     log.info("Calling create_ingredient")
 
-    client = client_factory()
-
     ingredient_dict = dict(ingredient)
     ingredient_dict.update({"id": create_guid()})
     ingredient_dict.update({"partitionKey": "ingredients"})
 
     try:
-        success = client.insert_data(
+        success = await client.insert_data(
             [ingredient_dict],
         )
         if not success:
@@ -74,6 +81,7 @@ def create_ingredient(
 async def put_ingredient_image(
     ingredient_id: str,
     image: UploadFile = File(...),
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Put ingredient image
@@ -99,22 +107,17 @@ async def put_ingredient_image(
             success=False,
         )
 
-    # pre-amble
-
-    client = client_factory()
-
     # insert data - blob first then metadata
 
-    blob_credentials = get_blob_credentials()
+    blob_credentials = await run_in_threadpool(get_blob_credentials)
 
     try:
-        blob_url = upload_blob(
+        blob_url = await store_blob(
+            client=client,
             connection=blob_credentials["credentials"],
             container="recipe-photos",
-            guid=ingredient_id,
             filename=image.filename,
-            file=BytesIO(await image.read()),
-            overwrite=True,
+            file=image,
         )
 
     except Exception as e:
@@ -124,50 +127,79 @@ async def put_ingredient_image(
             success=False,
         )
 
-    response = read_ingredients(where={"id": ingredient_id})
-
-    if response["success"]:
-        content = response["content"]
-        if content:
-            ingredient_dict = content[0]
-            if (
-                "blob_url" in ingredient_dict.keys()
-                and ingredient_dict["blob_url"] == blob_url
-            ):
-                return return_json(
-                    message="Successfully updated ingredient image.",
-                    success=True,
-                )
+    if blob_url is None:
+        log.critical(f"Failed to insert ingredient image. Check logs for details.")
+        return return_json(
+            message="Failed to insert ingredient image.",
+            success=False,
+        )
 
-            ingredient_dict.update({"blob_url": blob_url})
+    try:
+        ingredient_dict = await client.get_by_id(
+            item_id=ingredient_id,
+            partition_key="ingredients",
+        )
+    except Exception as e:
+        log.critical(f"Failed to read ingredient. Error: {e}")
+        ingredient_dict = None
+
+    if ingredient_dict:
+        if (
+            "blob_url" in ingredient_dict.keys()
+            and ingredient_dict["blob_url"] == blob_url
+        ):
+            # the image is unchanged, so the reference just taken is not needed
+            await release_blob(
+                client=client,
+                connection=blob_credentials["credentials"],
+                container="recipe-photos",
+                url=blob_url,
+            )
+            return return_json(
+                message="Successfully updated ingredient image.",
+                success=True,
+            )
 
-            try:
-                cosmos_success = client.update_data(
-                    item={"id": ingredient_id, "partitionKey": "ingredients"},
-                    body=ingredient_dict,
-                    upsert=False,
+        try:
+            # only if the image is unchanged since it was read, so that concurrent
+            # puts never both release the previous image
+            cosmos_success = await client.patch_data(
+                item={"id": ingredient_id, "partitionKey": "ingredients"},
+                operations=[{"op": "set", "path": "/blob_url", "value": blob_url}],
+                etag=ingredient_dict["_etag"],
+            )
+            if not cosmos_success:
+                log.critical(
+                    f"Failed to insert ingredient image. Check logs for details."
                 )
-                if not cosmos_success:
-                    log.critical(
-                        f"Failed to insert ingredient image. Check logs for details."
-                    )
-
-            except Exception as e:
-                cosmos_success = False
-                log.critical(f"Failed to insert ingredient image. Error: {e}")
 
-            if cosmos_success:
-                return return_json(
-                    message="Successfully inserted ingredient image.",
-                    success=True,
+        except Exception as e:
+            cosmos_success = False
+            log.critical(f"Failed to insert ingredient image. Error: {e}")
+
+        if cosmos_success:
+            # the previous image is no longer used by this ingredient
+            if ingredient_dict.get("blob_url"):
+                await release_blob(
+                    client=client,
+                    connection=blob_credentials["credentials"],
+                    container="recipe-photos",
+                    url=ingredient_dict["blob_url"],
                 )
+            return return_json(
+                message="Successfully inserted ingredient image.",
+                success=True,
+            )
 
     # Are you still here? Then blob insertion succeeded but Cosmos insertion failed
-    # roll back by deleting blob
+    # roll back by releasing blob
 
     try:
-        response = delete_ingredient_image(
-            photo_id=ingredient_id,
+        response = await release_blob(
+            client=client,
+            connection=blob_credentials["credentials"],
+            container="recipe-photos",
+            url=blob_url,
         )
         # TODO: indicate whether roll back was successful
         return return_json(
@@ -185,39 +217,81 @@ async def put_ingredient_image(
 
 
 @router.get("/api/deleteIngredientImage")
-def delete_ingredient_image(
+async def delete_ingredient_image(
     ingredient_id: str,
+    client: UnitOfWork = Depends(get_client),
 ):
     log.info("Calling delete_ingredient_image")
 
-    blob_credentials = get_blob_credentials()
+    blob_credentials = await run_in_threadpool(get_blob_credentials)
 
-    response = read_ingredients(where={"id": ingredient_id})
+    try:
+        target_ingredient = await client.get_by_id(
+            item_id=ingredient_id,
+            partition_key="ingredients",
+        )
+    except Exception as e:
+        log.critical(f"Failed to read ingredient. Error: {e}")
+        return return_json(
+            message="Failed to read ingredient.",
+            success=False,
+        )
 
-    if response["success"]:
-        target_ingredient = response["content"][0]
-        if "blob_url" in target_ingredient.keys() and target_ingredient["blob_url"]:
+    if not target_ingredient or not target_ingredient.get("blob_url"):
+        log.info(f"No ingredient image to delete.")
+        return return_json(
+            message="No ingredient image to delete.",
+            success=True,
+        )
 
-            try:
-                success = delete_blob(
-                    connection=blob_credentials["credentials"],
-                    container="recipe-photos",
-                    url=target_ingredient["blob_url"],
-                )
+    # delete URL to blob from cosmos first, and only if the image is unchanged since it
+    # was read, so that the blob is released once however often this is retried
 
-            except Exception as e:
-                log.critical(f"Failed to delete ingredient image. Error: {e}")
-                return return_json(
-                    message="Failed to delete ingredient image.",
-                    success=False,
-                )
-        else:
-            log.info(f"No ingredient image to delete.")
+    try:
+        success = await client.patch_data(
+            item={"id": ingredient_id, "partitionKey": "ingredients"},
+            operations=[{"op": "set", "path": "/blob_url", "value": None}],
+            etag=target_ingredient["_etag"],
+        )
+        if not success:
+            log.critical(f"Failed to delete ingredient image. Check logs for details.")
             return return_json(
-                message="No ingredient image to delete.",
-                success=True,
+                message="Failed to delete ingredient image.",
+                success=False,
+            )
+    except Exception as e:
+        log.critical(f"Failed to delete ingredient image. Error: {e}")
+        return return_json(
+            message="Failed to delete ingredient image.",
+            success=False,
+        )
+
+    try:
+        blob_delete_success = await release_blob(
+            client=client,
+            connection=blob_credentials["credentials"],
+            container="recipe-photos",
+            url=target_ingredient["blob_url"],
+        )
+
+        if not blob_delete_success:
+            log.critical(
+                f"Failed to delete ingredient image. Check blob storage for orphaned blobs."
+            )
+            return return_json(
+                message="Failed to delete ingredient image.",
+                success=False,
             )
 
+    except Exception as e:
+        log.critical(
+            f"Failed to delete ingredient image. Check blob storage for orphaned blobs. Error: {e}"
+        )
+        return return_json(
+            message="Failed to delete ingredient image.",
+            success=False,
+        )
+
     return return_json(
         message="Successfully deleted ingredient image.",
         success=True,
@@ -225,31 +299,39 @@ def delete_ingredient_image(
 
 
 @router.get("/api/readIngredients")
-def read_ingredients(
+async def read_ingredients(
     where: Dict[str, Any] = None,
+    fields: Optional[str] = None,
+    page_size: Optional[int] = None,
+    continuation_token: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Read ingredients
     """
     log.info("Calling read_ingredients")
 
-    client = client_factory()
-
     if where is None:
         where = {}
     where.update({"partitionKey": "ingredients"})
 
-    query = create_select(where)
-
     try:
-        data = client.select_data(
-            query=query,
-        )
-        if data:
-            return return_json(
-                message="Successfully selected ingredient data.",
-                success=True,
-                content=data,
+        if is_point_read(where):
+            item = await client.get_by_id(
+                item_id=where["id"],
+                partition_key=where["partitionKey"],
+                fields=parse_fields(fields),
+            )
+            data, continuation_token = [item] if item else [], None
+        else:
+            query = create_select(where, fields=parse_fields(fields))
+            if accepts_ndjson(accept):
+                return return_ndjson(client.stream_data(query=query))
+            data, continuation_token = await client.select_page(
+                query=query,
+                page_size=page_size,
+                continuation_token=continuation_token,
             )
     except Exception as e:
         log.critical(f"Failed to select ingredient data. Error: {e}")
@@ -258,33 +340,71 @@ def read_ingredients(
             success=False,
         )
 
-    log.critical(f"Failed to select ingredient data. Check logs for details.")
     return return_json(
-        message="Failed to select ingredient data.",
-        success=False,
+        message="Successfully selected ingredient data.",
+        success=True,
+        content=data,
+        continuation_token=continuation_token,
+    )
+
+
+@router.get("/api/aggregateIngredients")
+async def aggregate_ingredients(
+    where: Dict[str, Any] = None,
+    function: str = "count",
+    field: Optional[str] = None,
+    group_by: Optional[str] = None,
+    group_by_prefix: Optional[int] = None,
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Aggregate ingredient, e.g. count ingredient documents grouped by a field
+    """
+    log.info("Calling aggregate_ingredients")
+
+    if where is None:
+        where = {}
+    where.update({"partitionKey": "ingredients"})
+
+    try:
+        data = await client.aggregate(
+            query=create_aggregate(
+                where,
+                function=function,
+                field=field,
+                group_by=group_by,
+                group_by_prefix=group_by_prefix,
+            ),
+        )
+    except Exception as e:
+        log.critical(f"Failed to aggregate ingredient data. Error: {e}")
+        return return_json(
+            message="Failed to aggregate ingredient data.",
+            success=False,
+        )
+
+    return return_json(
+        message="Successfully aggregated ingredient data.",
+        success=True,
+        content={"aggregate": data},
     )
 
 
 @router.patch("/api/updateIngredient")
-def update_ingredient(
+async def update_ingredient(
     ingredient_id: str,
-    patch: Dict[str, Any],
+    patch: Union[List[PatchOperationModel], Dict[str, Any]],
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Update ingredient
     """
     log.info("Calling update_ingredient")
 
-    client = client_factory()
-
-    patch.update({"id": ingredient_id})
-    patch.update({"partitionKey": "ingredients"})
-
     try:
-        success = client.update_data(
+        success = await client.patch_data(
             item={"id": ingredient_id, "partitionKey": "ingredients"},
-            body=patch,
-            upsert=False,
+            operations=create_patch_operations(patch),
         )
         if not success:
             log.critical(f"Failed to update ingredient. Check logs for details.")
@@ -306,24 +426,24 @@ def update_ingredient(
 
 
 @router.delete("/api/deleteIngredient")
-def delete_ingredient(
+async def delete_ingredient(
     ingredient_id: str,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Delete ingredient
     """
     log.info("Calling delete_ingredient")
 
-    client = client_factory()
-
-    response = delete_ingredient_image(
+    response = await delete_ingredient_image(
         ingredient_id=ingredient_id,
+        client=client,
     )
 
     if response["success"]:
 
         try:
-            success = client.delete_data(
+            success = await client.delete_data(
                 item=ingredient_id,
                 partition_key="ingredients",
             )
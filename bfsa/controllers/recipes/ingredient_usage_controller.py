@@ -6,13 +6,21 @@ Created on 2022-07-16
 @email: bennettedmund@gmail.com
 """
 
-from typing import Dict, Any
-from fastapi import APIRouter
+from typing import Dict, Any, List, Union, Optional
+from fastapi import APIRouter, Depends, Header
 from pydantic import BaseModel
 
-from bfsa.db.environment import client_factory
-from bfsa.sql.create_select import create_select
+from bfsa.db.unit_of_work import UnitOfWork
+from bfsa.db.environment import get_client
+from bfsa.db.patch_operations import PatchOperationModel, create_patch_operations
+from bfsa.sql.create_select import (
+    create_select,
+    create_aggregate,
+    is_point_read,
+    parse_fields,
+)
 from bfsa.utils.return_json import return_json
+from bfsa.utils.return_ndjson import return_ndjson, accepts_ndjson
 from bfsa.utils.create_guid import create_guid
 from bfsa.utils.logger import logger as log
 
@@ -33,22 +41,21 @@ class IngredientUsageModel(BaseModel):
 
 
 @router.post("/api/createIngredientUsage")
-def create_ingredient_usage(
+async def create_ingredient_usage(
     ingredient_usage: IngredientUsageModel,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Add ingredient usage object to database
     """
     log.info("Calling create_ingredient_usage")
 
-    client = client_factory()
-
     ingredient_usage_dict = dict(ingredient_usage)
     ingredient_usage_dict.update({"id": create_guid()})
     ingredient_usage_dict.update({"partitionKey": "ingredient-usage"})
 
     try:
-        success = client.insert_data(
+        success = await client.insert_data(
             [ingredient_usage_dict],
         )
         if not success:
@@ -71,31 +78,39 @@ def create_ingredient_usage(
 
 
 @router.get("/api/readIngredientUsages")
-def read_ingredient_usages(
+async def read_ingredient_usages(
     where: Dict[str, Any] = None,
+    fields: Optional[str] = None,
+    page_size: Optional[int] = None,
+    continuation_token: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Read ingredient usages
     """
     log.info("Calling read_ingredient_usages")
 
-    client = client_factory()
-
     if where is None:
         where = {}
     where.update({"partitionKey": "ingredient-usage"})
 
-    query = create_select(where)
-
     try:
-        data = client.select_data(
-            query=query,
-        )
-        if data:
-            return return_json(
-                message="Successfully selected ingredient usage data.",
-                success=True,
-                content=data,
+        if is_point_read(where):
+            item = await client.get_by_id(
+                item_id=where["id"],
+                partition_key=where["partitionKey"],
+                fields=parse_fields(fields),
+            )
+            data, continuation_token = [item] if item else [], None
+        else:
+            query = create_select(where, fields=parse_fields(fields))
+            if accepts_ndjson(accept):
+                return return_ndjson(client.stream_data(query=query))
+            data, continuation_token = await client.select_page(
+                query=query,
+                page_size=page_size,
+                continuation_token=continuation_token,
             )
     except Exception as e:
         log.critical(f"Failed to select ingredient usage data. Error: {e}")
@@ -104,33 +119,71 @@ def read_ingredient_usages(
             success=False,
         )
 
-    log.critical(f"Failed to select ingredient usage data. Check logs for details.")
     return return_json(
-        message="Failed to select ingredient usage data.",
-        success=False,
+        message="Successfully selected ingredient usage data.",
+        success=True,
+        content=data,
+        continuation_token=continuation_token,
+    )
+
+
+@router.get("/api/aggregateIngredientUsages")
+async def aggregate_ingredient_usages(
+    where: Dict[str, Any] = None,
+    function: str = "count",
+    field: Optional[str] = None,
+    group_by: Optional[str] = None,
+    group_by_prefix: Optional[int] = None,
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Aggregate ingredient usage, e.g. count ingredient usage documents grouped by a field
+    """
+    log.info("Calling aggregate_ingredient_usages")
+
+    if where is None:
+        where = {}
+    where.update({"partitionKey": "ingredient-usage"})
+
+    try:
+        data = await client.aggregate(
+            query=create_aggregate(
+                where,
+                function=function,
+                field=field,
+                group_by=group_by,
+                group_by_prefix=group_by_prefix,
+            ),
+        )
+    except Exception as e:
+        log.critical(f"Failed to aggregate ingredient usage data. Error: {e}")
+        return return_json(
+            message="Failed to aggregate ingredient usage data.",
+            success=False,
+        )
+
+    return return_json(
+        message="Successfully aggregated ingredient usage data.",
+        success=True,
+        content={"aggregate": data},
     )
 
 
 @router.patch("/api/updateIngredientUsage")
-def update_ingredient_usage(
+async def update_ingredient_usage(
     ingredient_usage_id: str,
-    patch: Dict[str, Any],
+    patch: Union[List[PatchOperationModel], Dict[str, Any]],
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Update ingredient usage
     """
     log.info("Calling update_ingredient_usage")
 
-    client = client_factory()
-
-    patch.update({"id": ingredient_usage_id})
-    patch.update({"partitionKey": "ingredient-usage"})
-
     try:
-        success = client.update_data(
+        success = await client.patch_data(
             item={"id": ingredient_usage_id, "partitionKey": "ingredient-usage"},
-            body=patch,
-            upsert=False,
+            operations=create_patch_operations(patch),
         )
         if not success:
             log.critical(f"Failed to update ingredient usage. Check logs for details.")
@@ -152,18 +205,17 @@ def update_ingredient_usage(
 
 
 @router.delete("/api/deleteIngredientUsage")
-def delete_ingredient_usage(
+async def delete_ingredient_usage(
     ingredient_usage_id: str,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Delete ingredient usage
     """
     log.info("Calling delete_ingredient_usage")
 
-    client = client_factory()
-
     try:
-        success = client.delete_data(
+        success = await client.delete_data(
             item=ingredient_usage_id,
             partition_key="ingredient-usage",
         )
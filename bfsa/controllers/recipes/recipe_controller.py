@@ -6,16 +6,24 @@ Created on 2022-07-16
 @email: bennettedmund@gmail.com
 """
 
-from typing import Dict, Any, List
-from io import BytesIO
-from fastapi import APIRouter, UploadFile, File
+from typing import Dict, Any, List, Union, Optional
+from fastapi import APIRouter, UploadFile, File, Depends, Header
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
-from bfsa.db.environment import client_factory
 from bfsa.db.client import get_blob_credentials
-from bfsa.blob.blob_service_client import upload_blob, delete_blob
-from bfsa.sql.create_select import create_select
+from bfsa.db.unit_of_work import UnitOfWork
+from bfsa.db.environment import get_client
+from bfsa.db.patch_operations import PatchOperationModel, create_patch_operations
+from bfsa.blob.content_addressed_storage import store_blob, release_blob
+from bfsa.sql.create_select import (
+    create_select,
+    create_aggregate,
+    is_point_read,
+    parse_fields,
+)
 from bfsa.utils.return_json import return_json
+from bfsa.utils.return_ndjson import return_ndjson, accepts_ndjson
 from bfsa.utils.create_guid import create_guid
 from bfsa.utils.logger import logger as log
 
@@ -39,22 +47,21 @@ class RecipeModel(BaseModel):
 
 
 @router.post("/api/createRecipe")
-def create_recipe(
+async def create_recipe(
     recipe: RecipeModel,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Add recipe object to database
     """
     log.info("Calling create_recipe")
 
-    client = client_factory()
-
     recipe_dict = dict(recipe)
     recipe_dict.update({"id": create_guid()})
     recipe_dict.update({"partitionKey": "recipes"})
 
     try:
-        success = client.insert_data(
+        success = await client.insert_data(
             [recipe_dict],
         )
         if not success:
@@ -76,10 +83,55 @@ def create_recipe(
     )
 
 
+@router.post("/api/createManyRecipes")
+async def create_many_recipes(
+    recipes: List[RecipeModel],
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Add many recipes objects to database concurrently
+    """
+    log.info("Calling create_many_recipes")
+
+    recipe_dicts = []
+    for recipe in recipes:
+        recipe_dict = dict(recipe)
+        recipe_dict.update({"id": create_guid()})
+        recipe_dict.update({"partitionKey": "recipes"})
+        recipe_dicts.append(recipe_dict)
+
+    try:
+        results = await client.bulk_insert_data(
+            recipe_dicts,
+        )
+    except Exception as e:
+        log.critical(f"Failed to insert recipes. Error: {e}")
+        return return_json(
+            message="Failed to insert recipes.",
+            success=False,
+        )
+
+    failures = [result for result in results if not result["success"]]
+    if failures:
+        log.critical(f"Failed to insert {len(failures)} of {len(results)} recipes.")
+        return return_json(
+            message=f"Failed to insert {len(failures)} of {len(results)} recipes.",
+            success=False,
+            content=results,
+        )
+
+    return return_json(
+        message="Successfully inserted recipes.",
+        success=True,
+        content=results,
+    )
+
+
 @router.put("/api/putRecipeImage")
 async def put_recipe_image(
     recipe_id: str,
     image: UploadFile = File(...),
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Put recipe image
@@ -105,22 +157,17 @@ async def put_recipe_image(
             success=False,
         )
 
-    # pre-amble
-
-    client = client_factory()
-
     # insert data - blob first then metadata
 
-    blob_credentials = get_blob_credentials()
+    blob_credentials = await run_in_threadpool(get_blob_credentials)
 
     try:
-        blob_url = upload_blob(
+        blob_url = await store_blob(
+            client=client,
             connection=blob_credentials["credentials"],
             container="recipe-photos",
-            guid=recipe_id,
             filename=image.filename,
-            file=BytesIO(await image.read()),
-            overwrite=True,
+            file=image,
         )
 
     except Exception as e:
@@ -130,47 +177,74 @@ async def put_recipe_image(
             success=False,
         )
 
-    response = read_recipes(where={"id": recipe_id})
-
-    if response["success"]:
-        content = response["content"]
-        if content:
-            recipe_dict = content[0]
-            if "blob_url" in recipe_dict.keys() and recipe_dict["blob_url"] == blob_url:
-                return return_json(
-                    message="Successfully updated recipe image.",
-                    success=True,
-                )
+    if blob_url is None:
+        log.critical(f"Failed to insert recipe image. Check logs for details.")
+        return return_json(
+            message="Failed to insert recipe image.",
+            success=False,
+        )
 
-            recipe_dict.update({"blob_url": blob_url})
+    try:
+        recipe_dict = await client.get_by_id(
+            item_id=recipe_id,
+            partition_key="recipes",
+        )
+    except Exception as e:
+        log.critical(f"Failed to read recipe. Error: {e}")
+        recipe_dict = None
+
+    if recipe_dict:
+        if "blob_url" in recipe_dict.keys() and recipe_dict["blob_url"] == blob_url:
+            # the image is unchanged, so the reference just taken is not needed
+            await release_blob(
+                client=client,
+                connection=blob_credentials["credentials"],
+                container="recipe-photos",
+                url=blob_url,
+            )
+            return return_json(
+                message="Successfully updated recipe image.",
+                success=True,
+            )
 
-            try:
-                cosmos_success = client.update_data(
-                    item={"id": recipe_id, "partitionKey": "recipes"},
-                    body=recipe_dict,
-                    upsert=False,
-                )
-                if not cosmos_success:
-                    log.critical(
-                        f"Failed to insert recipe image. Check logs for details."
-                    )
-
-            except Exception as e:
-                cosmos_success = False
-                log.critical(f"Failed to insert recipe image. Error: {e}")
-
-            if cosmos_success:
-                return return_json(
-                    message="Successfully inserted recipe image.",
-                    success=True,
+        try:
+            # only if the image is unchanged since it was read, so that concurrent
+            # puts never both release the previous image
+            cosmos_success = await client.patch_data(
+                item={"id": recipe_id, "partitionKey": "recipes"},
+                operations=[{"op": "set", "path": "/blob_url", "value": blob_url}],
+                etag=recipe_dict["_etag"],
+            )
+            if not cosmos_success:
+                log.critical(f"Failed to insert recipe image. Check logs for details.")
+
+        except Exception as e:
+            cosmos_success = False
+            log.critical(f"Failed to insert recipe image. Error: {e}")
+
+        if cosmos_success:
+            # the previous image is no longer used by this recipe
+            if recipe_dict.get("blob_url"):
+                await release_blob(
+                    client=client,
+                    connection=blob_credentials["credentials"],
+                    container="recipe-photos",
+                    url=recipe_dict["blob_url"],
                 )
+            return return_json(
+                message="Successfully inserted recipe image.",
+                success=True,
+            )
 
     # Are you still here? Then blob insertion succeeded but Cosmos insertion failed
-    # roll back by deleting blob
+    # roll back by releasing blob
 
     try:
-        response = delete_recipe_image(
-            photo_id=recipe_id,
+        response = await release_blob(
+            client=client,
+            connection=blob_credentials["credentials"],
+            container="recipe-photos",
+            url=blob_url,
         )
         # TODO: indicate whether roll back was successful
         return return_json(
@@ -188,16 +262,18 @@ async def put_recipe_image(
 
 
 @router.delete("/api/deleteRecipeImage")
-def delete_recipe_image(
+async def delete_recipe_image(
     recipe_id: str,
+    client: UnitOfWork = Depends(get_client),
 ):
     log.info("Calling delete_recipe_image")
 
-    blob_credentials = get_blob_credentials()
+    blob_credentials = await run_in_threadpool(get_blob_credentials)
 
     try:
-        recipe_details = read_recipes(
-            where={"id": recipe_id},
+        recipe_details = await client.get_by_id(
+            item_id=recipe_id,
+            partition_key="recipes",
         )
     except Exception as e:
         log.critical(f"Failed to read recipe. Error: {e}")
@@ -206,20 +282,28 @@ def delete_recipe_image(
             success=False,
         )
 
-    try:
-        blob_delete_success = delete_blob(
-            connection=blob_credentials["credentials"],
-            container="recipe-photos",
-            url=recipe_details["content"][0]["blob_url"],
+    if not recipe_details or not recipe_details.get("blob_url"):
+        log.info(f"No recipe image to delete.")
+        return return_json(
+            message="No recipe image to delete.",
+            success=True,
         )
 
-        if not blob_delete_success:
-            log.critical(f"Failed to delete recipe image.")
+    # delete URL to blob from cosmos first, and only if the image is unchanged since it
+    # was read, so that the blob is released once however often this is retried
+
+    try:
+        success = await client.patch_data(
+            item={"id": recipe_id, "partitionKey": "recipes"},
+            operations=[{"op": "set", "path": "/blob_url", "value": None}],
+            etag=recipe_details["_etag"],
+        )
+        if not success:
+            log.critical(f"Failed to delete recipe image. Check logs for details.")
             return return_json(
                 message="Failed to delete recipe image.",
                 success=False,
             )
-
     except Exception as e:
         log.critical(f"Failed to delete recipe image. Error: {e}")
         return return_json(
@@ -227,17 +311,27 @@ def delete_recipe_image(
             success=False,
         )
 
-    # blob deleted, now delete URL to blob from cosmos
-
-    recipe_details.update({"blob_url": None})
-
     try:
-        update_recipe(
-            recipe_id,
-            recipe_details,
+        blob_delete_success = await release_blob(
+            client=client,
+            connection=blob_credentials["credentials"],
+            container="recipe-photos",
+            url=recipe_details["blob_url"],
         )
+
+        if not blob_delete_success:
+            log.critical(
+                f"Failed to delete recipe image. Check blob storage for orphaned blobs."
+            )
+            return return_json(
+                message="Failed to delete recipe image.",
+                success=False,
+            )
+
     except Exception as e:
-        log.critical(f"Failed to delete recipe image. Error: {e}")
+        log.critical(
+            f"Failed to delete recipe image. Check blob storage for orphaned blobs. Error: {e}"
+        )
         return return_json(
             message="Failed to delete recipe image.",
             success=False,
@@ -250,31 +344,39 @@ def delete_recipe_image(
 
 
 @router.get("/api/readRecipes")
-def read_recipes(
+async def read_recipes(
     where: Dict[str, Any] = None,
+    fields: Optional[str] = None,
+    page_size: Optional[int] = None,
+    continuation_token: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Read recipes
     """
     log.info("Calling read_recipes")
 
-    client = client_factory()
-
     if where is None:
         where = {}
     where.update({"partitionKey": "recipes"})
 
-    query = create_select(where)
-
     try:
-        data = client.select_data(
-            query=query,
-        )
-        if data:
-            return return_json(
-                message="Successfully selected recipe data.",
-                success=True,
-                content=data,
+        if is_point_read(where):
+            item = await client.get_by_id(
+                item_id=where["id"],
+                partition_key=where["partitionKey"],
+                fields=parse_fields(fields),
+            )
+            data, continuation_token = [item] if item else [], None
+        else:
+            query = create_select(where, fields=parse_fields(fields))
+            if accepts_ndjson(accept):
+                return return_ndjson(client.stream_data(query=query))
+            data, continuation_token = await client.select_page(
+                query=query,
+                page_size=page_size,
+                continuation_token=continuation_token,
             )
     except Exception as e:
         log.critical(f"Failed to select recipe data. Error: {e}")
@@ -283,33 +385,71 @@ def read_recipes(
             success=False,
         )
 
-    log.critical(f"Failed to select recipe data. Check logs for details.")
     return return_json(
-        message="Failed to select recipe data.",
-        success=False,
+        message="Successfully selected recipe data.",
+        success=True,
+        content=data,
+        continuation_token=continuation_token,
+    )
+
+
+@router.get("/api/aggregateRecipes")
+async def aggregate_recipes(
+    where: Dict[str, Any] = None,
+    function: str = "count",
+    field: Optional[str] = None,
+    group_by: Optional[str] = None,
+    group_by_prefix: Optional[int] = None,
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Aggregate recipe, e.g. count recipe documents grouped by a field
+    """
+    log.info("Calling aggregate_recipes")
+
+    if where is None:
+        where = {}
+    where.update({"partitionKey": "recipes"})
+
+    try:
+        data = await client.aggregate(
+            query=create_aggregate(
+                where,
+                function=function,
+                field=field,
+                group_by=group_by,
+                group_by_prefix=group_by_prefix,
+            ),
+        )
+    except Exception as e:
+        log.critical(f"Failed to aggregate recipe data. Error: {e}")
+        return return_json(
+            message="Failed to aggregate recipe data.",
+            success=False,
+        )
+
+    return return_json(
+        message="Successfully aggregated recipe data.",
+        success=True,
+        content={"aggregate": data},
     )
 
 
 @router.patch("/api/updateRecipe")
-def update_recipe(
+async def update_recipe(
     recipe_id: str,
-    patch: Dict[str, Any],
+    patch: Union[List[PatchOperationModel], Dict[str, Any]],
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Update recipe
     """
     log.info("Calling update_recipe")
 
-    client = client_factory()
-
-    patch.update({"id": recipe_id})
-    patch.update({"partitionKey": "recipes"})
-
     try:
-        success = client.update_data(
+        success = await client.patch_data(
             item={"id": recipe_id, "partitionKey": "recipes"},
-            body=patch,
-            upsert=False,
+            operations=create_patch_operations(patch),
         )
         if not success:
             log.critical(f"Failed to update recipe. Check logs for details.")
@@ -331,22 +471,22 @@ def update_recipe(
 
 
 @router.delete("/api/deleteRecipe")
-def delete_recipe(
+async def delete_recipe(
     recipe_id: str,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Delete recipe
     """
     log.info("Calling delete_recipe")
 
-    client = client_factory()
-
-    response = delete_recipe_image(
+    response = await delete_recipe_image(
         recipe_id=recipe_id,
+        client=client,
     )
 
     try:
-        success = client.delete_data(
+        success = await client.delete_data(
             item=recipe_id,
             partition_key="recipes",
         )
@@ -6,9 +6,10 @@ Created on 2022-07-16
 @email: bennettedmund@gmail.com
 """
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 
-from bfsa.db.environment import client_factory
+from bfsa.db.unit_of_work import UnitOfWork
+from bfsa.db.environment import get_client
 from bfsa.sql.create_select import create_select
 from bfsa.utils.return_json import return_json
 from bfsa.utils.logger import logger as log
@@ -18,37 +19,32 @@ router = APIRouter()
 
 
 @router.get("/api/readRecipeDetails")
-def read_recipe_details(
+async def read_recipe_details(
     recipe_id: str,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Read recipe details
     """
     log.info("Calling read_recipe_details")
 
-    client = client_factory()
-
     # get recipe
 
     data = {}
 
     try:
-        recipes = client.select_data(
-            query=create_select(
-                {
-                    "id": recipe_id,
-                    "partitionKey": "recipes",
-                }
-            ),
+        recipe = await client.get_by_id(
+            item_id=recipe_id,
+            partition_key="recipes",
         )
-        if recipes:
+        if recipe:
 
-            data.update({"recipe": recipes[0]})
+            data.update({"recipe": recipe})
 
             # get recipe steps
 
             try:
-                recipe_steps = client.select_data(
+                recipe_steps = await client.select_data(
                     query=create_select(
                         {
                             "recipe_id": recipe_id,
@@ -71,7 +67,7 @@ def read_recipe_details(
             # get ingredients
 
             try:
-                ingredients = client.select_data(
+                ingredients = await client.select_data(
                     query=create_select(
                         {
                             "partitionKey": "ingredients",
@@ -93,7 +89,7 @@ def read_recipe_details(
             # get equipment
 
             try:
-                equipment = client.select_data(
+                equipment = await client.select_data(
                     query=create_select(
                         {
                             "partitionKey": "equipment",
@@ -113,23 +109,21 @@ def read_recipe_details(
                 )
 
             ingredient_usages, equipment_usages = [], []
-            for recipe_step in recipe_steps:
+            recipe_step_ids = [recipe_step["id"] for recipe_step in recipe_steps]
+            if recipe_step_ids:
 
-                # for each step get ingredient usages
+                # get ingredient usages for all steps at once
 
                 try:
-                    ingredient_usage = client.select_data(
+                    ingredient_usages = await client.select_data(
                         query=create_select(
                             {
-                                "recipe_step_id": recipe_step["id"],
+                                "recipe_step_id": recipe_step_ids,
                                 "partitionKey": "ingredient-usage",
                             }
                         ),
                     )
 
-                    if ingredient_usage:
-                        ingredient_usages += ingredient_usage
-
                 except Exception as e:
                     log.critical(f"Failed to select ingredient usage data. Error: {e}")
                     return return_json(
@@ -137,21 +131,18 @@ def read_recipe_details(
                         success=False,
                     )
 
-                # for each step get equipment usage
+                # get equipment usage for all steps at once
 
                 try:
-                    equipment_usage = client.select_data(
+                    equipment_usages = await client.select_data(
                         query=create_select(
                             {
-                                "recipe_step_id": recipe_step["id"],
+                                "recipe_step_id": recipe_step_ids,
                                 "partitionKey": "equipment-usage",
                             }
                         ),
                     )
 
-                    if equipment_usage:
-                        equipment_usages += equipment_usage
-
                 except Exception as e:
                     log.critical(f"Failed to select equipment usage data. Error: {e}")
                     return return_json(
@@ -6,13 +6,21 @@ Created on 2022-07-16
 @email: bennettedmund@gmail.com
 """
 
-from typing import Dict, Any, List, Optional
-from fastapi import APIRouter
+from typing import Dict, Any, List, Optional, Union
+from fastapi import APIRouter, Depends, Header
 from pydantic import BaseModel
 
-from bfsa.db.environment import client_factory
-from bfsa.sql.create_select import create_select
+from bfsa.db.unit_of_work import UnitOfWork
+from bfsa.db.environment import get_client
+from bfsa.db.patch_operations import PatchOperationModel, create_patch_operations
+from bfsa.sql.create_select import (
+    create_select,
+    create_aggregate,
+    is_point_read,
+    parse_fields,
+)
 from bfsa.utils.return_json import return_json
+from bfsa.utils.return_ndjson import return_ndjson, accepts_ndjson
 from bfsa.utils.create_guid import create_guid
 from bfsa.utils.logger import logger as log
 
@@ -35,22 +43,21 @@ class RecipeStepModel(BaseModel):
 
 
 @router.post("/api/createRecipeStep")
-def create_recipe_step(
+async def create_recipe_step(
     recipe_step: RecipeStepModel,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Add recipe step object to database
     """
     log.info("Calling create_recipe_step")
 
-    client = client_factory()
-
     recipe_step_dict = dict(recipe_step)
     recipe_step_dict.update({"id": create_guid()})
     recipe_step_dict.update({"partitionKey": "recipe-steps"})
 
     try:
-        success = client.insert_data(
+        success = await client.insert_data(
             [recipe_step_dict],
         )
         if not success:
@@ -73,31 +80,39 @@ def create_recipe_step(
 
 
 @router.get("/api/readRecipeSteps")
-def read_recipe_steps(
+async def read_recipe_steps(
     where: Dict[str, Any] = None,
+    fields: Optional[str] = None,
+    page_size: Optional[int] = None,
+    continuation_token: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Read recipe steps
     """
     log.info("Calling read_recipe_steps")
 
-    client = client_factory()
-
     if where is None:
         where = {}
     where.update({"partitionKey": "recipe-steps"})
 
-    query = create_select(where)
-
     try:
-        data = client.select_data(
-            query=query,
-        )
-        if data:
-            return return_json(
-                message="Successfully selected recipe_step data.",
-                success=True,
-                content=data,
+        if is_point_read(where):
+            item = await client.get_by_id(
+                item_id=where["id"],
+                partition_key=where["partitionKey"],
+                fields=parse_fields(fields),
+            )
+            data, continuation_token = [item] if item else [], None
+        else:
+            query = create_select(where, fields=parse_fields(fields))
+            if accepts_ndjson(accept):
+                return return_ndjson(client.stream_data(query=query))
+            data, continuation_token = await client.select_page(
+                query=query,
+                page_size=page_size,
+                continuation_token=continuation_token,
             )
     except Exception as e:
         log.critical(f"Failed to select recipe_step data. Error: {e}")
@@ -106,33 +121,71 @@ def read_recipe_steps(
             success=False,
         )
 
-    log.critical(f"Failed to select recipe_step data. Check logs for details.")
     return return_json(
-        message="Failed to select recipe_step data.",
-        success=False,
+        message="Successfully selected recipe_step data.",
+        success=True,
+        content=data,
+        continuation_token=continuation_token,
+    )
+
+
+@router.get("/api/aggregateRecipeSteps")
+async def aggregate_recipe_steps(
+    where: Dict[str, Any] = None,
+    function: str = "count",
+    field: Optional[str] = None,
+    group_by: Optional[str] = None,
+    group_by_prefix: Optional[int] = None,
+    client: UnitOfWork = Depends(get_client),
+):
+    """
+    Aggregate recipe step, e.g. count recipe step documents grouped by a field
+    """
+    log.info("Calling aggregate_recipe_steps")
+
+    if where is None:
+        where = {}
+    where.update({"partitionKey": "recipe-steps"})
+
+    try:
+        data = await client.aggregate(
+            query=create_aggregate(
+                where,
+                function=function,
+                field=field,
+                group_by=group_by,
+                group_by_prefix=group_by_prefix,
+            ),
+        )
+    except Exception as e:
+        log.critical(f"Failed to aggregate recipe step data. Error: {e}")
+        return return_json(
+            message="Failed to aggregate recipe step data.",
+            success=False,
+        )
+
+    return return_json(
+        message="Successfully aggregated recipe step data.",
+        success=True,
+        content={"aggregate": data},
     )
 
 
 @router.patch("/api/updateRecipeStep")
-def update_recipe_step(
+async def update_recipe_step(
     recipe_step_id: str,
-    patch: Dict[str, Any],
+    patch: Union[List[PatchOperationModel], Dict[str, Any]],
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Update recipe step
     """
     log.info("Calling update_recipe_step")
 
-    client = client_factory()
-
-    patch.update({"id": recipe_step_id})
-    patch.update({"partitionKey": "recipe-steps"})
-
     try:
-        success = client.update_data(
+        success = await client.patch_data(
             item={"id": recipe_step_id, "partitionKey": "recipe-steps"},
-            body=patch,
-            upsert=False,
+            operations=create_patch_operations(patch),
         )
         if not success:
             log.critical(f"Failed to update recipe_step. Check logs for details.")
@@ -154,18 +207,17 @@ def update_recipe_step(
 
 
 @router.delete("/api/deleteRecipeStep")
-def delete_recipe_step(
+async def delete_recipe_step(
     recipe_step_id: str,
+    client: UnitOfWork = Depends(get_client),
 ):
     """
     Delete recipe step
     """
     log.info("Calling delete_recipe")
 
-    client = client_factory()
-
     try:
-        success = client.delete_data(
+        success = await client.delete_data(
             item=recipe_step_id,
             partition_key="recipe-steps",
         )
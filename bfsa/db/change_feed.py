@@ -0,0 +1,129 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-22
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from typing import List, Dict, Any, Callable, Awaitable, Optional, Union
+from asyncio import Task, CancelledError, create_task, sleep
+from collections import defaultdict
+from inspect import isawaitable
+
+from bfsa.db.environment import client_manager
+from bfsa.db.throttling import background_priority
+from bfsa.utils.logger import logger as log
+
+
+Subscriber = Callable[[str, List[Dict[str, Any]]], Union[None, Awaitable[None]]]
+
+
+class ChangeFeedPublisher:
+    """
+    In-process publish/subscribe of document changes, grouped by partitionKey.
+    Subscribers are called with the partition key and the documents changed in it,
+    and may be plain or async functions
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[Optional[str], List[Subscriber]] = defaultdict(list)
+
+    def subscribe(
+        self,
+        subscriber: Subscriber,
+        partition_key: Optional[str] = None,
+    ) -> Callable[[], None]:
+        """
+        :param subscriber:
+        :param partition_key: partition to receive changes for, or None for every partition
+        :return: function removing the subscription
+        """
+        self._subscribers[partition_key].append(subscriber)
+        return lambda: self._subscribers[partition_key].remove(subscriber)
+
+    async def publish(self, changes: List[Dict[str, Any]]) -> None:
+        partitions = defaultdict(list)
+        for change in changes:
+            partitions[change.get("partitionKey")].append(change)
+
+        for partition_key, documents in partitions.items():
+            for subscriber in (
+                self._subscribers[partition_key] + self._subscribers[None]
+            ):
+                try:
+                    result = subscriber(partition_key, documents)
+                    if isawaitable(result):
+                        await result
+                except Exception as e:
+                    # one failing subscriber must not starve the others
+                    log.error(
+                        f"Change feed subscriber failed on partition {partition_key}. Error: {e}"
+                    )
+
+
+class ChangeFeedProcessor:
+    """
+    Background task polling the container's change feed and publishing what it reads.
+    Starts from the current point in the feed, so only changes made while the server
+    runs are published. Deletes do not appear in the change feed
+    """
+
+    POLL_INTERVAL_IN_SECONDS = 5.0
+    ERROR_BACKOFF_IN_SECONDS = 30.0
+
+    def __init__(self, get_client, publisher: ChangeFeedPublisher):
+        self.get_client = get_client
+        self.publisher = publisher
+        self.continuation: Optional[str] = None
+        self._task: Optional[Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            log.info("Calling ChangeFeedProcessor.start")
+            self._task = create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            log.info("Calling ChangeFeedProcessor.stop")
+            self._task.cancel()
+            try:
+                await self._task
+            except CancelledError:
+                pass
+            self._task = None
+
+    async def poll(self) -> int:
+        """
+        Reads and publishes the changes made since the last poll
+        :return: number of changed documents
+        """
+        client = await self.get_client()
+        changes, self.continuation = await client.read_changes(
+            continuation=self.continuation,
+        )
+        if changes:
+            await self.publisher.publish(changes)
+        return len(changes)
+
+    async def _run(self) -> None:
+        # polling is background work, so it never delays interactive requests
+        with background_priority():
+            while True:
+                try:
+                    await self.poll()
+                    await sleep(ChangeFeedProcessor.POLL_INTERVAL_IN_SECONDS)
+                except Exception as e:
+                    log.error(f"Error reading change feed. Error: {e}")
+                    await sleep(ChangeFeedProcessor.ERROR_BACKOFF_IN_SECONDS)
+
+
+change_feed_publisher = ChangeFeedPublisher()
+change_feed_processor = ChangeFeedProcessor(
+    client_manager.get_client,
+    change_feed_publisher,
+)
+
+
+if __name__ == "__main__":
+    pass
@@ -6,18 +6,54 @@ Created on 2022-06-26
 @email: bennettedmund@gmail.com
 """
 
-from typing import List, Dict, Any, Union
+from typing import (
+    List,
+    Dict,
+    Any,
+    Union,
+    Optional,
+    Tuple,
+    AsyncIterator,
+    Mapping,
+    Callable,
+    Awaitable,
+)
+from asyncio import Semaphore, gather
+from collections import defaultdict
+from functools import lru_cache, wraps
 from json import load
-from azure.cosmos import CosmosClient, PartitionKey
+from azure.core import MatchConditions
+from azure.core.exceptions import ServiceRequestError
+from azure.cosmos import PartitionKey
+from azure.cosmos.aio import CosmosClient
+from azure.cosmos.exceptions import (
+    CosmosHttpResponseError,
+    CosmosBatchOperationError,
+    CosmosResourceNotFoundError,
+)
 
 from bfsa.controllers.environment import Environment
+from bfsa.db.metrics import OperationRecorder
+from bfsa.db.patch_operations import create_patch_operations
+from bfsa.db.query_cache import QueryCache
+from bfsa.db.throttling import (
+    RequestUnitBudget,
+    ThrottlingRetryPolicy,
+    background_priority,
+)
+from bfsa.sql.create_select import create_select
+from bfsa.sql.query_builder import project, target_partition_key
 from bfsa.utils.get_vault_secret import get_vault_secret
 
 
 environment = Environment()
 
 
+@lru_cache(maxsize=1)
 def get_blob_credentials():
+    """
+    Reads the blob storage configuration and connection string, once per process
+    """
     with open("credentials/blob_config.json", "r") as credentials_file:
         blob_credentials = load(credentials_file)
 
@@ -28,11 +64,70 @@ def get_blob_credentials():
     return blob_credentials
 
 
+def _mark_stale_on_connection_error(method):
+    """
+    Flags the client as stale when the connection drops or the key is rejected,
+    so that the owning ClientManager reconnects on the next request
+    """
+
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        try:
+            return await method(self, *args, **kwargs)
+        except ServiceRequestError:
+            self.stale = True
+            raise
+        except CosmosHttpResponseError as e:
+            if e.status_code == 401:
+                self.stale = True
+            raise
+
+    return wrapper
+
+
+async def retry_on_conflict(
+    attempt: Callable[[], Awaitable[Any]],
+    max_attempts: int,
+) -> Any:
+    """
+    Runs an optimistic read-modify-write attempt, running it again while it fails
+    because the document changed after it was read (412 precondition failed). A failed
+    transactional batch reports the status of the operation that failed
+    """
+    for i in range(max_attempts):
+        try:
+            return await attempt()
+        except (CosmosHttpResponseError, CosmosBatchOperationError) as e:
+            if e.status_code != 412 or i == max_attempts - 1:
+                raise
+
+
+def _item_result(
+    payload: Dict[str, Any],
+    success: bool,
+    error: Optional[Exception] = None,
+) -> Dict[str, Any]:
+    return {
+        "id": payload.get("id"),
+        "success": success,
+        "status_code": getattr(error, "status_code", None),
+        "error": None if error is None else str(error),
+    }
+
+
 class Client:
     """
-    Client to connect to backend database and manage interactions
+    Asynchronous client to connect to backend database and manage interactions
     """
 
+    PROVISIONED_THROUGHPUT = 400
+    MAX_BATCH_OPERATIONS = 100
+    READ_OPERATIONS = {"read_item"}
+    MAX_PATCH_OPERATIONS = 10
+    DEFAULT_MAX_CONCURRENCY = 10
+    MAX_READ_MANY_IDS = 100
+    MAX_CONFLICT_RETRIES = 5
+
     def __init__(
         self,
         endpoint: str,
@@ -40,93 +135,559 @@ class Client:
         database_name: str,
         container_name: str,
         partition_key_field: str = "partitionKey",
+        request_units_per_second: Optional[float] = None,
+        cache: Optional[QueryCache] = None,
     ):
+        self.stale = False
+        self.cache = cache
+        self.database_name = database_name
+        self.container_name = container_name
+        self.partition_key_field = partition_key_field
         self.client = CosmosClient(
             url=endpoint,
             credential=key,
         )
-        self.database = self.client.create_database_if_not_exists(id=database_name)
-        self.container = self.database.create_container_if_not_exists(
-            id=container_name,
-            partition_key=PartitionKey(path=f"/{partition_key_field}"),
-            offer_throughput=400,
+        self.database = self.client.get_database_client(database_name)
+        self.container = self.database.get_container_client(container_name)
+        self.budget = RequestUnitBudget(
+            request_units_per_second or Client.PROVISIONED_THROUGHPUT
         )
+        self.retry_policy = ThrottlingRetryPolicy(self.budget)
 
-    def insert_data(self, payloads: List[Dict[str, Any]]) -> bool:
+    async def provision(self) -> None:
+        """
+        Creates the database and container if they do not exist
+        :return:
+        """
+        self.database = await self.client.create_database_if_not_exists(
+            id=self.database_name
+        )
+        self.container = await self.database.create_container_if_not_exists(
+            id=self.container_name,
+            partition_key=PartitionKey(path=f"/{self.partition_key_field}"),
+            offer_throughput=Client.PROVISIONED_THROUGHPUT,
+        )
+
+    async def close(self) -> None:
+        """
+        Closes the underlying connection pool
+        :return:
+        """
+        await self.client.close()
+
+    def _last_response_headers(self) -> Mapping[str, str]:
+        return self.container.client_connection.last_response_headers
+
+    @staticmethod
+    def _match_condition(etag: Optional[str]) -> Dict[str, Any]:
+        if etag is None:
+            return {}
+        return {"etag": etag, "match_condition": MatchConditions.IfNotModified}
+
+    async def _execute(
+        self,
+        call: Callable[..., Awaitable[Any]],
+        *args,
+        items: int = 1,
+        **kwargs,
+    ) -> Any:
+        """
+        Awaits a single SDK call within the request unit budget, retrying it while it is
+        throttled and recording its request charge and latency
+        :param call: bound container method, e.g. self.container.read_item
+        :param items: number of documents the call touches
+        :return: result of the call
+        """
+        operation = call.__name__
+
+        async def attempt():
+            await self.budget.acquire(operation)
+            recorder = OperationRecorder(operation)
+            try:
+                with recorder:
+                    result = await call(*args, **kwargs)
+                    recorder.add_response(self._last_response_headers(), items=items)
+            finally:
+                self.budget.settle(operation, recorder.request_charge)
+            return result
+
+        try:
+            return await self.retry_policy.run(attempt)
+        finally:
+            # every write goes through here, so cached results are invalidated in one place
+            if self.cache is not None and operation not in Client.READ_OPERATIONS:
+                self.cache.invalidate(
+                    kwargs.get(
+                        "partition_key",
+                        (kwargs.get("body") or {}).get(self.partition_key_field),
+                    )
+                )
+
+    async def _fetch_page(
+        self,
+        pages,
+        recorder: OperationRecorder,
+    ) -> Optional[List[Dict[str, Any]]]:
+        """
+        Fetches the next page of a query within the request unit budget, retrying it
+        while it is throttled. A failed page leaves the continuation token untouched,
+        so the same page is requested again
+        :param pages: page iterator returned by query_items(...).by_page()
+        :param recorder: recorder of the query the page belongs to
+        :return: documents, or None when there are no more pages
+        """
+
+        async def attempt():
+            await self.budget.acquire(recorder.operation)
+            request_charge = recorder.request_charge
+            try:
+                page = await pages.__anext__()
+                items = [item async for item in page]
+                recorder.add_response(self._last_response_headers(), items=len(items))
+                return items
+            except StopAsyncIteration:
+                return None
+            finally:
+                self.budget.settle(
+                    recorder.operation, recorder.request_charge - request_charge
+                )
+
+        return await self.retry_policy.run(attempt)
+
+    async def insert_data(self, payloads: List[Dict[str, Any]]) -> bool:
         """
         Inserts data into collection
         :param payloads:
         :return: boolean indicating success or failure
         """
-        for payload in payloads:
-            self.container.create_item(body=payload)
-        return True
+        if len(payloads) == 1:
+            await self._create_item(payloads[0])
+            return True
+
+        results = await self.bulk_insert_data(payloads)
+        return all(result["success"] for result in results)
+
+    @_mark_stale_on_connection_error
+    async def _create_item(self, payload: Dict[str, Any]) -> None:
+        await self._execute(self.container.create_item, body=payload)
+
+    @_mark_stale_on_connection_error
+    async def bulk_insert_data(
+        self,
+        payloads: List[Dict[str, Any]],
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    ) -> List[Dict[str, Any]]:
+        """
+        Inserts data into collection concurrently. Payloads sharing a partition key are
+        written as transactional batches, falling back to single writes if a batch fails
+        :param payloads:
+        :param max_concurrency: maximum number of requests in flight at once
+        :return: list of per-item results, in the same order as payloads
+        """
+        semaphore = Semaphore(max_concurrency)
+        results: List[Optional[Dict[str, Any]]] = [None] * len(payloads)
+
+        async def create_one(index: int) -> None:
+            async with semaphore:
+                try:
+                    await self._execute(
+                        self.container.create_item, body=payloads[index]
+                    )
+                    results[index] = _item_result(payloads[index], True)
+                except CosmosHttpResponseError as e:
+                    results[index] = _item_result(payloads[index], False, e)
 
-    def select_data(self, query):
+        async def create_batch(partition_key: str, indices: List[int]) -> None:
+            async with semaphore:
+                try:
+                    await self._execute(
+                        self.container.execute_item_batch,
+                        items=len(indices),
+                        batch_operations=[
+                            ("create", (payloads[index],)) for index in indices
+                        ],
+                        partition_key=partition_key,
+                    )
+                    for index in indices:
+                        results[index] = _item_result(payloads[index], True)
+                    return
+                except (CosmosBatchOperationError, CosmosHttpResponseError):
+                    pass
+
+            # batches are all-or-nothing, so retry singly to find out which items failed
+            await gather(*[create_one(index) for index in indices])
+
+        partitions = defaultdict(list)
+        for index, payload in enumerate(payloads):
+            partitions[payload.get(self.partition_key_field)].append(index)
+
+        tasks = []
+        for partition_key, indices in partitions.items():
+            if partition_key is None or len(indices) == 1:
+                tasks += [create_one(index) for index in indices]
+                continue
+            for i in range(0, len(indices), Client.MAX_BATCH_OPERATIONS):
+                tasks.append(
+                    create_batch(
+                        partition_key,
+                        indices[i : i + Client.MAX_BATCH_OPERATIONS],
+                    )
+                )
+
+        # tasks inherit the lane, so bulk inserts never starve interactive requests
+        with background_priority():
+            await gather(*tasks)
+
+        return results
+
+    @_mark_stale_on_connection_error
+    async def select_data(self, query):
         """
         Selects data from collection
         :param query:
         :return:
         """
-        items = list(
-            self.container.query_items(
+        if self.cache is not None:
+            cached = self.cache.get(query)
+            if cached is not None:
+                with OperationRecorder("query_items_cached") as recorder:
+                    recorder.items = len(cached)
+                return cached
+            generation = self.cache.generation(QueryCache.key(query)[1])
+
+        items = []
+        with OperationRecorder("query_items") as recorder:
+            pages = self.container.query_items(
                 query=query,
-                enable_cross_partition_query=True,
-            )
-        )
+                partition_key=target_partition_key(query),
+            ).by_page()
+            while True:
+                page = await self._fetch_page(pages, recorder)
+                if page is None:
+                    break
+                items += page
+
+        if self.cache is not None:
+            self.cache.put(query, items, generation)
 
         return items
 
-    def delete_data(
+    async def aggregate(self, query) -> Any:
+        """
+        Runs an aggregate query, see bfsa.sql.create_select.create_aggregate
+        :param query:
+        :return: single value for ungrouped aggregates (None when nothing matched),
+            otherwise rows holding bucket and result
+        """
+        items = await self.select_data(query=query)
+        if query["query"].startswith("SELECT VALUE"):
+            return items[0] if items else None
+        return items
+
+    async def stream_data(self, query) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Yields documents from collection as each page arrives, without materialising the
+        full result set
+        :param query:
+        :return: asynchronous iterator of documents
+        """
+        try:
+            with OperationRecorder("stream_items") as recorder:
+                pages = self.container.query_items(
+                    query=query,
+                    partition_key=target_partition_key(query),
+                ).by_page()
+                while True:
+                    page = await self._fetch_page(pages, recorder)
+                    if page is None:
+                        break
+                    for item in page:
+                        yield item
+        except ServiceRequestError:
+            self.stale = True
+            raise
+
+    @_mark_stale_on_connection_error
+    async def read_changes(
+        self,
+        continuation: Optional[str] = None,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Reads documents created or updated since continuation, in modification order
+        :param continuation: token returned by the previous call, or None to start from now
+        :return: changed documents, and continuation for the next call
+        """
+        responses = []
+
+        async def attempt():
+            responses.clear()
+            await self.budget.acquire("read_changes")
+            recorder = OperationRecorder("read_changes")
+            try:
+                with recorder:
+                    changes = [
+                        item
+                        async for item in self.container.query_items_change_feed(
+                            continuation=continuation,
+                            response_hook=lambda headers, _: responses.append(headers),
+                        )
+                    ]
+                    # the hook is also called once, with stale headers, before any request
+                    for headers in responses[1:]:
+                        recorder.add_response(headers)
+                    recorder.items = len(changes)
+            finally:
+                self.budget.settle("read_changes", recorder.request_charge)
+
+            # the etag of the last response marks the point the feed has been read to
+            if len(responses) > 1:
+                return changes, responses[-1].get("etag") or continuation
+            return changes, continuation
+
+        return await self.retry_policy.run(attempt)
+
+    @_mark_stale_on_connection_error
+    async def select_page(
+        self,
+        query,
+        page_size: Optional[int] = None,
+        continuation_token: Optional[str] = None,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Selects a single page of data from collection
+        :param query:
+        :param page_size: maximum number of documents to return. If None, all documents are returned
+        :param continuation_token: token returned with the previous page, or None for the first page
+        :return: documents, and continuation token for the next page (None on the last page)
+        """
+        if page_size is None:
+            return await self.select_data(query=query), None
+
+        pages = self.container.query_items(
+            query=query,
+            partition_key=target_partition_key(query),
+            max_item_count=page_size,
+        ).by_page(continuation_token)
+
+        with OperationRecorder("query_page") as recorder:
+            items = await self._fetch_page(pages, recorder)
+
+        if items is None:
+            return [], None
+
+        return items, pages.continuation_token
+
+    @_mark_stale_on_connection_error
+    async def get_by_id(
+        self,
+        item_id: str,
+        partition_key: str,
+        fields: Optional[List[str]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Reads a single document by id and partition key (point read)
+        :param item_id:
+        :param partition_key:
+        :param fields: fields to project. If None, the whole document is returned
+        :return: document, or None if it does not exist
+        """
+        try:
+            item = await self._execute(
+                self.container.read_item,
+                item=item_id,
+                partition_key=partition_key,
+            )
+        except CosmosResourceNotFoundError:
+            return None
+
+        return project(item, fields)
+
+    async def read_many(
+        self,
+        items: List[Dict[str, str]],
+        fields: Optional[List[str]] = None,
+        max_concurrency: Optional[int] = None,
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Reads many documents by id. Ids are grouped by partition key and each group is
+        read by a single-partition query of up to MAX_READ_MANY_IDS ids, with the groups
+        read concurrently. A lone id is read by a point read instead
+        :param items: dictionaries holding id and partitionKey of each document
+        :param fields: fields to project. If None, whole documents are returned
+        :param max_concurrency: maximum number of queries in flight
+        :return: documents in the order requested, None for those that do not exist
+        """
+        if len(items) == 1:
+            return [
+                await self.get_by_id(
+                    item_id=items[0]["id"],
+                    partition_key=items[0]["partitionKey"],
+                    fields=fields,
+                )
+            ]
+
+        # dictionaries rather than sets, so that ids keep the order requested
+        partitions = defaultdict(dict)
+        for item in items:
+            partitions[item["partitionKey"]][item["id"]] = None
+
+        # ids are needed to match documents to requests, so are always selected
+        query_fields = fields
+        if fields and "id" not in fields:
+            query_fields = list(fields) + ["id"]
+
+        found = {}
+        semaphore = Semaphore(max_concurrency or Client.DEFAULT_MAX_CONCURRENCY)
+
+        async def read_ids(partition_key: str, ids: List[str]) -> None:
+            async with semaphore:
+                documents = await self.select_data(
+                    query=create_select(
+                        {"partitionKey": partition_key, "id": {"in": ids}},
+                        fields=query_fields,
+                    ),
+                )
+            for document in documents:
+                found[(partition_key, document["id"])] = document
+
+        tasks = []
+        for partition_key, ids in partitions.items():
+            ids = list(ids)
+            for i in range(0, len(ids), Client.MAX_READ_MANY_IDS):
+                tasks.append(
+                    read_ids(partition_key, ids[i : i + Client.MAX_READ_MANY_IDS])
+                )
+        await gather(*tasks)
+
+        results = []
+        for item in items:
+            document = found.get((item["partitionKey"], item["id"]))
+            if document is not None and query_fields is not fields:
+                document = {k: v for k, v in document.items() if k != "id"}
+            results.append(document)
+        return results
+
+    @_mark_stale_on_connection_error
+    async def delete_data(
         self,
         item: Union[Dict[str, Any], str],
         partition_key: str,
+        etag: Optional[str] = None,
     ):
         """
         Removes single document from collection
         :param query:
+        :param etag: only delete the document if it is still at this version (_etag)
         :return:
         """
 
-        self.container.delete_item(
+        await self._execute(
+            self.container.delete_item,
             item=item,
             partition_key=partition_key,
+            **Client._match_condition(etag),
         )
         return True
 
-    def update_data(
+    @_mark_stale_on_connection_error
+    async def update_data(
         self,
         item: Dict[str, Any],
         body: Dict[str, Any],
         upsert: bool = True,
+        patch: bool = False,
+        etag: Optional[str] = None,
     ):
         """
         Updates data in collection
         :param query:
         :param payload:
+        :param patch: send the top-level fields of body as server-side set operations
+        :param etag: only update the document if it is still at this version (_etag).
+            Without it, a merge (upsert=False) is applied to the latest version of the
+            document, re-reading it if another writer updates it first
         :return:
         """
 
+        if patch:
+            return await self.patch_data(
+                item=item,
+                operations=create_patch_operations(body),
+                etag=etag,
+            )
+
         if upsert:
-            self.container.upsert_item(
+            await self._execute(
+                self.container.upsert_item,
                 body=body,
+                **Client._match_condition(etag),
             )
-        else:
+            return True
 
-            doc = list(
-                self.container.query_items(
-                    query=f"SELECT * FROM c WHERE c.id = '{item['id']}' AND c.partitionKey = '{item['partitionKey']}'",
-                    enable_cross_partition_query=False,
-                )
+        async def merge():
+            payload = await self.get_by_id(
+                item_id=item["id"],
+                partition_key=item["partitionKey"],
             )
 
-            if doc:
-                payload = doc[0]
+            if payload:
                 payload.update(body)
-                self.container.replace_item(
+                await self._execute(
+                    self.container.replace_item,
                     item=payload,
                     body=payload,
+                    **Client._match_condition(etag or payload["_etag"]),
                 )
+            return True
+
+        if etag is not None:
+            return await merge()
+        return await retry_on_conflict(merge, Client.MAX_CONFLICT_RETRIES)
+
+    @_mark_stale_on_connection_error
+    async def patch_data(
+        self,
+        item: Dict[str, Any],
+        operations: List[Dict[str, Any]],
+        etag: Optional[str] = None,
+    ) -> bool:
+        """
+        Applies partial document update operations (set, remove, incr, add, replace)
+        server-side. More than ten operations are applied atomically as a batch
+        :param item: dictionary holding id and partitionKey of the document
+        :param operations: see bfsa.db.patch_operations.create_patch_operations
+        :param etag: only patch the document if it is still at this version (_etag)
+        :return: boolean indicating success or failure
+        """
+        if not operations:
+            return True
+
+        if len(operations) <= Client.MAX_PATCH_OPERATIONS:
+            await self._execute(
+                self.container.patch_item,
+                item=item["id"],
+                partition_key=item["partitionKey"],
+                patch_operations=operations,
+                **Client._match_condition(etag),
+            )
+            return True
+
+        await self._execute(
+            self.container.execute_item_batch,
+            batch_operations=[
+                (
+                    "patch",
+                    (
+                        item["id"],
+                        operations[i : i + Client.MAX_PATCH_OPERATIONS],
+                    ),
+                    # the batch is atomic, so checking the version it starts from suffices
+                    {"if_match_etag": etag} if etag is not None and i == 0 else {},
+                )
+                for i in range(0, len(operations), Client.MAX_PATCH_OPERATIONS)
+            ],
+            partition_key=item["partitionKey"],
+        )
         return True
 
 
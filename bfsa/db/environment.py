@@ -6,14 +6,19 @@ Created on 2022-07-17
 @email: bennettedmund@gmail.com
 """
 
-from typing import Dict
+from typing import Dict, Optional
 from json import load
+from asyncio import Lock, Task, create_task, gather, sleep
+from time import monotonic
+from fastapi.concurrency import run_in_threadpool
 
 from bfsa.db.client import Client
+from bfsa.db.fake_client import FakeClient, MemoryStorage, FileStorage
+from bfsa.db.query_cache import query_cache
+from bfsa.db.unit_of_work import UnitOfWork
 from bfsa.controllers.environment import Environment as BaseEnvironment
 from bfsa.utils.get_vault_secret import get_vault_secret
 from bfsa.utils.logger import logger as log
-from bfsa.utils.return_json import return_json
 
 
 base = BaseEnvironment()
@@ -34,23 +39,139 @@ class Environment:
             return db_config
 
 
-def client_factory() -> Client:
-    db_config = Environment.load_db_credentials()
+async def client_factory(
+    provision: bool = True,
+    container_name: Optional[str] = None,
+) -> Client:
+    """
+    Builds a new Client. Prefer get_client, which shares one Client across requests
+    :param provision: whether to create the database and container if they do not exist
+    :param container_name: container to connect to, if not the configured one
+    :return: Client
+    """
+    if base["DB_BACKEND"] in ("memory", "file"):
+        log.warning(f"Using {base['DB_BACKEND']} database in place of Cosmos.")
+        client = FakeClient(
+            storage=FileStorage(base["DB_FILE"])
+            if base["DB_BACKEND"] == "file"
+            else MemoryStorage()
+        )
+        await client.provision()
+        return client
+
+    # reads a file and Key Vault, so is kept off the event loop
+    db_config = await run_in_threadpool(Environment.load_db_credentials)
 
     try:
-        return Client(
+        client = Client(
             endpoint=db_config["uri"],
             key=db_config["key"],
             database_name=db_config["db"],
-            container_name=db_config["collection"],
+            container_name=container_name or db_config["collection"],
+            # the shared cache only holds results from the configured container
+            cache=query_cache if container_name is None else None,
         )
+        if provision:
+            await client.provision()
+        return client
     except Exception as e:
         log.critical(f"Error connecting to database. Error: {e}")
-        return return_json(
-            message="Error connecting to database.",
-            success=False,
+        raise
+
+
+class ClientManager:
+    """
+    Owns the process-wide Client. The container is provisioned once at startup,
+    the connection is rebuilt when it goes stale and closed at shutdown. A client that
+    is replaced is retired rather than closed, as requests, streamed responses and
+    background tasks may still be using it, and closed once they have had time to finish
+    """
+
+    MAX_CLIENT_AGE_IN_SECONDS = 6 * 60 * 60
+    RETIRED_CLIENT_GRACE_PERIOD_IN_SECONDS = 10 * 60
+
+    def __init__(self):
+        self._client: Optional[Client] = None
+        self._created_at = 0.0
+        self._lock: Optional[Lock] = None
+        # pending close -> retired client
+        self._retired: Dict[Task, Client] = {}
+
+    async def startup(self) -> None:
+        log.info("Calling ClientManager.startup")
+        async with self._get_lock():
+            self._client = await client_factory(provision=True)
+            self._created_at = monotonic()
+
+    async def shutdown(self) -> None:
+        log.info("Calling ClientManager.shutdown")
+        async with self._get_lock():
+            if self._client is not None:
+                await self._close(self._client)
+            self._client = None
+
+            retired = list(self._retired.values())
+            for task in list(self._retired):
+                task.cancel()
+            await gather(*[self._close(client) for client in retired])
+
+    async def get_client(self) -> Client:
+        async with self._get_lock():
+            if self._client is None:
+                self._client = await client_factory(provision=True)
+                self._created_at = monotonic()
+            elif self._is_stale():
+                log.warning("Database client is stale. Reconnecting.")
+                # the old client is kept if a new one cannot be built
+                client = await client_factory(provision=False)
+                self._retire(self._client)
+                self._client = client
+                self._created_at = monotonic()
+            return self._client
+
+    def _get_lock(self) -> Lock:
+        # created lazily so that the lock binds to the server's event loop
+        if self._lock is None:
+            self._lock = Lock()
+        return self._lock
+
+    def _is_stale(self) -> bool:
+        # rebuilding an in-memory database would throw its documents away
+        if isinstance(self._client, FakeClient):
+            return False
+        return (
+            self._client.stale
+            or monotonic() - self._created_at > ClientManager.MAX_CLIENT_AGE_IN_SECONDS
         )
 
+    def _retire(self, client: Client) -> None:
+        task = create_task(self._close_after_grace_period(client))
+        self._retired[task] = client
+        task.add_done_callback(self._retired.pop)
+
+    async def _close_after_grace_period(self, client: Client) -> None:
+        await sleep(ClientManager.RETIRED_CLIENT_GRACE_PERIOD_IN_SECONDS)
+        await self._close(client)
+
+    @staticmethod
+    async def _close(client: Client) -> None:
+        try:
+            await client.close()
+        except Exception as e:
+            log.warning(f"Failed to close database client. Error: {e}")
+
+
+client_manager = ClientManager()
+
+
+async def get_client() -> UnitOfWork:
+    """
+    FastAPI dependency returning a unit of work over the shared Client. FastAPI resolves
+    a dependency once per request, so controllers calling one another with client=client
+    share one unit of work
+    """
+    return UnitOfWork(await client_manager.get_client())
+
 
 if __name__ == "__main__":
     pass
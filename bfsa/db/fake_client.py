@@ -0,0 +1,361 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-21
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from typing import List, Dict, Any, Union, Optional, Tuple, AsyncIterator
+from copy import deepcopy
+from json import load, dump
+from os import replace, makedirs
+from os.path import exists, dirname
+from time import time
+from uuid import uuid4
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosBatchOperationError,
+    CosmosHttpResponseError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+
+from bfsa.db.client import Client, _item_result
+from bfsa.db.patch_operations import create_patch_operations
+from bfsa.sql.query_builder import project
+from bfsa.sql.query_evaluator import evaluate
+
+
+class MemoryStorage:
+    """
+    Holds documents in a dictionary keyed by partition key and id, and the log sequence
+    number of each document's last write apart from it, so that it never reaches callers
+    """
+
+    def __init__(self):
+        self.documents: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.sequence_numbers: Dict[Tuple[str, str], int] = {}
+
+    def load(self) -> None:
+        pass
+
+    def save(self) -> None:
+        pass
+
+
+class FileStorage(MemoryStorage):
+    """
+    Holds documents in memory, persisting them to a JSON file after every write
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+
+    def load(self) -> None:
+        if not exists(self.path):
+            return
+        with open(self.path, "r") as storage_file:
+            documents = load(storage_file)
+        self.documents = {
+            (document["partitionKey"], document["id"]): document
+            for document in documents
+        }
+        self.sequence_numbers = {
+            key: document.pop("_lsn", 0) for key, document in self.documents.items()
+        }
+
+    def save(self) -> None:
+        if dirname(self.path):
+            makedirs(dirname(self.path), exist_ok=True)
+        # written to a temporary file first, so a crash never leaves a partial file
+        with open(f"{self.path}.tmp", "w") as storage_file:
+            dump(
+                [
+                    {**document, "_lsn": self.sequence_numbers.get(key, 0)}
+                    for key, document in self.documents.items()
+                ],
+                storage_file,
+            )
+        replace(f"{self.path}.tmp", self.path)
+
+
+class FakeClient:
+    """
+    In-process stand-in for bfsa.db.client.Client, so that the API can run without an
+    Azure account. Queries are limited to the SQL produced by bfsa.sql.create_select
+    """
+
+    def __init__(
+        self,
+        storage: Optional[MemoryStorage] = None,
+        partition_key_field: str = "partitionKey",
+    ):
+        self.stale = False
+        self.partition_key_field = partition_key_field
+        self.storage = storage or MemoryStorage()
+        self._lsn = 0
+
+    async def provision(self) -> None:
+        self.storage.load()
+        self._lsn = max(self.storage.sequence_numbers.values(), default=0)
+
+    async def close(self) -> None:
+        self.storage.save()
+
+    def _key(self, item_id: str, partition_key: str) -> Tuple[str, str]:
+        return partition_key, item_id
+
+    def _write(self, payload: Dict[str, Any]) -> None:
+        document = deepcopy(payload)
+        document["_etag"] = f'"{uuid4()}"'
+        document["_ts"] = int(time())
+        key = self._key(document["id"], document.get(self.partition_key_field))
+        # log sequence number, standing in for the change feed's position
+        self._lsn += 1
+        self.storage.sequence_numbers[key] = self._lsn
+        self.storage.documents[key] = document
+
+    def _read(self, item_id: str, partition_key: str) -> Dict[str, Any]:
+        try:
+            return self.storage.documents[self._key(item_id, partition_key)]
+        except KeyError:
+            raise CosmosResourceNotFoundError(
+                status_code=404,
+                message=f"Document {item_id} does not exist",
+            )
+
+    def _check_etag(self, item_id: str, partition_key: str, etag: Optional[str]):
+        if etag is not None and self._read(item_id, partition_key)["_etag"] != etag:
+            raise CosmosAccessConditionFailedError(
+                status_code=412,
+                message=f"Document {item_id} has changed",
+            )
+
+    async def insert_data(self, payloads: List[Dict[str, Any]]) -> bool:
+        if len(payloads) == 1:
+            self._create_item(payloads[0])
+            self.storage.save()
+            return True
+
+        results = await self.bulk_insert_data(payloads)
+        return all(result["success"] for result in results)
+
+    def _create_item(self, payload: Dict[str, Any]) -> None:
+        key = self._key(payload["id"], payload.get(self.partition_key_field))
+        if key in self.storage.documents:
+            raise CosmosResourceExistsError(
+                status_code=409,
+                message=f"Document {payload['id']} already exists",
+            )
+        self._write(payload)
+
+    async def bulk_insert_data(
+        self,
+        payloads: List[Dict[str, Any]],
+        max_concurrency: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        results = []
+        for payload in payloads:
+            try:
+                self._create_item(payload)
+                results.append(_item_result(payload, True))
+            except CosmosResourceExistsError as e:
+                results.append(_item_result(payload, False, e))
+        self.storage.save()
+        return results
+
+    async def select_data(self, query) -> List[Dict[str, Any]]:
+        return deepcopy(evaluate(query, self.storage.documents.values()))
+
+    async def aggregate(self, query) -> Any:
+        items = await self.select_data(query=query)
+        if query["query"].startswith("SELECT VALUE"):
+            return items[0] if items else None
+        return items
+
+    async def stream_data(self, query) -> AsyncIterator[Dict[str, Any]]:
+        for item in await self.select_data(query=query):
+            yield item
+
+    async def read_changes(
+        self,
+        continuation: Optional[str] = None,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        if continuation is None:
+            return [], str(self._lsn)
+
+        sequence_numbers = self.storage.sequence_numbers
+        changed = sorted(
+            (
+                key
+                for key in sequence_numbers
+                if sequence_numbers[key] > int(continuation)
+            ),
+            key=lambda key: sequence_numbers[key],
+        )
+        changes = [deepcopy(self.storage.documents[key]) for key in changed]
+        return changes, str(self._lsn)
+
+    async def select_page(
+        self,
+        query,
+        page_size: Optional[int] = None,
+        continuation_token: Optional[str] = None,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        items = await self.select_data(query=query)
+        if page_size is None:
+            return items, None
+
+        # the token is the offset of the next page; opaque to callers, as with Cosmos
+        offset = int(continuation_token or 0)
+        next_offset = offset + page_size
+        return (
+            items[offset:next_offset],
+            str(next_offset) if next_offset < len(items) else None,
+        )
+
+    async def get_by_id(
+        self,
+        item_id: str,
+        partition_key: str,
+        fields: Optional[List[str]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        try:
+            item = deepcopy(self._read(item_id, partition_key))
+        except CosmosResourceNotFoundError:
+            return None
+
+        return project(item, fields)
+
+    async def read_many(
+        self,
+        items: List[Dict[str, str]],
+        fields: Optional[List[str]] = None,
+        max_concurrency: Optional[int] = None,
+    ) -> List[Optional[Dict[str, Any]]]:
+        return [
+            await self.get_by_id(item["id"], item["partitionKey"], fields=fields)
+            for item in items
+        ]
+
+    async def delete_data(
+        self,
+        item: Union[Dict[str, Any], str],
+        partition_key: str,
+        etag: Optional[str] = None,
+    ):
+        item_id = item["id"] if isinstance(item, dict) else item
+        self._check_etag(item_id, partition_key, etag)
+        self._read(item_id, partition_key)
+        del self.storage.documents[self._key(item_id, partition_key)]
+        del self.storage.sequence_numbers[self._key(item_id, partition_key)]
+        self.storage.save()
+        return True
+
+    async def update_data(
+        self,
+        item: Dict[str, Any],
+        body: Dict[str, Any],
+        upsert: bool = True,
+        patch: bool = False,
+        etag: Optional[str] = None,
+    ):
+        if patch:
+            return await self.patch_data(
+                item=item,
+                operations=create_patch_operations(body),
+                etag=etag,
+            )
+
+        if upsert:
+            self._check_etag(body["id"], body.get(self.partition_key_field), etag)
+            self._write(body)
+        else:
+            payload = await self.get_by_id(
+                item_id=item["id"],
+                partition_key=item["partitionKey"],
+            )
+            if payload:
+                self._check_etag(item["id"], item["partitionKey"], etag)
+                payload.update(body)
+                self._write(payload)
+        self.storage.save()
+        return True
+
+    async def patch_data(
+        self,
+        item: Dict[str, Any],
+        operations: List[Dict[str, Any]],
+        etag: Optional[str] = None,
+    ) -> bool:
+        if not operations:
+            return True
+
+        try:
+            self._check_etag(item["id"], item["partitionKey"], etag)
+        except CosmosAccessConditionFailedError as e:
+            if len(operations) <= Client.MAX_PATCH_OPERATIONS:
+                raise
+            # more operations than one patch allows are sent as a transactional batch
+            raise CosmosBatchOperationError(
+                error_index=0,
+                headers={},
+                status_code=412,
+                message=str(e),
+                operation_responses=[{"statusCode": 412}],
+            )
+        # applied to a copy, so that a failed operation leaves the document untouched
+        document = deepcopy(self._read(item["id"], item["partitionKey"]))
+        for operation in operations:
+            _apply_patch_operation(document, operation)
+        self._write(document)
+        self.storage.save()
+        return True
+
+
+def _apply_patch_operation(document: Dict[str, Any], operation: Dict[str, Any]):
+    *parents, leaf = operation["path"].lstrip("/").split("/")
+    target = document
+    try:
+        for segment in parents:
+            target = (
+                target[int(segment)] if isinstance(target, list) else target[segment]
+            )
+        if not isinstance(target, (dict, list)):
+            raise TypeError(f"{type(target).__name__} has no fields")
+    except (KeyError, IndexError, TypeError, ValueError):
+        raise CosmosHttpResponseError(
+            status_code=400,
+            message=f"{operation['path']} does not exist",
+        )
+
+    op = operation["op"]
+    if isinstance(target, list):
+        index = len(target) if leaf == "-" else int(leaf)
+        if op == "add":
+            target.insert(index, operation["value"])
+        elif op == "remove":
+            del target[index]
+        elif op == "incr":
+            target[index] += operation["value"]
+        else:
+            target[index] = operation["value"]
+        return
+
+    if op in ("remove", "replace") and leaf not in target:
+        raise CosmosHttpResponseError(
+            status_code=400,
+            message=f"{operation['path']} does not exist",
+        )
+    if op == "remove":
+        del target[leaf]
+    elif op == "incr":
+        target[leaf] = target.get(leaf, 0) + operation["value"]
+    else:
+        target[leaf] = operation["value"]
+
+
+if __name__ == "__main__":
+    pass
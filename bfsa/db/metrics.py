@@ -0,0 +1,170 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-19
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from typing import List, Dict, Any, Optional, Mapping
+from collections import defaultdict
+from contextvars import ContextVar
+from time import perf_counter
+
+
+REQUEST_CHARGE_HEADER = "x-ms-request-charge"
+SERVER_LATENCY_HEADER = "x-ms-request-duration-ms"
+
+# route of the request currently being served, used to tag every database operation
+current_route: ContextVar[str] = ContextVar("current_route", default="internal")
+
+
+class OperationMetrics:
+    """
+    Running totals for one kind of database operation
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.request_charge = 0.0
+        self.server_latency_ms = 0.0
+        self.client_latency_ms = 0.0
+        self.max_client_latency_ms = 0.0
+        self.items = 0
+        self.pages = 0
+
+    def add(
+        self,
+        request_charge: float,
+        server_latency_ms: float,
+        client_latency_ms: float,
+        items: int,
+        pages: int,
+        error: bool,
+    ) -> None:
+        self.count += 1
+        self.errors += int(error)
+        self.request_charge += request_charge
+        self.server_latency_ms += server_latency_ms
+        self.client_latency_ms += client_latency_ms
+        self.max_client_latency_ms = max(self.max_client_latency_ms, client_latency_ms)
+        self.items += items
+        self.pages += pages
+
+    def as_dict(self) -> Dict[str, Any]:
+        count = self.count or 1
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "request_charge": round(self.request_charge, 2),
+            "mean_request_charge": round(self.request_charge / count, 2),
+            "mean_server_latency_ms": round(self.server_latency_ms / count, 2),
+            "mean_client_latency_ms": round(self.client_latency_ms / count, 2),
+            "max_client_latency_ms": round(self.max_client_latency_ms, 2),
+            "items": self.items,
+            "pages": self.pages,
+        }
+
+
+# totals for the request currently being served, reported back as response headers
+request_metrics: ContextVar[Optional[OperationMetrics]] = ContextVar(
+    "request_metrics", default=None
+)
+
+
+class MetricsRegistry:
+    """
+    Process-wide database metrics aggregated by route and operation
+    """
+
+    def __init__(self):
+        self._operations: Dict[tuple, OperationMetrics] = defaultdict(OperationMetrics)
+
+    def record(
+        self,
+        operation: str,
+        request_charge: float = 0.0,
+        server_latency_ms: float = 0.0,
+        client_latency_ms: float = 0.0,
+        items: int = 0,
+        pages: int = 0,
+        error: bool = False,
+    ) -> None:
+        values = (
+            request_charge,
+            server_latency_ms,
+            client_latency_ms,
+            items,
+            pages,
+            error,
+        )
+        self._operations[(current_route.get(), operation)].add(*values)
+
+        per_request = request_metrics.get()
+        if per_request is not None:
+            per_request.add(*values)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """
+        :return: metrics per route and operation, most expensive first
+        """
+        rows = [
+            {"route": route, "operation": operation, **totals.as_dict()}
+            for (route, operation), totals in self._operations.items()
+        ]
+        return sorted(rows, key=lambda row: row["request_charge"], reverse=True)
+
+    def reset(self) -> None:
+        self._operations.clear()
+
+
+metrics = MetricsRegistry()
+
+
+class OperationRecorder:
+    """
+    Accumulates the responses that make up a single Client operation (one for point
+    operations, one per page for queries) and records them when the operation ends.
+    Used as a context manager, so failed operations are recorded as errors
+    """
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.started = perf_counter()
+        self.request_charge = 0.0
+        self.server_latency_ms = 0.0
+        self.items = 0
+        self.pages = 0
+
+    def add_response(self, headers: Optional[Mapping[str, str]], items: int = 0):
+        headers = headers or {}
+        self.request_charge += float(headers.get(REQUEST_CHARGE_HEADER) or 0)
+        self.server_latency_ms += float(headers.get(SERVER_LATENCY_HEADER) or 0)
+        self.items += items
+        self.pages += 1
+
+    def __enter__(self) -> "OperationRecorder":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> bool:
+        # failed requests are charged too, e.g. 429s
+        if getattr(exc_val, "headers", None):
+            self.add_response(exc_val.headers)
+        self.finish(error=isinstance(exc_val, Exception))
+        return False
+
+    def finish(self, error: bool = False) -> None:
+        metrics.record(
+            self.operation,
+            request_charge=self.request_charge,
+            server_latency_ms=self.server_latency_ms,
+            client_latency_ms=(perf_counter() - self.started) * 1000,
+            items=self.items,
+            pages=self.pages,
+            error=error,
+        )
+
+
+if __name__ == "__main__":
+    pass
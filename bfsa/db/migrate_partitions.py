@@ -0,0 +1,301 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-25
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from typing import List, Dict, Any, Optional
+from argparse import ArgumentParser
+from asyncio import run
+from json import load, dump
+from os import replace
+from os.path import exists
+
+from bfsa.db.client import Client
+from bfsa.db.environment import client_factory
+from bfsa.db.throttling import background_priority
+from bfsa.sql.create_select import create_select
+from bfsa.utils.logger import logger as log
+
+
+SYSTEM_FIELDS = {"_rid", "_self", "_etag", "_attachments", "_ts", "_lsn"}
+
+
+def repartition(
+    document: Dict[str, Any],
+    partition_key: str,
+    key_field: str,
+) -> Optional[Dict[str, Any]]:
+    """
+    Re-keys a document to "<partition key>:<key field value>", keeping the entity type
+    in entityType so that the type can still be queried across partitions
+    :return: re-keyed copy of document, or None if it has no value for key_field
+    """
+    if document.get(key_field) in (None, ""):
+        return None
+    migrated = {k: v for k, v in document.items() if k not in SYSTEM_FIELDS}
+    migrated["partitionKey"] = f"{partition_key}:{document[key_field]}"
+    migrated["entityType"] = partition_key
+    return migrated
+
+
+class Checkpoint:
+    """
+    Progress of a migration, persisted to a JSON file after every page
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.state = {
+            "phase": "copy",
+            "continuation_token": None,
+            "copied": 0,
+            "skipped": 0,
+            "failed_ids": [],
+            "deleted": 0,
+        }
+        if exists(path):
+            with open(path, "r") as checkpoint_file:
+                self.state.update(load(checkpoint_file))
+
+    def __getitem__(self, key: str) -> Any:
+        return self.state[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.state[key] = value
+
+    def save(self) -> None:
+        with open(f"{self.path}.tmp", "w") as checkpoint_file:
+            dump(self.state, checkpoint_file)
+        replace(f"{self.path}.tmp", self.path)
+
+
+async def _copy(
+    target: Client,
+    documents: List[Dict[str, Any]],
+    partition_key: str,
+    key_field: str,
+    checkpoint: Checkpoint,
+) -> List[str]:
+    """
+    :return: ids of the documents that failed to copy
+    """
+    migrated = [
+        repartition(document, partition_key, key_field) for document in documents
+    ]
+    checkpoint["skipped"] += sum(1 for m in migrated if m is None)
+    migrated = [m for m in migrated if m is not None]
+    if not migrated:
+        return []
+
+    failed_ids = []
+    for result in await target.bulk_insert_data(migrated):
+        # conflicts are documents copied before an interruption
+        if result["success"] or result["status_code"] == 409:
+            checkpoint["copied"] += 1
+        else:
+            failed_ids.append(result["id"])
+            log.error(f"Failed to copy {result['id']}: {result['error']}")
+    return failed_ids
+
+
+async def migrate_partition(
+    source: Client,
+    target: Client,
+    partition_key: str,
+    key_field: str,
+    checkpoint_path: str,
+    page_size: int = 100,
+) -> Dict[str, Any]:
+    """
+    Copies every document of one entity type to finer-grained partition keys. Documents
+    that fail to copy are recorded in the checkpoint and retried when the migration is
+    run again; the migration is only done once every document is copied
+    :param source: client of the container holding the documents
+    :param target: client of the container to copy to. May be the source client
+    :param partition_key: current partition key, i.e. the entity type, e.g. recipe-steps
+    :param key_field: field whose value is appended to the partition key, e.g. recipe_id
+    :param checkpoint_path: file recording progress, used to resume
+    :param page_size: documents read and written per page
+    :return: final checkpoint state
+    """
+    checkpoint = Checkpoint(checkpoint_path)
+    query = create_select({"partitionKey": partition_key})
+
+    # migrations run alongside the API, so they must never starve it
+    with background_priority():
+        while checkpoint["phase"] == "copy":
+            documents, continuation_token = await source.select_page(
+                query=query,
+                page_size=page_size,
+                continuation_token=checkpoint["continuation_token"],
+            )
+            checkpoint["failed_ids"] += await _copy(
+                target, documents, partition_key, key_field, checkpoint
+            )
+
+            checkpoint["continuation_token"] = continuation_token
+            if continuation_token is None:
+                checkpoint["phase"] = "retry" if checkpoint["failed_ids"] else "done"
+            checkpoint.save()
+            log.info(
+                f"Migrating {partition_key}: {checkpoint['copied']} copied, "
+                f"{checkpoint['skipped']} skipped, "
+                f"{len(checkpoint['failed_ids'])} failed"
+            )
+            if checkpoint["phase"] == "retry":
+                # the operator reruns the tool to retry them
+                return checkpoint.state
+
+        if checkpoint["phase"] == "retry":
+            documents = await source.read_many(
+                [
+                    {"id": item_id, "partitionKey": partition_key}
+                    for item_id in checkpoint["failed_ids"]
+                ]
+            )
+            # documents deleted since they failed no longer need copying
+            checkpoint["failed_ids"] = await _copy(
+                target,
+                [document for document in documents if document is not None],
+                partition_key,
+                key_field,
+                checkpoint,
+            )
+            if not checkpoint["failed_ids"]:
+                checkpoint["phase"] = "done"
+            checkpoint.save()
+            log.info(
+                f"Retried failed copies of {partition_key}: "
+                f"{len(checkpoint['failed_ids'])} still failed"
+            )
+
+    return checkpoint.state
+
+
+async def delete_source(
+    source: Client,
+    partition_key: str,
+    key_field: str,
+    checkpoint_path: str,
+) -> Dict[str, Any]:
+    """
+    Deletes the source documents of a finished migration. The API reads the source
+    documents until it is switched over to the new layout, so this must only be run
+    after that switch, never as part of the copy
+    :param source: client of the container holding the documents
+    :param partition_key: current partition key, i.e. the entity type, e.g. recipe-steps
+    :param key_field: field the documents were partitioned by, e.g. recipe_id
+    :param checkpoint_path: file recording progress of the migration
+    :return: final checkpoint state
+    """
+    checkpoint = Checkpoint(checkpoint_path)
+    if checkpoint["phase"] not in ("done", "delete"):
+        raise ValueError(
+            f"Migration of {partition_key} is not done (phase: {checkpoint['phase']}). "
+            f"Refusing to delete source documents."
+        )
+    checkpoint["phase"] = "delete"
+    checkpoint.save()
+
+    with background_priority():
+        # ids are collected first, as deleting while paging would shift the pages
+        documents = await source.select_data(
+            query=create_select(
+                {"partitionKey": partition_key},
+                fields=["id", key_field],
+            ),
+        )
+        for document in documents:
+            # documents without a key field were never copied
+            if document.get(key_field) in (None, ""):
+                continue
+            await source.delete_data(
+                item=document["id"],
+                partition_key=partition_key,
+            )
+            checkpoint["deleted"] += 1
+        checkpoint["phase"] = "deleted"
+        checkpoint.save()
+
+    return checkpoint.state
+
+
+async def main() -> None:
+    """
+    Offline tool moving one entity type from its single logical partition to
+    finer-grained partition keys, e.g. recipe steps keyed by recipe:
+
+        python -m bfsa.db.migrate_partitions recipe-steps recipe_id --target-container data-v2
+
+    Documents are streamed a page at a time and the position is checkpointed after
+    every page, so an interrupted migration resumes where it stopped when run again.
+    Documents that failed to copy are retried on the next run, and the tool exits
+    non-zero until every document is copied. The API reads the current layout until it
+    is switched over to the new one; only then delete the source documents:
+
+        python -m bfsa.db.migrate_partitions recipe-steps recipe_id --delete-source
+    """
+    parser = ArgumentParser(description="Move an entity type to finer partition keys")
+    parser.add_argument("partition_key", help="entity type, e.g. recipe-steps")
+    parser.add_argument("key_field", help="field to partition by, e.g. recipe_id")
+    parser.add_argument("--target-container", default=None)
+    parser.add_argument("--checkpoint", default=None)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument(
+        "--delete-source",
+        action="store_true",
+        help="only delete the source documents of a finished migration. Run once the "
+        "API reads the new layout",
+    )
+    args = parser.parse_args()
+    checkpoint_path = (
+        args.checkpoint or f"migrate-{args.partition_key}-{args.key_field}.json"
+    )
+
+    source = await client_factory(provision=False)
+    target = source
+    if args.target_container and not args.delete_source:
+        target = await client_factory(
+            provision=True,
+            container_name=args.target_container,
+        )
+
+    try:
+        if args.delete_source:
+            state = await delete_source(
+                source=source,
+                partition_key=args.partition_key,
+                key_field=args.key_field,
+                checkpoint_path=checkpoint_path,
+            )
+        else:
+            state = await migrate_partition(
+                source=source,
+                target=target,
+                partition_key=args.partition_key,
+                key_field=args.key_field,
+                checkpoint_path=checkpoint_path,
+                page_size=args.page_size,
+            )
+    except ValueError as e:
+        log.critical(str(e))
+        raise SystemExit(1)
+    finally:
+        await source.close()
+        if target is not source:
+            await target.close()
+
+    if state["phase"] not in ("done", "deleted"):
+        log.critical(
+            f"Migration incomplete: {len(state['failed_ids'])} documents failed to "
+            f"copy. Run again to retry them. {state}"
+        )
+        raise SystemExit(1)
+    log.info(f"Migration finished: {state}")
+
+
+if __name__ == "__main__":
+    run(main())
@@ -0,0 +1,65 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-04
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from typing import List, Dict, Any, Optional, Union
+from pydantic import BaseModel
+
+
+SUPPORTED_OPERATIONS = {"add", "set", "replace", "remove", "incr"}
+
+OPERATION_ALIASES = {"increment": "incr"}
+
+# fields that Cosmos either owns or will not allow to be patched
+PROTECTED_FIELDS = {"id", "partitionKey"}
+
+
+class PatchOperationModel(BaseModel):
+    """
+    Pydantic model for a single partial document update operation
+    """
+
+    op: str
+    path: str
+    value: Optional[Any] = None
+
+
+def create_patch_operations(
+    patch: Union[Dict[str, Any], List[Union[PatchOperationModel, Dict[str, Any]]]],
+) -> List[Dict[str, Any]]:
+    """
+    Constructs Cosmos partial document update operations. A dictionary of fields is
+    converted into "set" operations; a list of operations is validated and passed through
+    :param patch: dictionary of top-level fields, or list of operations
+    :return: list of patch operations
+    """
+    if isinstance(patch, dict):
+        return [
+            {"op": "set", "path": f"/{k}", "value": v}
+            for k, v in patch.items()
+            if k not in PROTECTED_FIELDS and not k.startswith("_")
+        ]
+
+    operations = []
+    for operation in patch:
+        if isinstance(operation, PatchOperationModel):
+            operation = operation.dict()
+        op = OPERATION_ALIASES.get(operation["op"], operation["op"])
+        path = operation["path"]
+        if op not in SUPPORTED_OPERATIONS:
+            raise ValueError(f"{op} is an unsupported patch operation")
+        if not path.startswith("/") or path.lstrip("/") in PROTECTED_FIELDS:
+            raise ValueError(f"{path} is not a patchable path")
+        if op == "remove":
+            operations.append({"op": op, "path": path})
+        else:
+            operations.append({"op": op, "path": path, "value": operation["value"]})
+    return operations
+
+
+if __name__ == "__main__":
+    pass
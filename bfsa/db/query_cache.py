@@ -0,0 +1,145 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-23
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from typing import List, Dict, Any, Optional, Set, Tuple, Union
+from collections import OrderedDict, defaultdict
+from json import dumps, loads
+from time import monotonic
+
+from bfsa.sql.query_builder import target_partition_key
+
+
+class QueryCache:
+    """
+    LRU cache of query results with a time to live, bounded by the size of the cached
+    results. Results are held serialised, so every hit returns fresh copies and the
+    size of every entry is known. Entries are grouped by the partitionKey their query filters
+    on; writing to a partition invalidates its entries and those of cross-partition
+    queries
+    """
+
+    DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+    DEFAULT_TTL_IN_SECONDS = 60.0
+
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        ttl_in_seconds: float = DEFAULT_TTL_IN_SECONDS,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl_in_seconds = ttl_in_seconds
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> (expires at, partition key, serialised results)
+        self._entries: "OrderedDict[str, Tuple[float, Optional[str], str]]" = (
+            OrderedDict()
+        )
+        self._partitions: Dict[Optional[str], Set[str]] = defaultdict(set)
+        self._generations: Dict[Optional[str], int] = defaultdict(int)
+        self._writes = 0
+        self._epoch = 0
+
+    @staticmethod
+    def key(query: Union[str, Dict[str, Any]]) -> Tuple[str, Optional[str]]:
+        """
+        :param query: query text, or query specification holding query text and parameters
+        :return: normalised cache key, and the partitionKey the query filters on
+        """
+        if isinstance(query, str):
+            query = {"query": query, "parameters": []}
+        text = " ".join(query["query"].split())
+        parameters = {
+            parameter["name"]: parameter["value"]
+            for parameter in query.get("parameters", [])
+        }
+
+        key = dumps([text, sorted(parameters.items())], default=str)
+        return key, target_partition_key(query)
+
+    def generation(self, partition_key: Optional[str]) -> Tuple[int, int]:
+        """
+        Snapshot taken before running a query, so that results read while a write was
+        in flight are not cached
+        """
+        if partition_key is None:
+            return self._epoch, self._writes
+        return self._epoch, self._generations[partition_key]
+
+    def get(self, query: Union[str, Dict[str, Any]]) -> Optional[List[Dict[str, Any]]]:
+        key, _ = QueryCache.key(query)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < monotonic():
+            if entry is not None:
+                self._evict(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return loads(entry[2])
+
+    def put(
+        self,
+        query: Union[str, Dict[str, Any]],
+        items: List[Dict[str, Any]],
+        generation: Tuple[int, int],
+    ) -> None:
+        key, partition_key = QueryCache.key(query)
+        if generation != self.generation(partition_key):
+            return
+
+        serialised = dumps(items)
+        if len(serialised) > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self._evict(key)
+        self._entries[key] = (
+            monotonic() + self.ttl_in_seconds,
+            partition_key,
+            serialised,
+        )
+        self._partitions[partition_key].add(key)
+        self.size += len(serialised)
+
+        while self.size > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+
+    def invalidate(self, partition_key: Optional[str]) -> None:
+        """
+        Drops the results of queries a write to partition_key may have changed. A write
+        without a partition key may have changed anything
+        """
+        if partition_key is None:
+            self._epoch += 1
+            self.clear()
+            return
+
+        self._generations[partition_key] += 1
+        self._writes += 1
+        for affected in {partition_key, None}:
+            for key in list(self._partitions.get(affected, ())):
+                self._evict(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._partitions.clear()
+        self.size = 0
+
+    def _evict(self, key: str) -> None:
+        _, partition_key, serialised = self._entries.pop(key)
+        self._partitions[partition_key].discard(key)
+        self.size -= len(serialised)
+
+
+query_cache = QueryCache()
+
+
+if __name__ == "__main__":
+    pass
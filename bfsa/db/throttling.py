@@ -0,0 +1,189 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-20
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from typing import Dict, Any, Callable, Awaitable
+from asyncio import sleep
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from time import monotonic
+from azure.cosmos.exceptions import CosmosHttpResponseError
+
+from bfsa.utils.logger import logger as log
+
+
+RETRY_AFTER_HEADER = "x-ms-retry-after-ms"
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+request_priority: ContextVar[Priority] = ContextVar(
+    "request_priority", default=Priority.INTERACTIVE
+)
+
+
+@contextmanager
+def background_priority():
+    """
+    Runs database operations started inside the block in the background lane, e.g.
+    bulk inserts and bulk updates, so that they never starve interactive requests.
+    Tasks created inside the block inherit the lane
+    """
+    token = request_priority.set(Priority.BACKGROUND)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+class RequestUnitBudget:
+    """
+    Token bucket shaping the request units spent by this process to the provisioned
+    throughput. Charges are not known until a response arrives, so each operation
+    reserves an estimate up front and the difference is settled afterwards.
+    Background operations leave a reserve untouched for interactive ones and wait
+    whenever an interactive operation is waiting.
+    """
+
+    DEFAULT_ESTIMATE = 5.0
+    ESTIMATE_WEIGHT = 0.2
+    POLL_INTERVAL_IN_SECONDS = 0.01
+
+    def __init__(
+        self,
+        request_units_per_second: float,
+        interactive_reserve: float = 0.25,
+    ):
+        self.rate = float(request_units_per_second)
+        self.capacity = float(request_units_per_second)
+        self.reserve = self.capacity * interactive_reserve
+        self._tokens = self.capacity
+        self._updated_at = monotonic()
+        self._interactive_waiting = 0
+        self._estimates: Dict[str, float] = {}
+
+    def estimate(self, operation: str) -> float:
+        return self._estimates.get(operation, RequestUnitBudget.DEFAULT_ESTIMATE)
+
+    async def acquire(self, operation: str) -> None:
+        """
+        Waits until the budget can afford the estimated charge of operation
+        :param operation: name of the operation, e.g. read_item
+        :return:
+        """
+        cost = min(self.estimate(operation), self.capacity - self.reserve)
+        interactive = request_priority.get() == Priority.INTERACTIVE
+
+        if interactive:
+            self._interactive_waiting += 1
+        try:
+            while True:
+                self._refill()
+                if interactive:
+                    affordable = self._tokens >= cost
+                else:
+                    affordable = (
+                        not self._interactive_waiting
+                        and self._tokens - self.reserve >= cost
+                    )
+                if affordable:
+                    self._tokens -= cost
+                    return
+                shortfall = cost + (0 if interactive else self.reserve) - self._tokens
+                await sleep(
+                    max(
+                        shortfall / self.rate,
+                        RequestUnitBudget.POLL_INTERVAL_IN_SECONDS,
+                    )
+                )
+        finally:
+            if interactive:
+                self._interactive_waiting -= 1
+
+    def settle(self, operation: str, request_charge: float) -> None:
+        """
+        Replaces the estimate reserved by acquire with the actual charge
+        :param operation:
+        :param request_charge: value of the x-ms-request-charge header
+        :return:
+        """
+        estimate = self.estimate(operation)
+        self._tokens -= request_charge - min(estimate, self.capacity - self.reserve)
+        if request_charge:
+            self._estimates[operation] = (
+                1 - RequestUnitBudget.ESTIMATE_WEIGHT
+            ) * estimate + RequestUnitBudget.ESTIMATE_WEIGHT * request_charge
+
+    def throttled(self, retry_after_in_seconds: float) -> None:
+        """
+        Drains the bucket after a 429, pausing every lane until the server's retry-after
+        has elapsed
+        """
+        self._refill()
+        self._tokens = min(self._tokens, -retry_after_in_seconds * self.rate)
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+
+class ThrottlingRetryPolicy:
+    """
+    Retries operations rejected with 429 (request rate too large), waiting for the
+    retry-after interval returned by the server, or backing off exponentially without one
+    """
+
+    def __init__(
+        self,
+        budget: RequestUnitBudget,
+        max_attempts: int = 5,
+        base_delay_in_seconds: float = 0.1,
+        max_delay_in_seconds: float = 10.0,
+    ):
+        self.budget = budget
+        self.max_attempts = max_attempts
+        self.base_delay_in_seconds = base_delay_in_seconds
+        self.max_delay_in_seconds = max_delay_in_seconds
+
+    def retry_after(self, error: CosmosHttpResponseError, attempt: int) -> float:
+        retry_after_ms = (getattr(error, "headers", None) or {}).get(RETRY_AFTER_HEADER)
+        if retry_after_ms:
+            delay = float(retry_after_ms) / 1000
+        else:
+            delay = self.base_delay_in_seconds * 2 ** (attempt - 1)
+        return min(delay, self.max_delay_in_seconds)
+
+    async def run(self, attempt: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Awaits attempt, retrying it while it is throttled
+        :param attempt: callable returning a fresh awaitable for each attempt
+        :return: result of the first successful attempt
+        """
+        for attempt_number in range(1, self.max_attempts + 1):
+            try:
+                return await attempt()
+            except CosmosHttpResponseError as e:
+                if e.status_code != 429 or attempt_number == self.max_attempts:
+                    raise
+                delay = self.retry_after(e, attempt_number)
+                log.warning(
+                    f"Request rate too large. Retrying in {delay:.2f}s "
+                    f"(attempt {attempt_number} of {self.max_attempts})."
+                )
+                self.budget.throttled(delay)
+                await sleep(delay)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,79 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-28
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from typing import Dict, Any
+from copy import deepcopy
+from json import dumps
+
+from bfsa.db.client import Client
+
+
+class UnitOfWork:
+    """
+    Request-scoped view of the shared Client. Identical reads within a request are
+    served from memory after the first, so composite operations (e.g. a delete that
+    reads the document first, or a rollback re-reading what was just read) do not pay
+    for the same read twice. Any write through the unit of work drops what it has
+    memoised, so reads after a write always reach the database. Everything else is
+    passed through to the client
+    """
+
+    MEMOISED_READS = {
+        "select_data",
+        "select_page",
+        "aggregate",
+        "get_by_id",
+        "read_many",
+    }
+    WRITES = {
+        "insert_data",
+        "bulk_insert_data",
+        "delete_data",
+        "update_data",
+        "patch_data",
+    }
+
+    def __init__(self, client: Client):
+        self.client = client
+        self._reads: Dict[str, Any] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self.client, name)
+        if name in UnitOfWork.MEMOISED_READS:
+            return self._memoised(name, attribute)
+        if name in UnitOfWork.WRITES:
+            return self._invalidating(attribute)
+        return attribute
+
+    def _memoised(self, name: str, read):
+        async def wrapper(*args, **kwargs):
+            key = dumps([name, args, kwargs], sort_keys=True, default=str)
+            if key not in self._reads:
+                self._reads[key] = await read(*args, **kwargs)
+                return self._reads[key]
+            # only repeats are copied, so reads made once cost nothing extra. Callers
+            # modifying what they read mostly write it back, which drops the read
+            return deepcopy(self._reads[key])
+
+        return wrapper
+
+    def _invalidating(self, write):
+        async def wrapper(*args, **kwargs):
+            # dropped after the write as well, as reads overlapping it may be stale,
+            # and even if it fails, as it may still have been applied
+            self._reads.clear()
+            try:
+                return await write(*args, **kwargs)
+            finally:
+                self._reads.clear()
+
+        return wrapper
+
+
+if __name__ == "__main__":
+    pass
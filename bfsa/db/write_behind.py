@@ -0,0 +1,168 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-26
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from typing import List, Dict, Any, Optional, Tuple
+from asyncio import Lock, Semaphore, Task, create_task, gather, shield, sleep
+from collections import OrderedDict
+
+from bfsa.db.environment import client_manager
+from bfsa.db.throttling import background_priority
+from bfsa.utils.logger import logger as log
+
+
+class WriteBehindQueue:
+    """
+    Queues writes that do not need confirmation (view counters, audit entries, derived
+    fields) and applies them in the background, so requests do not wait on their round
+    trips. Writes to the same document are coalesced: an upsert or delete supersedes
+    what was queued before it, consecutive patches are merged and increments of the same
+    path are summed. The queue is flushed when it holds max_batch_size documents, every
+    flush_interval_in_seconds, and drained at shutdown. Failed writes are logged and
+    dropped
+    """
+
+    DEFAULT_MAX_BATCH_SIZE = 100
+    DEFAULT_FLUSH_INTERVAL_IN_SECONDS = 1.0
+    DEFAULT_MAX_CONCURRENCY = 10
+
+    def __init__(
+        self,
+        get_client,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        flush_interval_in_seconds: float = DEFAULT_FLUSH_INTERVAL_IN_SECONDS,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    ):
+        self.get_client = get_client
+        self.max_batch_size = max_batch_size
+        self.flush_interval_in_seconds = flush_interval_in_seconds
+        self.max_concurrency = max_concurrency
+        # (partition key, id) -> writes to apply in order
+        self._pending: "OrderedDict[Tuple[str, str], List[Dict[str, Any]]]" = (
+            OrderedDict()
+        )
+        self._timer: Optional[Task] = None
+        self._flushes: List[Task] = []
+        self._lock: Optional[Lock] = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def upsert(self, body: Dict[str, Any]) -> None:
+        self._pending[(body["partitionKey"], body["id"])] = [
+            {"op": "upsert", "body": dict(body)}
+        ]
+        self._flush_if_full()
+
+    def delete(self, item_id: str, partition_key: str) -> None:
+        self._pending[(partition_key, item_id)] = [{"op": "delete"}]
+        self._flush_if_full()
+
+    def patch(self, item: Dict[str, Any], operations: List[Dict[str, Any]]) -> None:
+        """
+        :param item: dictionary holding id and partitionKey of the document
+        :param operations: see bfsa.db.patch_operations.create_patch_operations
+        """
+        writes = self._pending.setdefault((item["partitionKey"], item["id"]), [])
+        if not writes or writes[-1]["op"] != "patch":
+            writes.append({"op": "patch", "operations": []})
+        merged = writes[-1]["operations"]
+
+        for operation in operations:
+            previous = merged[-1] if merged else None
+            if (
+                previous is not None
+                and operation["op"] == previous["op"] == "incr"
+                and operation["path"] == previous["path"]
+            ):
+                previous["value"] += operation["value"]
+            else:
+                merged.append(dict(operation))
+        self._flush_if_full()
+
+    def increment(self, item: Dict[str, Any], path: str, value: float = 1) -> None:
+        self.patch(item, [{"op": "incr", "path": path, "value": value}])
+
+    def start(self) -> None:
+        if self._timer is None:
+            log.info("Calling WriteBehindQueue.start")
+            self._timer = create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the timer and drains the queue. Flushes already running are awaited, not
+        cancelled, as their writes have left the queue
+        """
+        log.info("Calling WriteBehindQueue.stop")
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await gather(*self._flushes, return_exceptions=True)
+        while self._pending:
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Applies every queued write. Flushes run one at a time, so writes to a document
+        are always applied in the order they were queued
+        """
+        if self._lock is None:
+            self._lock = Lock()
+
+        async with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+            if not pending:
+                return
+
+            client = await self.get_client()
+            semaphore = Semaphore(self.max_concurrency)
+
+            async def apply(key: Tuple[str, str], writes: List[Dict[str, Any]]):
+                partition_key, item_id = key
+                item = {"id": item_id, "partitionKey": partition_key}
+                async with semaphore:
+                    for write in writes:
+                        try:
+                            if write["op"] == "upsert":
+                                await client.update_data(item, write["body"])
+                            elif write["op"] == "delete":
+                                await client.delete_data(item_id, partition_key)
+                            else:
+                                await client.patch_data(item, write["operations"])
+                        except Exception as e:
+                            log.error(
+                                f"Failed to write {item_id} behind ({write['op']}). Error: {e}"
+                            )
+
+            with background_priority():
+                await gather(*[apply(key, writes) for key, writes in pending.items()])
+
+    def _start_flush(self) -> Task:
+        task = create_task(self.flush())
+        self._flushes.append(task)
+        task.add_done_callback(self._flushes.remove)
+        return task
+
+    def _flush_if_full(self) -> None:
+        if len(self._pending) >= self.max_batch_size:
+            self._start_flush()
+
+    async def _run(self) -> None:
+        while True:
+            await sleep(self.flush_interval_in_seconds)
+            try:
+                # shielded, so stopping the timer mid-flush leaves the flush to finish
+                await shield(self._start_flush())
+            except Exception as e:
+                log.error(f"Error flushing write-behind queue. Error: {e}")
+
+
+write_behind_queue = WriteBehindQueue(client_manager.get_client)
+
+
+if __name__ == "__main__":
+    pass
@@ -6,23 +6,61 @@ Created on 2022-08-07
 @email: bennettedmund@gmail.com
 """
 
-from typing import Dict, Any
+from typing import List, Dict, Any, Optional
 
+from bfsa.sql.query_builder import Select, Aggregate
 
-def create_select(where: Dict[str, Any] = None) -> str:
+
+def create_select(
+    where: Dict[str, Any] = None,
+    fields: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    """
+    Constructs a parameterised SQL SELECT query with optional where clause and projection
+    :param where: see bfsa.sql.query_builder.Select.filter
+    :param fields: fields to project. If None, whole documents are selected
+    :return: query specification holding query text and parameters
+    """
+    return Select(fields).filter(where).build()
+
+
+def create_aggregate(
+    where: Dict[str, Any] = None,
+    function: str = "count",
+    field: Optional[str] = None,
+    group_by: Optional[str] = None,
+    group_by_prefix: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Constructs a parameterised SQL aggregate query with optional where clause
+    :param where: see bfsa.sql.query_builder.Select.filter
+    :param function: count, min, max, sum or avg
+    :param field: field to aggregate. Not needed to count documents
+    :param group_by: field to group by. If None, a single value is aggregated
+    :param group_by_prefix: group by the first characters of group_by only, e.g. 4 to group ISO dates by year
+    :return: query specification holding query text and parameters
+    """
+    return Aggregate(function, field, group_by, group_by_prefix).filter(where).build()
+
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """
+    Parses a comma-separated fields parameter, e.g. "id,title,authors"
+    :param fields:
+    :return: list of field names, or None if all fields are wanted
+    """
+    if not fields:
+        return None
+    return [field.strip() for field in fields.split(",") if field.strip()]
+
+
+def is_point_read(where: Dict[str, Any]) -> bool:
     """
-    Constructs an SQL SELECT query with optional where clause
+    Indicates whether a where clause identifies exactly one document by id and partition key
     :param where:
     :return:
     """
-    query = "SELECT * FROM c"
-    if where is not None:
-        for i, (k, v) in enumerate(where.items()):
-            if i == 0:
-                query += f" WHERE c.{k} = '{v}'"
-            else:
-                query += f" AND c.{k} = '{v}'"
-    return query
+    return where.keys() == {"id", "partitionKey"} and isinstance(where["id"], str)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,300 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-18
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+import re
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Tuple, Union
+
+
+FIELD_REGEX = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$")
+
+PARTITION_KEY_REGEX = re.compile(r"\bc\.partitionKey = (@\w+)")
+
+# operators accepted in where dictionaries, e.g. {"release_year": {"gte": 1990}}
+WHERE_OPERATORS = {
+    "eq": "=",
+    "ne": "!=",
+    "lt": "<",
+    "lte": "<=",
+    "gt": ">",
+    "gte": ">=",
+    "in": "IN",
+}
+
+COMPARISON_OPERATORS = {"=", "!=", "<", "<=", ">", ">="}
+
+AGGREGATE_FUNCTIONS = {
+    "count": "COUNT",
+    "min": "MIN",
+    "max": "MAX",
+    "sum": "SUM",
+    "avg": "AVG",
+}
+
+
+def _validate_field(field: str) -> str:
+    if not FIELD_REGEX.match(field):
+        raise ValueError(f"{field} is not a valid field name")
+    return field
+
+
+@lru_cache(maxsize=512)
+def _compile(
+    fields: Tuple[str, ...],
+    top: bool,
+    conditions: Tuple[Tuple[str, str], ...],
+    order_by: Tuple[Tuple[str, bool], ...],
+    paginate: bool,
+) -> str:
+    """
+    Compiles a query shape into SQL text. Values never appear in the text, so every query
+    of the same shape shares one text (and one cached query plan on the server)
+    """
+    query = "SELECT "
+    if top:
+        query += "TOP @top "
+    query += ", ".join(f"c.{field}" for field in fields) if fields else "*"
+    query += " FROM c"
+    query += _compile_where(conditions)
+
+    if order_by:
+        query += " ORDER BY " + ", ".join(
+            f"c.{field} {'DESC' if descending else 'ASC'}"
+            for field, descending in order_by
+        )
+
+    if paginate:
+        query += " OFFSET @offset LIMIT @limit"
+
+    return query
+
+
+def _compile_where(conditions: Tuple[Tuple[str, str], ...]) -> str:
+    clause = ""
+    for i, (field, operator) in enumerate(conditions):
+        clause += " WHERE " if i == 0 else " AND "
+        if operator == "IN":
+            clause += f"ARRAY_CONTAINS(@p{i}, c.{field})"
+        else:
+            clause += f"c.{field} {operator} @p{i}"
+    return clause
+
+
+@lru_cache(maxsize=512)
+def _compile_aggregate(
+    function: str,
+    field: Optional[str],
+    group_by: Optional[str],
+    group_by_prefix: Optional[int],
+    conditions: Tuple[Tuple[str, str], ...],
+) -> str:
+    """
+    Compiles an aggregate query shape into SQL text. Ungrouped aggregates select a
+    single VALUE; grouped ones select rows of bucket and result
+    """
+    aggregate = f"{function}({f'c.{field}' if field else '1'})"
+    where = _compile_where(conditions)
+    if group_by is None:
+        return f"SELECT VALUE {aggregate} FROM c{where}"
+
+    # the prefix is a validated integer, inlined because GROUP BY has to repeat the
+    # selected expression exactly
+    bucket = f"c.{group_by}"
+    if group_by_prefix is not None:
+        bucket = f"LEFT({bucket}, {group_by_prefix})"
+    return (
+        f"SELECT {bucket} AS bucket, {aggregate} AS result FROM c{where} "
+        f"GROUP BY {bucket}"
+    )
+
+
+def target_partition_key(query: Union[str, Dict[str, Any]]) -> Optional[str]:
+    """
+    Finds the partitionKey a query is confined to. Conditions are only ever combined
+    with AND, so an equality condition on partitionKey confines the whole query
+    :param query: query text, or query specification holding query text and parameters
+    :return: partition key, or None for cross-partition queries
+    """
+    if isinstance(query, str):
+        return None
+    match = PARTITION_KEY_REGEX.search(query["query"])
+    if not match:
+        return None
+    for parameter in query.get("parameters", []):
+        if parameter["name"] == match[1] and isinstance(parameter["value"], str):
+            return parameter["value"]
+    return None
+
+
+def project(document: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+    """
+    Applies a projection to a single document the same way Cosmos does for SELECT c.a.b,
+    i.e. keyed by the last segment of each field path
+    """
+    if not fields:
+        return document
+
+    projected = {}
+    for field in fields:
+        value = document
+        for segment in _validate_field(field).split("."):
+            if not isinstance(value, dict) or segment not in value:
+                break
+            value = value[segment]
+        else:
+            projected[field.split(".")[-1]] = value
+    return projected
+
+
+class Select:
+    """
+    Composable, parameterised Cosmos SQL SELECT builder
+    """
+
+    def __init__(self, fields: Optional[List[str]] = None):
+        self._fields = tuple(_validate_field(field) for field in fields or [])
+        self._top: Optional[int] = None
+        self._conditions: List[Tuple[str, str, Any]] = []
+        self._order_by: List[Tuple[str, bool]] = []
+        self._offset: Optional[int] = None
+        self._limit: Optional[int] = None
+
+    def where(self, field: str, value: Any, operator: str = "=") -> "Select":
+        if operator not in COMPARISON_OPERATORS:
+            raise ValueError(f"{operator} is an unsupported operator")
+        self._conditions.append((_validate_field(field), operator, value))
+        return self
+
+    def where_in(self, field: str, values: List[Any]) -> "Select":
+        self._conditions.append((_validate_field(field), "IN", list(values)))
+        return self
+
+    def where_range(
+        self,
+        field: str,
+        lower: Any = None,
+        upper: Any = None,
+    ) -> "Select":
+        """
+        Adds an inclusive range condition. Either bound may be omitted
+        """
+        if lower is not None:
+            self.where(field, lower, ">=")
+        if upper is not None:
+            self.where(field, upper, "<=")
+        return self
+
+    def filter(self, where: Optional[Dict[str, Any]] = None) -> "Select":
+        """
+        Adds conditions from a where dictionary. Plain values are equality conditions,
+        lists are IN conditions and dictionaries map operators (eq, ne, lt, lte, gt, gte,
+        in) to values, e.g. {"format": ["DVD", "Blu-ray"], "release_year": {"gte": 1990}}
+        """
+        for field, value in (where or {}).items():
+            if isinstance(value, list):
+                self.where_in(field, value)
+            elif isinstance(value, dict):
+                for operator, operand in value.items():
+                    if operator not in WHERE_OPERATORS:
+                        raise ValueError(f"{operator} is an unsupported operator")
+                    if WHERE_OPERATORS[operator] == "IN":
+                        self.where_in(field, operand)
+                    else:
+                        self.where(field, operand, WHERE_OPERATORS[operator])
+            else:
+                self.where(field, value)
+        return self
+
+    def order_by(self, field: str, descending: bool = False) -> "Select":
+        self._order_by.append((_validate_field(field), descending))
+        return self
+
+    def top(self, count: int) -> "Select":
+        self._top = count
+        return self
+
+    def offset_limit(self, offset: int, limit: int) -> "Select":
+        self._offset, self._limit = offset, limit
+        return self
+
+    def build(self) -> Dict[str, Any]:
+        """
+        Builds the query specification accepted by the Cosmos SDK
+        :return: dictionary holding query text and parameters
+        """
+        query = _compile(
+            self._fields,
+            self._top is not None,
+            tuple((field, operator) for field, operator, _ in self._conditions),
+            tuple(self._order_by),
+            self._limit is not None,
+        )
+
+        parameters = [
+            {"name": f"@p{i}", "value": value}
+            for i, (_, _, value) in enumerate(self._conditions)
+        ]
+        if self._top is not None:
+            parameters.append({"name": "@top", "value": self._top})
+        if self._limit is not None:
+            parameters.append({"name": "@offset", "value": self._offset or 0})
+            parameters.append({"name": "@limit", "value": self._limit})
+
+        return {"query": query, "parameters": parameters}
+
+
+class Aggregate(Select):
+    """
+    Composable, parameterised Cosmos SQL aggregate builder, e.g. counts of media grouped
+    by format. Conditions are added as with Select
+    """
+
+    def __init__(
+        self,
+        function: str = "count",
+        field: Optional[str] = None,
+        group_by: Optional[str] = None,
+        group_by_prefix: Optional[int] = None,
+    ):
+        super().__init__()
+        if function not in AGGREGATE_FUNCTIONS:
+            raise ValueError(f"{function} is an unsupported aggregate function")
+        if field is None and function != "count":
+            raise ValueError(f"{function} requires a field")
+        if group_by_prefix is not None and (
+            group_by is None or int(group_by_prefix) < 1
+        ):
+            raise ValueError("group_by_prefix requires group_by and must be positive")
+        self._function = AGGREGATE_FUNCTIONS[function]
+        self._field = None if field is None else _validate_field(field)
+        self._group_by = None if group_by is None else _validate_field(group_by)
+        self._group_by_prefix = (
+            None if group_by_prefix is None else int(group_by_prefix)
+        )
+
+    def build(self) -> Dict[str, Any]:
+        """
+        Builds the query specification accepted by the Cosmos SDK
+        :return: dictionary holding query text and parameters
+        """
+        query = _compile_aggregate(
+            self._function,
+            self._field,
+            self._group_by,
+            self._group_by_prefix,
+            tuple((field, operator) for field, operator, _ in self._conditions),
+        )
+        parameters = [
+            {"name": f"@p{i}", "value": value}
+            for i, (_, _, value) in enumerate(self._conditions)
+        ]
+        return {"query": query, "parameters": parameters}
+
+
+if __name__ == "__main__":
+    pass
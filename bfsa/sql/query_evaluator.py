@@ -0,0 +1,284 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-21
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+import re
+from functools import lru_cache
+from json import dumps
+from typing import List, Dict, Any, Iterable, Tuple, Union, Callable, Optional
+
+from bfsa.sql.query_builder import project
+
+
+QUERY_REGEX = re.compile(
+    r"^SELECT (?P<top>TOP @top )?(?P<fields>\*|c\.[\w.]+(?:, c\.[\w.]+)*) FROM c"
+    r"(?: WHERE (?P<where>.+?))?"
+    r"(?: ORDER BY (?P<order_by>.+?))?"
+    r"(?P<paginate> OFFSET @offset LIMIT @limit)?$"
+)
+COMPARISON_REGEX = re.compile(
+    r"^c\.(?P<field>[\w.]+) (?P<operator>=|!=|<=|>=|<|>) (?P<parameter>@\w+)$"
+)
+IN_REGEX = re.compile(r"^ARRAY_CONTAINS\((?P<parameter>@\w+), c\.(?P<field>[\w.]+)\)$")
+AGGREGATE_REGEX = re.compile(
+    r"^SELECT (?:VALUE (?P<value>\w+\((?:1|c\.[\w.]+)\))"
+    r"|(?P<bucket>c\.[\w.]+|LEFT\(c\.[\w.]+, \d+\)) AS bucket, "
+    r"(?P<grouped>\w+\((?:1|c\.[\w.]+)\)) AS result) FROM c"
+    r"(?: WHERE (?P<where>.+?))?"
+    r"(?: GROUP BY (?P<group_by>.+))?$"
+)
+FUNCTION_REGEX = re.compile(
+    r"^(?P<function>COUNT|MIN|MAX|SUM|AVG)\((?:1|c\.(?P<field>[\w.]+))\)$"
+)
+BUCKET_REGEX = re.compile(r"^(?:LEFT\()?c\.(?P<field>[\w.]+)(?:, (?P<prefix>\d+)\))?$")
+ORDER_BY_REGEX = re.compile(r"^c\.(?P<field>[\w.]+) (?P<direction>ASC|DESC)$")
+
+COMPARISONS: Dict[str, Callable[[Any, Any], bool]] = {
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+}
+
+_UNDEFINED = object()
+
+
+def _resolve(document: Dict[str, Any], field: str) -> Any:
+    value = document
+    for segment in field.split("."):
+        if not isinstance(value, dict) or segment not in value:
+            return _UNDEFINED
+        value = value[segment]
+    return value
+
+
+def _type_rank(value: Any) -> int:
+    # Cosmos orders undefined < null < booleans < numbers < strings
+    if value is _UNDEFINED:
+        return 0
+    if value is None:
+        return 1
+    if isinstance(value, bool):
+        return 2
+    if isinstance(value, (int, float)):
+        return 3
+    if isinstance(value, str):
+        return 4
+    return 5
+
+
+def _sort_key(value: Any) -> Tuple[int, Any]:
+    rank = _type_rank(value)
+    return rank, value if rank in (2, 3, 4) else 0
+
+
+def _compare(operator: str, value: Any, operand: Any) -> bool:
+    # comparisons against undefined, or between different types, are undefined and
+    # so never match, apart from inequality between different types
+    if value is _UNDEFINED:
+        return False
+    if _type_rank(value) != _type_rank(operand):
+        return operator == "!="
+    if operator not in ("=", "!=") and _type_rank(value) == 5:
+        return False
+    return COMPARISONS[operator](value, operand)
+
+
+def _parse_conditions(where: Optional[str]) -> Tuple[Tuple[str, str, str], ...]:
+    conditions = []
+    for condition in where.split(" AND ") if where else []:
+        comparison = COMPARISON_REGEX.match(condition)
+        contains = IN_REGEX.match(condition)
+        if comparison:
+            conditions.append(
+                (comparison["field"], comparison["operator"], comparison["parameter"])
+            )
+        elif contains:
+            conditions.append((contains["field"], "IN", contains["parameter"]))
+        else:
+            raise ValueError(f"{condition} is not a supported condition")
+    return tuple(conditions)
+
+
+def _matches(
+    document: Dict[str, Any],
+    conditions: Tuple[Tuple[str, str, str], ...],
+    parameters: Dict[str, Any],
+) -> bool:
+    for field, operator, parameter in conditions:
+        value = _resolve(document, field)
+        if operator == "IN":
+            if value is _UNDEFINED or value not in parameters[parameter]:
+                return False
+        elif not _compare(operator, value, parameters[parameter]):
+            return False
+    return True
+
+
+@lru_cache(maxsize=512)
+def _parse_aggregate(query: str) -> Tuple:
+    """
+    Parses aggregate query text produced by bfsa.sql.query_builder.Aggregate
+    """
+    match = AGGREGATE_REGEX.match(query)
+    if not match or bool(match["bucket"]) != bool(match["group_by"]):
+        raise ValueError(f"{query} is not a supported query")
+
+    function = FUNCTION_REGEX.match(match["value"] or match["grouped"])
+    if not function:
+        raise ValueError(f"{query} is not a supported query")
+
+    bucket = None
+    if match["bucket"]:
+        bucket = BUCKET_REGEX.match(match["bucket"])
+        bucket = bucket["field"], int(bucket["prefix"]) if bucket["prefix"] else None
+
+    return (
+        function["function"],
+        function["field"],
+        bucket,
+        _parse_conditions(match["where"]),
+    )
+
+
+def _aggregate(function: str, field: Optional[str], documents: List) -> Any:
+    if function == "COUNT":
+        return len(documents)
+
+    values = [_resolve(document, field) for document in documents]
+    if function in ("SUM", "AVG"):
+        values = [
+            value
+            for value in values
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+        ]
+    else:
+        values = [value for value in values if _type_rank(value) in (2, 3, 4)]
+    if not values:
+        return _UNDEFINED
+
+    if function == "SUM":
+        return sum(values)
+    if function == "AVG":
+        return sum(values) / len(values)
+    pick = min if function == "MIN" else max
+    return pick(values, key=_sort_key)
+
+
+def _evaluate_aggregate(
+    query: str,
+    parameters: Dict[str, Any],
+    documents: Iterable[Dict[str, Any]],
+) -> List[Any]:
+    function, field, bucket, conditions = _parse_aggregate(query)
+    matching = [
+        document for document in documents if _matches(document, conditions, parameters)
+    ]
+
+    if bucket is None:
+        result = _aggregate(function, field, matching)
+        return [] if result is _UNDEFINED else [result]
+
+    group_field, prefix = bucket
+    groups = {}
+    for document in matching:
+        value = _resolve(document, group_field)
+        if prefix is not None and isinstance(value, str):
+            value = value[:prefix]
+        key = "undefined" if value is _UNDEFINED else dumps(value, sort_keys=True)
+        groups.setdefault(key, (value, []))[1].append(document)
+
+    rows = []
+    for value, members in groups.values():
+        row = {}
+        if value is not _UNDEFINED:
+            row["bucket"] = value
+        result = _aggregate(function, field, members)
+        if result is not _UNDEFINED:
+            row["result"] = result
+        rows.append(row)
+    return rows
+
+
+@lru_cache(maxsize=512)
+def _parse(query: str) -> Tuple:
+    """
+    Parses query text produced by bfsa.sql.query_builder.Select into its clauses
+    """
+    match = QUERY_REGEX.match(query)
+    if not match:
+        raise ValueError(f"{query} is not a supported query")
+
+    fields = None
+    if match["fields"] != "*":
+        fields = tuple(field[2:] for field in match["fields"].split(", "))
+
+    conditions = _parse_conditions(match["where"])
+
+    order_by = []
+    for clause in match["order_by"].split(", ") if match["order_by"] else []:
+        ordering = ORDER_BY_REGEX.match(clause)
+        if not ordering:
+            raise ValueError(f"{clause} is not a supported ordering")
+        order_by.append((ordering["field"], ordering["direction"] == "DESC"))
+
+    return (
+        fields,
+        bool(match["top"]),
+        tuple(conditions),
+        tuple(order_by),
+        bool(match["paginate"]),
+    )
+
+
+def evaluate(
+    query: Union[str, Dict[str, Any]],
+    documents: Iterable[Dict[str, Any]],
+) -> List[Dict[str, Any]]:
+    """
+    Evaluates the SQL subset produced by bfsa.sql.create_select and
+    bfsa.sql.create_select.create_aggregate against documents in memory, for use where
+    Cosmos is not available
+    :param query: query text, or query specification holding query text and parameters
+    :param documents:
+    :return: matching documents, ordered, paged and projected as Cosmos would
+    """
+    if isinstance(query, str):
+        query = {"query": query, "parameters": []}
+    parameters = {
+        parameter["name"]: parameter["value"]
+        for parameter in query.get("parameters", [])
+    }
+    if AGGREGATE_REGEX.match(query["query"]):
+        return _evaluate_aggregate(query["query"], parameters, documents)
+
+    fields, top, conditions, order_by, paginate = _parse(query["query"])
+
+    results = [
+        document for document in documents if _matches(document, conditions, parameters)
+    ]
+
+    # stable sorts applied from the last ordering to the first
+    for field, descending in reversed(order_by):
+        results.sort(
+            key=lambda document: _sort_key(_resolve(document, field)),
+            reverse=descending,
+        )
+
+    if paginate:
+        offset = parameters["@offset"]
+        results = results[offset : offset + parameters["@limit"]]
+    if top:
+        results = results[: parameters["@top"]]
+
+    return [project(document, list(fields) if fields else None) for document in results]
+
+
+if __name__ == "__main__":
+    pass
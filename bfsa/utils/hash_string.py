@@ -6,12 +6,30 @@ Created on 2022-11-28
 @email: bennettedmund@gmail.com
 """
 
+from typing import Union
 import hashlib
 
 
+class StreamingHash:
+    """
+    SHA-256 of input fed a chunk at a time, e.g. while a file streams through. Gives the
+    same digest as hash_string of the whole input
+    """
+
+    def __init__(self):
+        self._hash = hashlib.sha256()
+
+    def update(self, chunk: Union[bytes, str]) -> None:
+        self._hash.update(chunk.encode("utf8") if isinstance(chunk, str) else chunk)
+
+    def hexdigest(self, characters: int = None) -> str:
+        return self._hash.hexdigest()[:characters]
+
+
 def hash_string(hashable_input: str, characters: int = None) -> str:
-    hashed_input = hashlib.sha256(hashable_input.encode("utf8")).hexdigest()
-    return hashed_input[:characters] if hashed_input is not None else hashed_input
+    hashed_input = StreamingHash()
+    hashed_input.update(hashable_input)
+    return hashed_input.hexdigest(characters)
 
 
 if __name__ == "__main__":
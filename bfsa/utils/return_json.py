@@ -7,13 +7,17 @@ Created on 2022-07-17
 """
 
 
-def return_json(message, success=True, content=None, exceptions=None):
+def return_json(
+    message, success=True, content=None, exceptions=None, continuation_token=None
+):
     """
     Convenience wrapper for ASGI return objects
     """
     resp_dict = {"success": success, "message": message}
     if content:
         resp_dict.update({"content": content})
+    if continuation_token:
+        resp_dict.update({"continuation_token": continuation_token})
     if exceptions:
         resp_dict.update({"exceptions": [str(e) for e in exceptions]})
     return resp_dict
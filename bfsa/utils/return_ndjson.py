@@ -0,0 +1,53 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-11
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from typing import Optional, Dict, Any, AsyncIterator
+from json import dumps
+from fastapi.responses import StreamingResponse
+
+from bfsa.utils.logger import logger as log
+from bfsa.utils.return_json import return_json
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def accepts_ndjson(accept: Optional[str]) -> bool:
+    """
+    Indicates whether an Accept header asks for newline-delimited JSON. Endpoints called
+    directly from other controllers receive the Header default rather than a string
+    """
+    return isinstance(accept, str) and NDJSON_MEDIA_TYPE in accept
+
+
+def return_ndjson(items: AsyncIterator[Dict[str, Any]]) -> StreamingResponse:
+    """
+    Convenience wrapper streaming documents as newline-delimited JSON, one per line. If
+    reading fails part way, the stream ends with a failure record in the return_json
+    format, so that clients can tell it is incomplete
+    """
+
+    async def lines():
+        try:
+            async for item in items:
+                yield dumps(item) + "\n"
+        except Exception as e:
+            # headers have already been sent, so the failure can only be reported in-band
+            log.critical(f"Failed to stream data. Error: {e}")
+            yield dumps(
+                return_json(
+                    message="Failed to stream data. Results are incomplete.",
+                    success=False,
+                )
+            ) + "\n"
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE)
+
+
+if __name__ == "__main__":
+    pass
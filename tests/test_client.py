@@ -0,0 +1,179 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-31
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from typing import List, Dict, Any
+from copy import deepcopy
+from types import SimpleNamespace
+from unittest import IsolatedAsyncioTestCase, main
+from azure.cosmos.exceptions import (
+    CosmosBatchOperationError,
+    CosmosResourceNotFoundError,
+)
+
+from bfsa.db.client import Client, retry_on_conflict
+from bfsa.db.fake_client import FakeClient, _apply_patch_operation
+
+
+class BatchContainer:
+    """
+    Stands in for a container, applying patches and transactional batches of patches
+    to one document. The document is changed by another writer before the first batch
+    """
+
+    def __init__(self, document: Dict[str, Any], concurrent_writes: int = 1):
+        self.document = {**document, "_etag": '"0"'}
+        self.version = 0
+        self.concurrent_writes = concurrent_writes
+        self.batches: List[List[Any]] = []
+        self.client_connection = SimpleNamespace(last_response_headers={})
+
+    async def read_item(self, item: str, partition_key: str, **kwargs):
+        if item != self.document["id"]:
+            raise CosmosResourceNotFoundError(status_code=404, message=item)
+        return deepcopy(self.document)
+
+    async def execute_item_batch(self, batch_operations, partition_key: str, **kwargs):
+        self.batches.append(batch_operations)
+        if self.concurrent_writes:
+            self.concurrent_writes -= 1
+            self._changed()
+
+        etag = batch_operations[0][2].get("if_match_etag")
+        if etag is not None and etag != self.document["_etag"]:
+            raise CosmosBatchOperationError(
+                error_index=0,
+                headers={},
+                status_code=412,
+                message="Precondition failed",
+                operation_responses=[{"statusCode": 412}]
+                + [{"statusCode": 424}] * (len(batch_operations) - 1),
+            )
+
+        for _, (_, operations), _ in batch_operations:
+            for operation in operations:
+                _apply_patch_operation(self.document, operation)
+        self._changed()
+        return [{"statusCode": 200}] * len(batch_operations)
+
+    def _changed(self) -> None:
+        self.version += 1
+        self.document["_etag"] = f'"{self.version}"'
+
+
+class TestPatchBatches(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = Client(
+            endpoint="https://localhost:8081/",
+            key="a2V5",
+            database_name="database",
+            container_name="container",
+        )
+        self.container = BatchContainer({"id": "a", "partitionKey": "p", "count": 0})
+        self.client.container = self.container
+        self.item = {"id": "a", "partitionKey": "p"}
+
+    async def asyncTearDown(self):
+        await self.client.close()
+
+    @staticmethod
+    def operations(document: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return [
+            {"op": "set", "path": f"/field{i}", "value": document["count"]}
+            for i in range(Client.MAX_PATCH_OPERATIONS + 2)
+        ] + [{"op": "incr", "path": "/count", "value": 1}]
+
+    async def test_more_operations_than_one_patch_are_batched(self):
+        await self.client.patch_data(self.item, self.operations({"count": 0}))
+
+        self.assertEqual(len(self.container.batches), 1)
+        self.assertEqual(
+            [len(operations) for _, (_, operations), _ in self.container.batches[0]],
+            [10, 3],
+        )
+
+    async def test_only_the_first_batched_patch_checks_the_etag(self):
+        self.container.concurrent_writes = 0
+        await self.client.patch_data(
+            self.item, self.operations({"count": 0}), etag='"0"'
+        )
+
+        self.assertEqual(
+            [options for *_, options in self.container.batches[0]],
+            [{"if_match_etag": '"0"'}, {}],
+        )
+        self.assertEqual(self.container.document["count"], 1)
+
+    async def test_batched_patch_with_stale_etag_raises(self):
+        with self.assertRaises(CosmosBatchOperationError) as raised:
+            await self.client.patch_data(
+                self.item, self.operations({"count": 0}), etag='"stale"'
+            )
+        self.assertEqual(raised.exception.status_code, 412)
+        self.assertEqual(self.container.document["count"], 0)
+
+    async def modify(self) -> bool:
+        async def attempt():
+            document = await self.client.get_by_id("a", "p")
+            return await self.client.patch_data(
+                self.item, self.operations(document), etag=document["_etag"]
+            )
+
+        return await retry_on_conflict(attempt, Client.MAX_CONFLICT_RETRIES)
+
+    async def test_batched_patch_is_retried_on_conflict(self):
+        self.assertTrue(await self.modify())
+
+        self.assertEqual(len(self.container.batches), 2)
+        self.assertEqual(self.container.document["count"], 1)
+        self.assertEqual(self.container.document["field11"], 0)
+
+    async def test_retry_gives_up_after_max_conflict_retries(self):
+        self.container.concurrent_writes = Client.MAX_CONFLICT_RETRIES
+
+        with self.assertRaises(CosmosBatchOperationError):
+            await self.modify()
+        self.assertEqual(len(self.container.batches), Client.MAX_CONFLICT_RETRIES)
+        self.assertEqual(self.container.document["count"], 0)
+
+
+class TestFakeClientPatchBatches(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = FakeClient()
+        await self.client.insert_data([{"id": "a", "partitionKey": "p", "count": 0}])
+        self.item = {"id": "a", "partitionKey": "p"}
+
+    async def test_batched_patch_with_stale_etag_raises_batch_error(self):
+        with self.assertRaises(CosmosBatchOperationError) as raised:
+            await self.client.patch_data(
+                self.item, TestPatchBatches.operations({"count": 0}), etag='"stale"'
+            )
+        self.assertEqual(raised.exception.status_code, 412)
+
+    async def test_batched_patch_is_retried_on_conflict(self):
+        writes = []
+
+        async def attempt():
+            document = await self.client.get_by_id("a", "p")
+            if not writes:
+                # another writer updates the document between the read and the patch
+                writes.append(self.client._write({**document, "count": 5}))
+            return await self.client.patch_data(
+                self.item,
+                TestPatchBatches.operations(document),
+                etag=document["_etag"],
+            )
+
+        self.assertTrue(await retry_on_conflict(attempt, Client.MAX_CONFLICT_RETRIES))
+
+        document = await self.client.get_by_id("a", "p")
+        self.assertEqual(document["count"], 6)
+        self.assertEqual(document["field0"], 5)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-31
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import IsolatedAsyncioTestCase, main
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosHttpResponseError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+
+from bfsa.db.fake_client import FakeClient, FileStorage
+from bfsa.sql.create_select import create_select
+from bfsa.sql.query_builder import Select
+
+
+ITEM = {"id": "a", "partitionKey": "media"}
+
+
+class TestFakeClient(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = FakeClient()
+        await self.client.provision()
+        await self.client.insert_data(
+            [{**ITEM, "title": "A", "counts": {"views": 1}, "tags": ["x", "y"]}]
+        )
+
+    async def read(self):
+        return await self.client.get_by_id(ITEM["id"], ITEM["partitionKey"])
+
+    async def test_insert_existing_document_conflicts(self):
+        with self.assertRaises(CosmosResourceExistsError):
+            await self.client.insert_data([dict(ITEM)])
+
+    async def test_bulk_insert_reports_each_item(self):
+        results = await self.client.bulk_insert_data(
+            [{"id": "b", "partitionKey": "media"}, dict(ITEM)]
+        )
+
+        self.assertEqual([result["success"] for result in results], [True, False])
+        self.assertEqual(results[1]["status_code"], 409)
+
+    async def test_documents_are_keyed_by_partition(self):
+        await self.client.insert_data([{"id": "a", "partitionKey": "papers"}])
+
+        self.assertEqual((await self.read())["title"], "A")
+        self.assertIsNone(await self.client.get_by_id("a", "photo"))
+
+    async def test_reads_are_copies(self):
+        document = await self.read()
+        document["title"] = "B"
+
+        self.assertEqual((await self.read())["title"], "A")
+
+    async def test_writes_change_the_etag(self):
+        etag = (await self.read())["_etag"]
+        await self.client.update_data(ITEM, {"title": "B"}, upsert=False)
+
+        self.assertNotEqual((await self.read())["_etag"], etag)
+
+    async def test_write_with_stale_etag_fails(self):
+        etag = (await self.read())["_etag"]
+        await self.client.update_data(ITEM, {"title": "B"}, upsert=False)
+
+        with self.assertRaises(CosmosAccessConditionFailedError):
+            await self.client.update_data(ITEM, {"title": "C"}, upsert=False, etag=etag)
+        with self.assertRaises(CosmosAccessConditionFailedError):
+            await self.client.delete_data(ITEM["id"], ITEM["partitionKey"], etag=etag)
+        self.assertEqual((await self.read())["title"], "B")
+
+    async def test_delete_missing_document(self):
+        with self.assertRaises(CosmosResourceNotFoundError):
+            await self.client.delete_data("missing", "media")
+
+    async def test_patch_operations(self):
+        await self.client.patch_data(
+            ITEM,
+            [
+                {"op": "set", "path": "/title", "value": "B"},
+                {"op": "incr", "path": "/counts/views", "value": 2},
+                {"op": "add", "path": "/tags/-", "value": "z"},
+                {"op": "remove", "path": "/tags/0"},
+            ],
+        )
+
+        document = await self.read()
+        self.assertEqual(document["title"], "B")
+        self.assertEqual(document["counts"], {"views": 3})
+        self.assertEqual(document["tags"], ["y", "z"])
+
+    async def test_patch_creates_missing_leaf(self):
+        await self.client.patch_data(
+            ITEM,
+            [
+                {"op": "set", "path": "/description", "value": "D"},
+                {"op": "incr", "path": "/counts/likes", "value": 1},
+            ],
+        )
+
+        document = await self.read()
+        self.assertEqual(document["description"], "D")
+        self.assertEqual(document["counts"], {"views": 1, "likes": 1})
+
+    async def test_patch_missing_path_fails_atomically(self):
+        for operation in (
+            {"op": "replace", "path": "/description", "value": "D"},
+            {"op": "remove", "path": "/description"},
+        ):
+            with self.assertRaises(CosmosHttpResponseError) as raised:
+                await self.client.patch_data(
+                    ITEM,
+                    [{"op": "set", "path": "/title", "value": "B"}, operation],
+                )
+            self.assertEqual(raised.exception.status_code, 400)
+
+        self.assertEqual((await self.read())["title"], "A")
+
+    async def test_patch_missing_parent_fails(self):
+        for path in ("/missing/field", "/tags/5/field", "/title/field"):
+            with self.assertRaises(CosmosHttpResponseError) as raised:
+                await self.client.patch_data(
+                    ITEM, [{"op": "set", "path": path, "value": 1}]
+                )
+            self.assertEqual(raised.exception.status_code, 400)
+
+    async def test_patch_missing_document(self):
+        with self.assertRaises(CosmosResourceNotFoundError):
+            await self.client.patch_data(
+                {"id": "missing", "partitionKey": "media"},
+                [{"op": "set", "path": "/title", "value": "B"}],
+            )
+
+    async def test_select_pages_until_no_token(self):
+        await self.client.insert_data(
+            [{"id": str(i), "partitionKey": "media"} for i in range(5)]
+        )
+        query = Select().where("partitionKey", "media").order_by("id").build()
+
+        pages, token = [], None
+        while True:
+            page, token = await self.client.select_page(query, 2, token)
+            pages.append([item["id"] for item in page])
+            if token is None:
+                break
+
+        self.assertEqual(pages, [["0", "1"], ["2", "3"], ["4", "a"]])
+
+    async def test_select_with_projection(self):
+        items = await self.client.select_data(
+            create_select({"partitionKey": "media"}, fields=["id", "counts.views"])
+        )
+
+        self.assertEqual(items, [{"id": "a", "views": 1}])
+
+    async def test_read_many_keeps_request_order(self):
+        await self.client.insert_data([{"id": "b", "partitionKey": "papers"}])
+
+        items = await self.client.read_many(
+            [
+                {"id": "b", "partitionKey": "papers"},
+                {"id": "missing", "partitionKey": "media"},
+                dict(ITEM),
+            ],
+            fields=["id"],
+        )
+
+        self.assertEqual(items, [{"id": "b"}, None, {"id": "a"}])
+
+    async def test_change_feed_starts_from_now(self):
+        changes, continuation = await self.client.read_changes()
+        self.assertEqual(changes, [])
+
+        await self.client.patch_data(
+            ITEM, [{"op": "set", "path": "/title", "value": "B"}]
+        )
+        await self.client.insert_data([{"id": "b", "partitionKey": "media"}])
+        changes, continuation = await self.client.read_changes(continuation)
+
+        self.assertEqual([change["id"] for change in changes], ["a", "b"])
+        self.assertEqual(
+            await self.client.read_changes(continuation), ([], continuation)
+        )
+
+    async def test_sequence_numbers_are_not_returned(self):
+        _, continuation = await self.client.read_changes()
+        await self.client.insert_data([{"id": "b", "partitionKey": "media"}])
+
+        changes, _ = await self.client.read_changes(continuation)
+        items = await self.client.select_data(query=create_select({}))
+
+        for document in [await self.read(), *items, *changes]:
+            self.assertNotIn("_lsn", document)
+
+
+class TestFileStorage(IsolatedAsyncioTestCase):
+    async def test_documents_persist_across_clients(self):
+        with TemporaryDirectory() as directory:
+            path = join(directory, "data", "db.json")
+
+            client = FakeClient(storage=FileStorage(path))
+            await client.provision()
+            await client.insert_data([{**ITEM, "title": "A"}])
+            await client.close()
+
+            client = FakeClient(storage=FileStorage(path))
+            await client.provision()
+            document = await client.get_by_id(ITEM["id"], ITEM["partitionKey"])
+            self.assertEqual(document["title"], "A")
+
+            # the change feed continues from the persisted position
+            _, continuation = await client.read_changes()
+            await client.insert_data([{"id": "b", "partitionKey": "media"}])
+            changes, _ = await client.read_changes(continuation)
+            self.assertEqual([change["id"] for change in changes], ["b"])
+
+
+if __name__ == "__main__":
+    main()
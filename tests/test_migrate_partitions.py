@@ -0,0 +1,130 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-31
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import IsolatedAsyncioTestCase, main
+
+from bfsa.db.fake_client import FakeClient
+from bfsa.db.migrate_partitions import migrate_partition, delete_source
+
+
+class FailingClient(FakeClient):
+    """
+    Fails to insert the documents with the given ids
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.failing_ids = set()
+
+    async def bulk_insert_data(self, payloads, max_concurrency=None):
+        results = await super().bulk_insert_data(
+            [payload for payload in payloads if payload["id"] not in self.failing_ids]
+        )
+        return results + [
+            {"id": item_id, "success": False, "status_code": 503, "error": "down"}
+            for item_id in (payload["id"] for payload in payloads)
+            if item_id in self.failing_ids
+        ]
+
+
+class TestMigratePartition(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = TemporaryDirectory()
+        self.checkpoint_path = join(self.directory.name, "checkpoint.json")
+        self.source = FakeClient()
+        await self.source.provision()
+        await self.source.insert_data(
+            [
+                {
+                    "id": f"s{i}",
+                    "partitionKey": "recipe-steps",
+                    "recipe_id": f"r{i % 2}",
+                }
+                for i in range(5)
+            ]
+            + [{"id": "orphan", "partitionKey": "recipe-steps"}]
+        )
+        self.target = FailingClient()
+        await self.target.provision()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    async def migrate(self):
+        return await migrate_partition(
+            source=self.source,
+            target=self.target,
+            partition_key="recipe-steps",
+            key_field="recipe_id",
+            checkpoint_path=self.checkpoint_path,
+            page_size=2,
+        )
+
+    async def delete(self):
+        return await delete_source(
+            source=self.source,
+            partition_key="recipe-steps",
+            key_field="recipe_id",
+            checkpoint_path=self.checkpoint_path,
+        )
+
+    async def test_documents_are_copied_to_finer_partitions(self):
+        state = await self.migrate()
+
+        self.assertEqual(state["phase"], "done")
+        self.assertEqual((state["copied"], state["skipped"]), (5, 1))
+        copy = await self.target.get_by_id("s3", "recipe-steps:r1")
+        self.assertEqual(copy["entityType"], "recipe-steps")
+        # the source is left untouched, as the API still reads it
+        self.assertIsNotNone(await self.source.get_by_id("s0", "recipe-steps"))
+
+    async def test_failed_copies_are_kept_for_retry(self):
+        self.target.failing_ids = {"s1", "s4"}
+
+        state = await self.migrate()
+
+        self.assertEqual(state["phase"], "retry")
+        self.assertEqual(state["failed_ids"], ["s1", "s4"])
+        self.assertEqual(state["copied"], 3)
+
+        self.target.failing_ids = {"s4"}
+        state = await self.migrate()
+
+        self.assertEqual(state["phase"], "retry")
+        self.assertEqual(state["failed_ids"], ["s4"])
+        self.assertIsNotNone(await self.target.get_by_id("s1", "recipe-steps:r1"))
+
+        self.target.failing_ids = set()
+        state = await self.migrate()
+
+        self.assertEqual(state["phase"], "done")
+        self.assertEqual((state["copied"], state["failed_ids"]), (5, []))
+
+    async def test_source_is_not_deleted_before_migration_is_done(self):
+        self.target.failing_ids = {"s1"}
+        await self.migrate()
+
+        with self.assertRaises(ValueError):
+            await self.delete()
+        self.assertIsNotNone(await self.source.get_by_id("s0", "recipe-steps"))
+
+    async def test_source_is_deleted_as_a_separate_step(self):
+        await self.migrate()
+
+        state = await self.delete()
+
+        self.assertEqual((state["phase"], state["deleted"]), ("deleted", 5))
+        self.assertIsNone(await self.source.get_by_id("s0", "recipe-steps"))
+        # never copied, so kept
+        self.assertIsNotNone(await self.source.get_by_id("orphan", "recipe-steps"))
+
+
+if __name__ == "__main__":
+    main()
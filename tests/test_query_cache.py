@@ -0,0 +1,131 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-31
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from json import dumps
+from unittest import TestCase, main
+from unittest.mock import patch
+
+from bfsa.db.query_cache import QueryCache
+from bfsa.sql.create_select import create_select
+
+
+MEDIA = create_select({"partitionKey": "media"})
+PAPERS = create_select({"partitionKey": "papers"})
+# no partition key, so the query may read from any partition
+TITLES = create_select({"title": "A"})
+
+
+class TestQueryCache(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        clock = patch("bfsa.db.query_cache.monotonic", lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.cache = QueryCache(ttl_in_seconds=10)
+
+    def put(self, query, items):
+        self.cache.put(query, items, self.cache.generation(QueryCache.key(query)[1]))
+
+    def test_hit_returns_a_copy(self):
+        self.put(MEDIA, [{"id": "a"}])
+
+        self.cache.get(MEDIA)[0]["id"] = "b"
+
+        self.assertEqual(self.cache.get(MEDIA), [{"id": "a"}])
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 0))
+
+    def test_key_ignores_whitespace_and_parameter_order(self):
+        query = {
+            "query": MEDIA["query"].replace(" ", "  "),
+            "parameters": list(reversed(MEDIA["parameters"])),
+        }
+
+        self.assertEqual(QueryCache.key(query)[0], QueryCache.key(MEDIA)[0])
+        self.assertEqual(QueryCache.key(MEDIA)[1], "media")
+        self.assertIsNone(QueryCache.key(TITLES)[1])
+
+    def test_entries_expire(self):
+        self.put(MEDIA, [{"id": "a"}])
+
+        self.now = 10.5
+
+        self.assertIsNone(self.cache.get(MEDIA))
+        self.assertEqual(self.cache.size, 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        items = [{"id": "a"}]
+        self.cache.max_bytes = 2 * len(dumps(items))
+        self.put(MEDIA, items)
+        self.put(PAPERS, items)
+
+        self.cache.get(MEDIA)
+        self.put(TITLES, items)
+
+        self.assertIsNotNone(self.cache.get(MEDIA))
+        self.assertIsNone(self.cache.get(PAPERS))
+        self.assertIsNotNone(self.cache.get(TITLES))
+        self.assertEqual(self.cache.size, self.cache.max_bytes)
+
+    def test_results_larger_than_the_cache_are_not_cached(self):
+        self.cache.max_bytes = 10
+        self.put(MEDIA, [{"id": "a" * 10}])
+
+        self.assertIsNone(self.cache.get(MEDIA))
+
+    def test_write_invalidates_its_partition_and_cross_partition_queries(self):
+        for query in (MEDIA, PAPERS, TITLES):
+            self.put(query, [{"id": "a"}])
+
+        self.cache.invalidate("media")
+
+        self.assertIsNone(self.cache.get(MEDIA))
+        self.assertIsNone(self.cache.get(TITLES))
+        self.assertIsNotNone(self.cache.get(PAPERS))
+
+    def test_write_without_partition_key_invalidates_everything(self):
+        for query in (MEDIA, PAPERS, TITLES):
+            self.put(query, [{"id": "a"}])
+
+        self.cache.invalidate(None)
+
+        for query in (MEDIA, PAPERS, TITLES):
+            self.assertIsNone(self.cache.get(query))
+        self.assertEqual(self.cache.size, 0)
+
+    def test_results_read_during_a_write_are_not_cached(self):
+        generation = self.cache.generation("media")
+        self.cache.invalidate("media")
+        self.cache.put(MEDIA, [{"id": "stale"}], generation)
+
+        self.assertIsNone(self.cache.get(MEDIA))
+
+    def test_writes_to_other_partitions_do_not_prevent_caching(self):
+        generation = self.cache.generation("media")
+        self.cache.invalidate("papers")
+        self.cache.put(MEDIA, [{"id": "a"}], generation)
+
+        self.assertEqual(self.cache.get(MEDIA), [{"id": "a"}])
+
+    def test_any_write_prevents_caching_cross_partition_results(self):
+        for partition_key in ("papers", None):
+            generation = self.cache.generation(None)
+            self.cache.invalidate(partition_key)
+            self.cache.put(TITLES, [{"id": "stale"}], generation)
+
+            self.assertIsNone(self.cache.get(TITLES))
+
+    def test_write_without_partition_key_prevents_caching_any_results(self):
+        generation = self.cache.generation("media")
+        self.cache.invalidate(None)
+        self.cache.put(MEDIA, [{"id": "stale"}], generation)
+
+        self.assertIsNone(self.cache.get(MEDIA))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-31
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from unittest import TestCase, main
+
+from bfsa.sql.create_select import create_aggregate
+from bfsa.sql.query_builder import Select
+from bfsa.sql.query_evaluator import evaluate
+
+
+DOCUMENTS = [
+    {"id": "1", "format": "DVD", "year": 1999, "rating": 4.5, "tags": ["a"]},
+    {"id": "2", "format": "Blu-ray", "year": 2008, "rating": 3, "tags": ["b"]},
+    {"id": "3", "format": "DVD", "year": "2001", "rating": None},
+    {"id": "4", "format": "VHS", "year": True, "details": {"region": 2}},
+    {"id": "5", "year": None, "details": {"region": 1}},
+    {"id": "6", "format": "DVD", "year": 1985, "rating": 5},
+]
+
+
+def ids(results):
+    return [result["id"] for result in results]
+
+
+class TestOrdering(TestCase):
+    def test_mixed_types_order_as_cosmos_does(self):
+        results = evaluate(Select().order_by("year").build(), DOCUMENTS)
+
+        # undefined < null < booleans < numbers < strings
+        self.assertEqual(ids(results), ["5", "4", "6", "1", "2", "3"])
+
+    def test_descending_order_reverses_type_order(self):
+        results = evaluate(
+            Select().order_by("year", descending=True).build(), DOCUMENTS
+        )
+
+        self.assertEqual(ids(results), ["3", "2", "1", "6", "4", "5"])
+
+    def test_undefined_fields_sort_first(self):
+        results = evaluate(Select().order_by("format").build(), DOCUMENTS)
+
+        self.assertEqual(ids(results)[0], "5")
+
+    def test_later_orderings_break_ties(self):
+        query = Select().order_by("format").order_by("year", descending=True).build()
+
+        self.assertEqual(
+            ids(evaluate(query, DOCUMENTS)), ["5", "2", "3", "1", "6", "4"]
+        )
+
+    def test_nested_fields(self):
+        query = Select().where("details.region", 1, ">=").order_by("details.region")
+
+        self.assertEqual(ids(evaluate(query.build(), DOCUMENTS)), ["5", "4"])
+
+
+class TestConditions(TestCase):
+    def test_undefined_fields_never_match(self):
+        for operator in ("=", "!=", "<", ">"):
+            results = evaluate(Select().where("rating", 4, operator).build(), DOCUMENTS)
+            self.assertNotIn("4", ids(results))
+            self.assertNotIn("5", ids(results))
+
+    def test_comparisons_between_types_do_not_match(self):
+        results = evaluate(Select().where("year", 2000, ">").build(), DOCUMENTS)
+
+        self.assertEqual(ids(results), ["2"])
+
+    def test_inequality_between_types_matches(self):
+        results = evaluate(Select().where("year", 1999, "!=").build(), DOCUMENTS)
+
+        self.assertEqual(ids(results), ["2", "3", "4", "5", "6"])
+
+    def test_null_equals_null(self):
+        results = evaluate(Select().where("rating", None).build(), DOCUMENTS)
+
+        self.assertEqual(ids(results), ["3"])
+
+    def test_array_contains(self):
+        query = Select().filter({"format": ["DVD", "VHS"]}).build()
+
+        self.assertIn("ARRAY_CONTAINS", query["query"])
+        self.assertEqual(ids(evaluate(query, DOCUMENTS)), ["1", "3", "4", "6"])
+
+    def test_array_contains_skips_undefined(self):
+        query = Select().where_in("format", [None, "VHS"]).build()
+
+        self.assertEqual(ids(evaluate(query, DOCUMENTS)), ["4"])
+
+    def test_conditions_are_combined(self):
+        query = Select().filter({"format": "DVD", "year": {"gte": 1990}}).build()
+
+        self.assertEqual(ids(evaluate(query, DOCUMENTS)), ["1"])
+
+    def test_unsupported_query_is_rejected(self):
+        with self.assertRaises(ValueError):
+            evaluate("SELECT * FROM c WHERE c.id LIKE '1%'", DOCUMENTS)
+
+
+class TestPaging(TestCase):
+    def test_offset_limit(self):
+        query = Select().order_by("id").offset_limit(2, 3).build()
+
+        self.assertEqual(ids(evaluate(query, DOCUMENTS)), ["3", "4", "5"])
+
+    def test_offset_past_the_end(self):
+        query = Select().order_by("id").offset_limit(10, 3).build()
+
+        self.assertEqual(evaluate(query, DOCUMENTS), [])
+
+    def test_top(self):
+        query = Select().order_by("id", descending=True).top(2).build()
+
+        self.assertEqual(ids(evaluate(query, DOCUMENTS)), ["6", "5"])
+
+    def test_projection(self):
+        query = Select(["id", "details.region"]).where("id", "4").build()
+
+        self.assertEqual(evaluate(query, DOCUMENTS), [{"id": "4", "region": 2}])
+
+
+class TestAggregates(TestCase):
+    def test_count(self):
+        query = create_aggregate({"format": "DVD"})
+
+        self.assertEqual(evaluate(query, DOCUMENTS), [3])
+
+    def test_sum_and_average_skip_non_numbers(self):
+        self.assertEqual(
+            evaluate(create_aggregate(None, "sum", "rating"), DOCUMENTS), [12.5]
+        )
+        self.assertEqual(
+            evaluate(create_aggregate(None, "avg", "rating"), DOCUMENTS), [12.5 / 3]
+        )
+
+    def test_min_and_max_order_across_types(self):
+        self.assertEqual(
+            evaluate(create_aggregate(None, "min", "year"), DOCUMENTS), [True]
+        )
+        self.assertEqual(
+            evaluate(create_aggregate(None, "max", "year"), DOCUMENTS), ["2001"]
+        )
+
+    def test_aggregate_of_nothing_is_undefined(self):
+        query = create_aggregate({"format": "Betamax"}, "sum", "rating")
+
+        self.assertEqual(evaluate(query, DOCUMENTS), [])
+
+    def test_grouped_count(self):
+        rows = evaluate(create_aggregate(None, "count", group_by="format"), DOCUMENTS)
+
+        self.assertCountEqual(
+            rows,
+            [
+                {"bucket": "DVD", "result": 3},
+                {"bucket": "Blu-ray", "result": 1},
+                {"bucket": "VHS", "result": 1},
+                # documents without the field are grouped without a bucket
+                {"result": 1},
+            ],
+        )
+
+    def test_grouped_aggregate_omits_undefined_results(self):
+        rows = evaluate(create_aggregate(None, "max", "rating", "format"), DOCUMENTS)
+
+        self.assertCountEqual(
+            rows,
+            [
+                {"bucket": "DVD", "result": 5},
+                {"bucket": "Blu-ray", "result": 3},
+                {"bucket": "VHS"},
+                {},
+            ],
+        )
+
+    def test_grouped_by_prefix(self):
+        documents = [
+            {"id": "1", "date": "2001-01-01"},
+            {"id": "2", "date": "2001-06-01"},
+            {"id": "3", "date": "2002-01-01"},
+        ]
+        query = create_aggregate(None, "count", group_by="date", group_by_prefix=4)
+
+        self.assertCountEqual(
+            evaluate(query, documents),
+            [{"bucket": "2001", "result": 2}, {"bucket": "2002", "result": 1}],
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-04-01
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from json import loads
+from unittest import IsolatedAsyncioTestCase, main
+
+from bfsa.utils.return_ndjson import return_ndjson
+
+
+async def documents(count: int, fail: bool = False):
+    for i in range(count):
+        yield {"id": str(i)}
+    if fail:
+        raise RuntimeError("Connection reset")
+
+
+class TestReturnNdjson(IsolatedAsyncioTestCase):
+    async def lines(self, items):
+        response = return_ndjson(items)
+        return [loads(line) async for line in response.body_iterator]
+
+    async def test_one_document_per_line(self):
+        self.assertEqual(await self.lines(documents(2)), [{"id": "0"}, {"id": "1"}])
+
+    async def test_failure_part_way_ends_with_failure_record(self):
+        lines = await self.lines(documents(2, fail=True))
+
+        self.assertEqual(lines[:2], [{"id": "0"}, {"id": "1"}])
+        self.assertEqual(len(lines), 3)
+        self.assertFalse(lines[-1]["success"])
+
+
+if __name__ == "__main__":
+    main()
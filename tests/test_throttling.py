@@ -0,0 +1,191 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-31
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from asyncio import create_task, sleep
+from unittest import IsolatedAsyncioTestCase, TestCase, main
+from unittest.mock import patch
+from azure.cosmos.exceptions import CosmosHttpResponseError
+
+from bfsa.db.throttling import (
+    Priority,
+    RequestUnitBudget,
+    ThrottlingRetryPolicy,
+    background_priority,
+    request_priority,
+    RETRY_AFTER_HEADER,
+)
+
+
+class FakeClockTestCase(IsolatedAsyncioTestCase):
+    """
+    Runs the throttling module against a clock that only advances while it sleeps
+    """
+
+    def setUp(self):
+        self.now = 0.0
+        self.sleeps = []
+
+        async def fake_sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+            # let other tasks run, as a real sleep would
+            await sleep(0)
+
+        for target, replacement in (
+            ("bfsa.db.throttling.monotonic", lambda: self.now),
+            ("bfsa.db.throttling.sleep", fake_sleep),
+        ):
+            patcher = patch(target, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class TestRequestUnitBudget(FakeClockTestCase):
+    def setUp(self):
+        super().setUp()
+        # 100 RU/s, 25 RU of which are reserved for interactive requests
+        self.budget = RequestUnitBudget(100)
+
+    async def test_acquire_reserves_the_estimate(self):
+        await self.budget.acquire("read_item")
+
+        self.assertEqual(self.budget._tokens, 100 - RequestUnitBudget.DEFAULT_ESTIMATE)
+        self.assertEqual(self.sleeps, [])
+
+    async def test_settle_refunds_an_overestimate(self):
+        await self.budget.acquire("read_item")
+        self.budget.settle("read_item", 1.0)
+
+        self.assertEqual(self.budget._tokens, 99)
+
+    async def test_settle_charges_an_underestimate(self):
+        await self.budget.acquire("query")
+        self.budget.settle("query", 30.0)
+
+        self.assertEqual(self.budget._tokens, 70)
+
+    async def test_settle_moves_the_estimate_towards_the_charge(self):
+        await self.budget.acquire("query")
+        self.budget.settle("query", 30.0)
+
+        self.assertAlmostEqual(self.budget.estimate("query"), 0.8 * 5 + 0.2 * 30)
+        self.assertEqual(self.budget.estimate("read_item"), 5)
+
+    async def test_settle_without_a_charge_refunds_and_keeps_the_estimate(self):
+        await self.budget.acquire("query")
+        self.budget.settle("query", 0.0)
+
+        self.assertEqual(self.budget._tokens, 100)
+        self.assertEqual(self.budget.estimate("query"), 5)
+
+    async def test_estimates_are_capped_to_what_the_bucket_can_hold(self):
+        self.budget._estimates["query"] = 500.0
+        await self.budget.acquire("query")
+        self.budget.settle("query", 500.0)
+
+        # 75 reserved, the rest charged when settled
+        self.assertEqual(self.budget._tokens, -400)
+
+    async def test_interactive_acquire_waits_for_the_bucket_to_refill(self):
+        self.budget._tokens = 0
+        await self.budget.acquire("read_item")
+
+        self.assertAlmostEqual(self.now, 0.05)
+        self.assertAlmostEqual(self.budget._tokens, 0)
+
+    async def test_interactive_requests_may_spend_the_reserve(self):
+        self.budget._tokens = 10
+        await self.budget.acquire("read_item")
+
+        self.assertEqual(self.sleeps, [])
+
+    async def test_background_requests_leave_the_reserve(self):
+        self.budget._tokens = 10
+        with background_priority():
+            await self.budget.acquire("read_item")
+
+        # waits until 25 reserved + 5 estimated are available
+        self.assertAlmostEqual(self.now, 0.2)
+        self.assertAlmostEqual(self.budget._tokens, 25)
+
+    async def test_background_requests_wait_for_interactive_ones(self):
+        self.budget._tokens = 0
+        order = []
+
+        async def acquire(name):
+            await self.budget.acquire("read_item")
+            order.append(name)
+
+        with background_priority():
+            background = create_task(acquire("background"))
+        await sleep(0)
+        await acquire("interactive")
+        await background
+
+        self.assertEqual(order, ["interactive", "background"])
+
+    async def test_throttled_pauses_every_lane(self):
+        self.budget.throttled(0.5)
+        await self.budget.acquire("read_item")
+
+        self.assertAlmostEqual(self.now, 0.55)
+
+
+class TestThrottlingRetryPolicy(FakeClockTestCase):
+    def setUp(self):
+        super().setUp()
+        self.budget = RequestUnitBudget(100)
+        self.policy = ThrottlingRetryPolicy(self.budget, max_attempts=3)
+        self.attempts = 0
+
+    def failing(self, *errors):
+        async def attempt():
+            self.attempts += 1
+            if self.attempts <= len(errors):
+                raise errors[self.attempts - 1]
+            return "result"
+
+        return attempt
+
+    async def test_retries_after_the_interval_the_server_returns(self):
+        error = CosmosHttpResponseError(status_code=429, message="Too many requests")
+        error.headers = {RETRY_AFTER_HEADER: "250"}
+
+        self.assertEqual(await self.policy.run(self.failing(error)), "result")
+        self.assertEqual(self.sleeps, [0.25])
+
+    async def test_backs_off_exponentially_without_an_interval(self):
+        errors = [CosmosHttpResponseError(status_code=429) for _ in range(2)]
+
+        self.assertEqual(await self.policy.run(self.failing(*errors)), "result")
+        self.assertEqual(self.sleeps, [0.1, 0.2])
+
+    async def test_gives_up_after_max_attempts(self):
+        errors = [CosmosHttpResponseError(status_code=429) for _ in range(3)]
+
+        with self.assertRaises(CosmosHttpResponseError):
+            await self.policy.run(self.failing(*errors))
+        self.assertEqual(self.attempts, 3)
+
+    async def test_other_errors_are_not_retried(self):
+        with self.assertRaises(CosmosHttpResponseError):
+            await self.policy.run(
+                self.failing(CosmosHttpResponseError(status_code=412))
+            )
+        self.assertEqual(self.attempts, 1)
+
+
+class TestBackgroundPriority(TestCase):
+    def test_lane_is_restored(self):
+        with background_priority():
+            self.assertEqual(request_priority.get(), Priority.BACKGROUND)
+        self.assertEqual(request_priority.get(), Priority.INTERACTIVE)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-31
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from unittest import IsolatedAsyncioTestCase, main
+
+from bfsa.db.fake_client import FakeClient
+from bfsa.db.unit_of_work import UnitOfWork
+
+
+ITEM = {"id": "a", "partitionKey": "media"}
+
+
+class CountingClient(FakeClient):
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    async def get_by_id(self, *args, **kwargs):
+        self.reads += 1
+        return await super().get_by_id(*args, **kwargs)
+
+
+class TestUnitOfWork(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = CountingClient()
+        await self.client.provision()
+        await self.client.insert_data([{**ITEM, "title": "A"}])
+        self.unit_of_work = UnitOfWork(self.client)
+
+    async def read(self):
+        return await self.unit_of_work.get_by_id(
+            item_id=ITEM["id"], partition_key=ITEM["partitionKey"]
+        )
+
+    async def test_identical_reads_reach_the_database_once(self):
+        first = await self.read()
+        second = await self.read()
+
+        self.assertEqual(self.client.reads, 1)
+        self.assertEqual(first, second)
+
+    async def test_only_repeated_reads_are_copied(self):
+        first = await self.read()
+        second = await self.read()
+        second["title"] = "B"
+
+        self.assertIsNot(first, second)
+        self.assertEqual(first["title"], "A")
+        self.assertEqual((await self.read())["title"], "A")
+
+    async def test_different_reads_are_memoised_apart(self):
+        await self.read()
+        await self.unit_of_work.get_by_id(item_id="b", partition_key="media")
+
+        self.assertEqual(self.client.reads, 2)
+
+    async def test_writes_drop_memoised_reads(self):
+        await self.read()
+        await self.unit_of_work.patch_data(
+            ITEM, [{"op": "set", "path": "/title", "value": "B"}]
+        )
+
+        self.assertEqual((await self.read())["title"], "B")
+        self.assertEqual(self.client.reads, 2)
+
+    async def test_failed_writes_drop_memoised_reads(self):
+        await self.read()
+        with self.assertRaises(Exception):
+            await self.unit_of_work.insert_data([dict(ITEM)])
+
+        await self.read()
+        self.assertEqual(self.client.reads, 2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!
+# -*- coding: utf-8 -*-
+"""
+Created on 2023-03-31
+@author: Edmund Bennett
+@email: bennettedmund@gmail.com
+"""
+
+from asyncio import sleep
+from unittest import IsolatedAsyncioTestCase, main
+from unittest.mock import patch
+
+from bfsa.controllers.blog import blog_controller
+from bfsa.db.fake_client import FakeClient
+from bfsa.db.unit_of_work import UnitOfWork
+from bfsa.db.write_behind import WriteBehindQueue
+
+
+BLOG = {"id": "a", "partitionKey": "blog"}
+
+
+class TestWriteBehindQueue(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = FakeClient()
+        await self.client.provision()
+        await self.client.insert_data([{**BLOG, "title": "A"}])
+
+        async def get_client():
+            return self.client
+
+        self.queue = WriteBehindQueue(get_client, flush_interval_in_seconds=60)
+
+    async def read(self):
+        return await self.client.get_by_id(BLOG["id"], BLOG["partitionKey"])
+
+    async def test_increments_of_a_document_are_coalesced(self):
+        for _ in range(3):
+            self.queue.increment(BLOG, "/views")
+
+        self.assertEqual(len(self.queue), 1)
+        self.assertNotIn("views", await self.read())
+
+        await self.queue.flush()
+
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual((await self.read())["views"], 3)
+
+    async def test_delete_supersedes_queued_patches(self):
+        self.queue.increment(BLOG, "/views")
+        self.queue.delete(BLOG["id"], BLOG["partitionKey"])
+
+        await self.queue.flush()
+
+        self.assertIsNone(await self.read())
+
+    async def test_queue_is_flushed_when_full(self):
+        self.queue.max_batch_size = 1
+        self.queue.increment(BLOG, "/views")
+        await sleep(0)
+
+        self.assertEqual(len(self.queue), 0)
+        await self.queue.stop()
+        self.assertEqual((await self.read())["views"], 1)
+
+    async def test_failed_writes_do_not_stop_the_flush(self):
+        self.queue.increment({"id": "missing", "partitionKey": "blog"}, "/views")
+        self.queue.increment(BLOG, "/views")
+
+        await self.queue.flush()
+
+        self.assertEqual((await self.read())["views"], 1)
+
+    async def test_stop_drains_the_queue(self):
+        self.queue.start()
+        self.queue.increment(BLOG, "/views")
+
+        await self.queue.stop()
+
+        self.assertEqual((await self.read())["views"], 1)
+
+    async def test_blog_point_read_counts_a_view_behind(self):
+        with patch.object(blog_controller, "write_behind_queue", self.queue):
+            for _ in range(2):
+                response = await blog_controller.read_blog(
+                    where=dict(BLOG), client=UnitOfWork(self.client)
+                )
+                self.assertTrue(response["success"])
+            await blog_controller.read_blog(
+                where={"id": "missing"}, client=UnitOfWork(self.client)
+            )
+
+        self.assertNotIn("views", await self.read())
+        self.assertEqual(len(self.queue), 1)
+
+        await self.queue.flush()
+
+        self.assertEqual((await self.read())["views"], 2)
+
+
+if __name__ == "__main__":
+    main()